@@ -2,6 +2,8 @@
 import numpy as np
 import torch
 
+from components.joint_action_reduction import cvar_topk
+
 class OptimismScheduler:
     """
     Decays an optimism coefficient alpha from start_val to end_val over t_max steps.
@@ -54,19 +56,12 @@ def cvar_q(q_values, alpha):
     Returns:
         torch.Tensor: Shape [batch] with the CVaR value.
     """
-    if alpha <= 0 or alpha > 1:
-        raise ValueError("Alpha must be in (0, 1]")
-    
-    # Sort Q-values along the last dimension (actions of other agents)
     # q_values shape: [..., n_joint_actions]
-    sorted_q, _ = torch.sort(q_values, descending=True, dim=-1)
-    
-    n_actions = q_values.shape[-1]
-    k = int(np.ceil(alpha * n_actions))
-    k = max(1, k) # Ensure at least 1
+    k = cvar_topk(q_values.shape[-1], alpha)
     
-    # Take top k values
-    top_k = sorted_q[..., :k]
+    # Take top k values along the last dimension (actions of other agents),
+    # partial selection instead of a full sort
+    top_k = torch.topk(q_values, k, dim=-1)[0]
     
     # Mean of top k
     return top_k.mean(dim=-1)
@@ -0,0 +1,6 @@
+import os
+from os.path import dirname, abspath
+import sys
+
+# the tests import the EPyMARL modules the way custom_main.py runs them, from src
+sys.path.insert(0, os.path.join(dirname(dirname(dirname(abspath(__file__)))), "src"))
@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from types import SimpleNamespace as SN
+
+import pytest
+import torch as th
+
+from components.async_actor import AsyncActor
+from run import collect_batch
+from utils.logging import Logger
+
+
+class FakeRunner:
+    # Returns the agent weight of the controller it acts with as the episode batch,
+    # every run takes 10 env steps
+    def __init__(self, n_runs=None):
+        self.mac = None
+        self.buffer = object()
+        self.n_runs = n_runs
+        self.runs = 0
+        self.t_env = 0
+        self.ran = threading.Event()
+
+    def run(self, test_mode=False):
+        if self.n_runs is not None and self.runs >= self.n_runs:
+            raise RuntimeError("out of episodes")
+        self.runs += 1
+        self.t_env += 10
+        self.ran.set()
+        return float(self.mac.agent.weight)
+
+
+def make_mac():
+    agent = th.nn.Linear(1, 1, bias=False)
+    with th.no_grad():
+        agent.weight.fill_(0.0)
+    return SN(agent=agent)
+
+
+def test_actor_runs_with_the_published_parameters():
+    mac, runner = make_mac(), FakeRunner()
+    actor = AsyncActor(runner, mac, max_queue=1)
+    try:
+        # the runner acts with a copy of the controller and fills no buffer slots
+        assert runner.mac is not mac
+        assert runner.buffer is None
+        assert actor.get() == (0.0, 1, 10)
+
+        with th.no_grad():
+            mac.agent.weight.fill_(2.0)
+        actor.publish()
+        # the batches queued before the publish still come with the old version
+        batch, version, _ = actor.get()
+        while version < actor.version:
+            batch, version, _ = actor.get()
+        assert batch == 2.0
+
+        actor.record_lag(1, dropped=True)
+        actor.record_lag(2)
+        stats = actor.stats()
+        assert (stats["policy_lag_mean"], stats["policy_lag_max"]) == (0.5, 1.0)
+        assert stats["stale_batches_dropped"] == 1
+        assert "actor_wait_mean" in stats
+        assert actor.stats() == {}
+    finally:
+        actor.close()
+
+
+def test_runner_lock_pauses_the_actor():
+    actor = AsyncActor(FakeRunner(), make_mac(), max_queue=1)
+    try:
+        actor.get()
+        with actor.runner_lock:
+            runs = actor.runner.runs
+            actor.runner.ran.clear()
+            assert not actor.runner.ran.wait(0.2)
+            assert actor.runner.runs == runs
+    finally:
+        actor.close()
+
+
+def test_actor_errors_are_raised_by_get():
+    actor = AsyncActor(FakeRunner(n_runs=1), make_mac(), max_queue=2)
+    try:
+        assert actor.get() == (0.0, 1, 10)
+        with pytest.raises(RuntimeError):
+            actor.get()
+    finally:
+        actor.close()
+
+
+def test_batches_come_with_the_t_env_of_their_run():
+    runner = FakeRunner()
+    actor = AsyncActor(runner, make_mac(), max_queue=2)
+    logger = Logger(logging.getLogger("test_async_actor"))
+    try:
+        # the actor runs ahead of the learner, the queued batches keep their t_env
+        assert runner.ran.wait(1.0)
+        ts = [collect_batch(runner, actor, None, logger)[1] for _ in range(4)]
+        assert ts == [10, 20, 30, 40]
+        assert runner.t_env >= 40
+    finally:
+        actor.close()
+
+
+def test_stale_batches_are_dropped():
+    runner = FakeRunner()
+    actor = AsyncActor(runner, make_mac(), max_queue=1)
+    logger = Logger(logging.getLogger("test_async_actor"))
+    try:
+        assert collect_batch(runner, actor, 0, logger) == (0.0, 10, False)
+        # the batch queued meanwhile was collected before this update
+        while not actor.batches.full():
+            time.sleep(0.01)
+        actor.publish()
+        episode_batch, t_env, stale = collect_batch(runner, actor, 0, logger)
+        assert (episode_batch, t_env, stale) == (None, 20, True)
+        assert actor.stats()["stale_batches_dropped"] == 1
+    finally:
+        actor.close()
+
+
+def test_collect_batch_runs_the_runner_without_actor():
+    runner = FakeRunner()
+    runner.mac = make_mac()
+    logger = Logger(logging.getLogger("test_async_actor"))
+    assert collect_batch(runner, None, None, logger) == (0.0, 10, False)
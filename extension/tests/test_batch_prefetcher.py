@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import torch as th
+
+from components.batch_prefetcher import BatchPrefetcher
+from components.episode_buffer import ReplayBuffer
+from test_episode_buffer import GROUPS, MAX_T, SCHEME, make_episodes
+
+
+def make_buffer(lengths):
+    buffer = ReplayBuffer(SCHEME, GROUPS, len(lengths), MAX_T)
+    buffer.insert_episode_batch(make_episodes(list(range(len(lengths))), lengths))
+    return buffer
+
+
+def test_prefetched_batch_matches_the_sampled_episodes():
+    buffer = make_buffer([2, 3, 4, 3, 2])
+    prefetcher = BatchPrefetcher(buffer, 3, "cpu")
+    try:
+        np.random.seed(0)
+        prefetcher.request()
+        batch = prefetcher.get()
+        np.random.seed(0)
+        ep_ids = buffer.sample_ids(3)
+
+        # truncated to the longest sampled episode
+        assert batch.max_seq_length == max([2, 3, 4, 3, 2][i] for i in ep_ids)
+        expected = buffer[ep_ids][:, : batch.max_seq_length]
+        for k in ["obs", "reward", "filled"]:
+            assert th.equal(batch[k], expected[k])
+        assert set(prefetcher.wait_stats()) == {"prefetch_wait_mean", "prefetch_wait_max"}
+        assert prefetcher.wait_stats() == {}
+    finally:
+        prefetcher.close()
+
+
+def test_prefetched_batches_reuse_the_slots():
+    buffer = make_buffer([6, 6, 6, 6])
+    prefetcher = BatchPrefetcher(buffer, 2, "cpu", n_slots=2)
+    try:
+        prefetcher.request()
+        first = prefetcher.get()
+        prefetcher.request()
+        second = prefetcher.get()
+        prefetcher.request()
+        third = prefetcher.get()
+        assert first["obs"].data_ptr() == third["obs"].data_ptr() != second["obs"].data_ptr()
+        # only one batch can be pending while the learner holds the other slot
+        prefetcher.request()
+        with pytest.raises(AssertionError):
+            prefetcher.request()
+        prefetcher.get()
+    finally:
+        prefetcher.close()
+
+
+def test_prefetcher_leaves_out_reserved_slots():
+    buffer = make_buffer([6, 6, 6, 6])
+    buffer.reserve_episode_batch(2)
+    assert not buffer.can_sample(3)
+    prefetcher = BatchPrefetcher(buffer, 2, "cpu")
+    try:
+        for _ in range(5):
+            prefetcher.request()
+            assert sorted(prefetcher.get()["obs"][:, 0, 0, 0].long().tolist()) == [2, 3]
+    finally:
+        prefetcher.close()
+
+
+def test_prefetcher_raises_the_sampling_errors_in_get():
+    buffer = make_buffer([6, 6])
+    prefetcher = BatchPrefetcher(buffer, 2, "cpu")
+    try:
+        buffer.reserve_episode_batch(1)
+        prefetcher.request()
+        with pytest.raises(AssertionError):
+            prefetcher.get()
+    finally:
+        prefetcher.close()
@@ -0,0 +1,74 @@
+import numpy as np
+import torch as th
+
+from components.episode_buffer import EpisodeBatch, ReplayBuffer
+from components.memmap_buffer import MemmapReplayBuffer
+from components.transforms import OneHot
+from test_episode_buffer import GROUPS, MAX_T, N_AGENTS
+
+
+N_ACTIONS = 5
+SCHEME = {
+    "obs": {"vshape": 3, "group": "agents"},
+    "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+    "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int},
+}
+COMPACT_SCHEME = {
+    "obs": {**SCHEME["obs"], "storage_dtype": th.float16},
+    "actions": {**SCHEME["actions"], "storage_dtype": th.uint8, "lazy_preprocess": True},
+    "avail_actions": {**SCHEME["avail_actions"], "storage_dtype": th.bool},
+}
+PREPROCESS = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+
+
+def make_episodes(n_episodes):
+    batch = EpisodeBatch(SCHEME, GROUPS, n_episodes, MAX_T, preprocess=PREPROCESS)
+    batch.update(
+        {
+            # exactly representable in float16
+            "obs": th.randint(-8, 8, (n_episodes, MAX_T, N_AGENTS, 3)).float() / 4,
+            "actions": th.randint(N_ACTIONS, (n_episodes, MAX_T, N_AGENTS, 1)),
+            "avail_actions": th.randint(2, (n_episodes, MAX_T, N_AGENTS, N_ACTIONS), dtype=th.int),
+        }
+    )
+    return batch
+
+
+def check_batch(sample, expected):
+    for k in ["obs", "actions", "avail_actions", "actions_onehot", "filled"]:
+        assert sample[k].dtype == expected[k].dtype
+        assert th.equal(sample[k], expected[k])
+
+
+def test_compact_buffer_stores_narrow_dtypes():
+    buffer = ReplayBuffer(COMPACT_SCHEME, GROUPS, 4, MAX_T, preprocess=PREPROCESS)
+    assert buffer.data.transition_data["obs"].dtype == th.float16
+    assert buffer.data.transition_data["actions"].dtype == th.uint8
+    assert buffer.data.transition_data["avail_actions"].dtype == th.bool
+    assert buffer.data.transition_data["filled"].dtype == th.uint8
+    # computed when sampling
+    assert "actions_onehot" not in buffer.data.transition_data
+    assert not buffer.can_reserve
+
+
+def test_compact_buffer_samples_the_scheme_dtypes():
+    th.manual_seed(0)
+    episodes = make_episodes(3)
+    buffer = ReplayBuffer(COMPACT_SCHEME, GROUPS, 4, MAX_T, preprocess=PREPROCESS)
+    buffer.insert_episode_batch(episodes)
+
+    check_batch(buffer.sample(3), episodes)
+    np.random.seed(0)
+    ep_ids = buffer.sample_ids(2)
+    np.random.seed(0)
+    check_batch(buffer.sample(2), episodes[ep_ids])
+
+
+def test_compact_memmap_buffer_stores_bfloat16(tmp_path):
+    th.manual_seed(0)
+    episodes = make_episodes(2)
+    scheme = {**COMPACT_SCHEME, "obs": {**SCHEME["obs"], "storage_dtype": th.bfloat16}}
+    buffer = MemmapReplayBuffer(scheme, GROUPS, 2, MAX_T, str(tmp_path), preprocess=PREPROCESS)
+    buffer.insert_episode_batch(episodes)
+    assert buffer.data.transition_data["obs"].dtype == th.bfloat16
+    check_batch(buffer.sample(2), episodes)
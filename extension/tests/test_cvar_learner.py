@@ -0,0 +1,75 @@
+from types import SimpleNamespace as SN
+
+import torch as th
+
+from components.episode_buffer import EpisodeBatch
+from components.transforms import OneHot
+from extension.learners.pac_cvar_learner import PACCVaRLearner
+from extension.modules.optimism import cvar_q
+
+
+N_AGENTS = 3
+N_ACTIONS = 4
+STATE_SHAPE = 4
+OBS_SHAPE = 3
+BS = 2
+MAX_T = 4
+CVAR_ALPHA = 0.5
+
+
+def make_learner():
+    th.manual_seed(0)
+    scheme = {
+        "state": {"vshape": STATE_SHAPE},
+        "obs": {"vshape": OBS_SHAPE, "group": "agents"},
+        "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+        "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int},
+    }
+    groups = {"agents": N_AGENTS}
+    preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+    batch = EpisodeBatch(scheme, groups, BS, MAX_T, preprocess=preprocess)
+    batch.update(
+        {
+            "state": th.randn(BS, MAX_T, STATE_SHAPE),
+            "obs": th.randn(BS, MAX_T, N_AGENTS, OBS_SHAPE),
+            "actions": th.randint(N_ACTIONS, (BS, MAX_T, N_AGENTS, 1)),
+            "avail_actions": th.ones(BS, MAX_T, N_AGENTS, N_ACTIONS, dtype=th.int),
+        }
+    )
+
+    args = SN(
+        n_agents=N_AGENTS,
+        n_actions=N_ACTIONS,
+        hidden_dim=8,
+        lr=0.0005,
+        use_cuda=False,
+        critic_type="pac_critic",
+        state_value_type="cv_critic",
+        obs_individual_obs=True,
+        obs_last_action=True,
+        learner_log_interval=1,
+        cvar_alpha=CVAR_ALPHA,
+        compute_all_chunk_size=5,
+    )
+    mac = SN(parameters=lambda: [th.nn.Parameter(th.zeros(1))])
+    learner = PACCVaRLearner(mac, batch.scheme, None, args)
+    return learner, batch
+
+
+def test_cvar_is_over_the_own_actions():
+    learner, batch = make_learner()
+    assert learner.operator.name == "cvar"
+    assert learner.target_operator.name == "max"
+
+    reduction = learner.reduce_joint_actions(
+        learner.critic, batch, cvar_k=learner.operator.cvar_k
+    )
+    value = learner.operator(reduction)
+
+    # CVaR over the last (own action) dimension of compute_all, for every joint action
+    # of the other agents
+    with th.no_grad():
+        q_all = learner.critic(batch, compute_all=True)[0][:, :-1]
+    n_joint = N_ACTIONS ** (N_AGENTS - 1)
+    assert value.shape == (BS, MAX_T - 1, N_AGENTS, n_joint)
+    assert th.allclose(value, cvar_q(q_all, CVAR_ALPHA), atol=1e-5)
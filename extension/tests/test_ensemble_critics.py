@@ -0,0 +1,49 @@
+from types import SimpleNamespace as SN
+
+import torch as th
+
+from components.episode_buffer import EpisodeBatch
+from modules.critics.ac_ns import ACCriticNS
+from modules.critics.mlp import MLP, EnsembleMLP
+
+
+N_AGENTS = 3
+OBS_SHAPE = 5
+HIDDEN_DIM = 8
+
+
+def per_agent_mlps(output_dim=1):
+    th.manual_seed(0)
+    return [MLP(OBS_SHAPE, HIDDEN_DIM, output_dim) for _ in range(N_AGENTS)]
+
+
+def test_ensemble_mlp_loads_per_model_state_dicts():
+    mlps = per_agent_mlps(output_dim=4)
+    state_dict = {
+        "{}.{}".format(i, k): v for i, mlp in enumerate(mlps) for k, v in mlp.state_dict().items()
+    }
+    ensemble = EnsembleMLP(N_AGENTS, OBS_SHAPE, HIDDEN_DIM, 4)
+    ensemble.load_state_dict(state_dict)
+
+    inputs = th.randn(2, 6, N_AGENTS, OBS_SHAPE)
+    expected = th.stack([mlp(inputs[..., i, :]) for i, mlp in enumerate(mlps)], dim=-2)
+    assert th.allclose(ensemble(inputs), expected, atol=1e-6)
+
+
+def test_ns_critic_loads_per_agent_mlp_checkpoint():
+    # checkpoints saved before the ensemble: a list with one MLP state dict per agent
+    mlps = per_agent_mlps()
+    args = SN(n_agents=N_AGENTS, n_actions=2, hidden_dim=HIDDEN_DIM)
+    scheme = {"obs": {"vshape": OBS_SHAPE, "group": "agents"}}
+    critic = ACCriticNS(scheme, args)
+    critic.load_state_dict([mlp.state_dict() for mlp in mlps])
+
+    batch = EpisodeBatch(scheme, {"agents": N_AGENTS}, 2, 4)
+    batch.update({"obs": th.randn(2, 4, N_AGENTS, OBS_SHAPE)}, ts=slice(None))
+    expected = th.stack([mlp(batch["obs"][:, :, i]) for i, mlp in enumerate(mlps)], dim=2)
+    assert th.allclose(critic(batch), expected, atol=1e-6)
+
+    # and the new checkpoints round trip
+    other = ACCriticNS(scheme, args)
+    other.load_state_dict(critic.state_dict())
+    assert th.allclose(other(batch), expected, atol=1e-6)
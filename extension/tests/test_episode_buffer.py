@@ -0,0 +1,304 @@
+from types import SimpleNamespace as SN
+
+import numpy as np
+import pytest
+import torch as th
+
+from components.episode_buffer import EpisodeBatch, ReplayBuffer
+from controllers.basic_controller import BasicMAC
+
+
+N_AGENTS = 2
+MAX_T = 6
+SCHEME = {
+    "obs": {"vshape": 3, "group": "agents"},
+    "reward": {"vshape": (1,)},
+}
+GROUPS = {"agents": N_AGENTS}
+
+
+def make_episodes(ids, lengths=None, scheme=SCHEME):
+    # Episodes whose obs hold their id and their timestep, filled up to lengths
+    lengths = [MAX_T] * len(ids) if lengths is None else lengths
+    batch = EpisodeBatch(scheme, GROUPS, len(ids), MAX_T)
+    for b, (ep_id, length) in enumerate(zip(ids, lengths)):
+        t = th.arange(length, dtype=th.float32)
+        obs = th.stack([th.full_like(t, ep_id), t, th.zeros_like(t)], dim=-1)
+        batch.update(
+            {"obs": obs.unsqueeze(1).expand(-1, N_AGENTS, -1), "reward": t.unsqueeze(-1)},
+            bs=b,
+            ts=slice(0, length),
+        )
+    return batch
+
+
+def stored_ids(buffer):
+    return buffer["obs"][:, 0, 0, 0].long().tolist()
+
+
+def test_ring_insert_wraps_around():
+    buffer = ReplayBuffer(SCHEME, GROUPS, 5, MAX_T)
+    buffer.insert_episode_batch(make_episodes([0, 1, 2], lengths=[6, 2, 3]))
+    assert (buffer.buffer_index, buffer.episodes_in_buffer) == (3, 3)
+
+    # slots 3 and 4, then 0 after the wraparound
+    buffer.insert_episode_batch(make_episodes([3, 4, 5], lengths=[4, 5, 1]))
+    assert stored_ids(buffer) == [5, 1, 2, 3, 4]
+    assert (buffer.buffer_index, buffer.episodes_in_buffer) == (1, 5)
+    # the timesteps of the episodes are copied along with them
+    assert th.equal(buffer["obs"][4, :, 0, 1], th.tensor([0.0, 1, 2, 3, 4, 0]))
+    assert buffer["filled"][:, :, 0].sum(1).tolist() == [1, 2, 3, 4, 5]
+    assert buffer.episode_lengths.tolist() == [1, 2, 3, 4, 5]
+
+
+def test_ring_insert_of_full_buffer_batch():
+    buffer = ReplayBuffer(SCHEME, GROUPS, 4, MAX_T)
+    buffer.insert_episode_batch(make_episodes([0, 1, 2]))
+    buffer.insert_episode_batch(make_episodes([3, 4, 5, 6]))
+    assert stored_ids(buffer) == [4, 5, 6, 3]
+    assert buffer.buffer_index == 3
+
+
+def test_insert_larger_than_buffer():
+    buffer = ReplayBuffer(SCHEME, GROUPS, 2, MAX_T)
+    with pytest.raises(AssertionError):
+        buffer.insert_episode_batch(make_episodes([0, 1, 2]))
+
+
+def fill_in_place(batch, ids, lengths):
+    filled = make_episodes(ids, lengths)
+    for k, v in filled.data.transition_data.items():
+        batch.data.transition_data[k].copy_(v)
+
+
+def test_reserved_batch_is_inserted_without_copy():
+    buffer = ReplayBuffer(SCHEME, GROUPS, 5, MAX_T)
+    buffer.insert_episode_batch(make_episodes([0, 1, 2]))
+    # two slots do not fit before the end of the buffer, so the batch starts at slot 0
+    batch = buffer.reserve_episode_batch(3)
+    assert batch["obs"].data_ptr() == buffer["obs"].data_ptr()
+    # the previous episodes of the slots are cleared
+    assert batch["filled"].sum() == 0
+
+    fill_in_place(batch, [3, 4, 5], [2, 6, 4])
+    buffer.insert_episode_batch(batch)
+    assert stored_ids(buffer)[:3] == [3, 4, 5]
+    assert buffer["filled"][:3, :, 0].sum(1).tolist() == [2, 6, 4]
+    assert (buffer.buffer_index, buffer.episodes_in_buffer) == (3, 3)
+    assert buffer.reserved is None
+
+
+def test_released_batch_is_cleared_and_reserved_again():
+    buffer = ReplayBuffer(SCHEME, GROUPS, 4, MAX_T)
+    buffer.insert_episode_batch(make_episodes([0, 1, 2, 3]))
+    batch = buffer.reserve_episode_batch(2)
+    fill_in_place(batch, [4, 5], [3, 3])
+    buffer.release_episode_batch()
+    assert buffer.reserved is None
+    assert buffer["filled"][:2].sum() == 0
+    assert buffer.episode_lengths[:2].tolist() == [0, 0]
+    assert buffer.buffer_index == 0
+
+    # a new reservation starts at the same slots
+    batch = buffer.reserve_episode_batch(2)
+    fill_in_place(batch, [6, 7], [3, 3])
+    buffer.insert_episode_batch(batch)
+    assert stored_ids(buffer) == [6, 7, 2, 3]
+    # releasing without a reservation is a no-op
+    buffer.release_episode_batch()
+
+
+def test_released_slots_are_not_sampled_until_written():
+    buffer = ReplayBuffer(SCHEME, GROUPS, 4, MAX_T)
+    buffer.insert_episode_batch(make_episodes([0, 1, 2, 3]))
+    buffer.reserve_episode_batch(2)
+    buffer.release_episode_batch()
+    assert not buffer.can_sample(3)
+    assert sorted(buffer.sample_ids(2).tolist()) == [2, 3]
+
+    # writing the first released slot makes it available again
+    buffer.insert_episode_batch(make_episodes([4]))
+    assert buffer.can_sample(3)
+    assert 1 not in buffer.sample_ids(3).tolist()
+
+
+def test_sample_of_whole_buffer_copies_the_episodes():
+    buffer = ReplayBuffer(SCHEME, GROUPS, 3, MAX_T)
+    buffer.insert_episode_batch(make_episodes([0, 1, 2], lengths=[2, 4, 3]))
+    batch = buffer.sample(3)
+    # truncated to the longest episode
+    assert batch.max_seq_length == 4
+    batch["obs"].zero_()
+    assert stored_ids(buffer) == [0, 1, 2]
+    # 3 of the 12 timesteps are padding
+    assert buffer.sample_stats() == {"sample_padding_ratio": 0.25}
+
+
+def test_length_buckets_hold_similar_lengths():
+    np.random.seed(0)
+    lengths = [1, 6, 2, 5, 3, 4, 2, 1]
+    buffer = ReplayBuffer(SCHEME, GROUPS, 8, MAX_T)
+    buffer.insert_episode_batch(make_episodes(list(range(8)), lengths))
+    buffer.sample_by_length = True
+    for _ in range(20):
+        ep_ids = buffer.sample_ids(2)
+        # neighbours in the length order
+        assert abs(lengths[ep_ids[0]] - lengths[ep_ids[1]]) <= 1
+    stats = buffer.sample_stats()
+    assert 0.0 <= stats["sample_padding_ratio"] < 0.5
+    assert buffer.sample_stats() == {}
+
+
+def test_length_weights_correct_to_uniform_sampling():
+    np.random.seed(0)
+    n, batch_size = 6, 2
+    buffer = ReplayBuffer(SCHEME, GROUPS, n, MAX_T)
+    buffer.insert_episode_batch(make_episodes(list(range(n)), [1, 2, 3, 4, 5, 6]))
+    buffer.sample_by_length = buffer.length_weights = True
+    # the expected weight of every episode is its uniform sampling probability
+    totals = np.zeros(n)
+    n_samples = 20000
+    for _ in range(n_samples):
+        ep_ids, weights = buffer.sample_ids(batch_size, return_weights=True)
+        np.add.at(totals, ep_ids, weights)
+    assert np.allclose(totals / n_samples, batch_size / n, atol=0.02)
+
+    batch = buffer.sample(batch_size)
+    assert batch["sample_weight"].shape == (batch_size, 1)
+
+
+def test_prioritized_sampling_and_updates():
+    np.random.seed(0)
+    buffer = ReplayBuffer(SCHEME, GROUPS, 4, MAX_T)
+    buffer.prioritize(alpha=1.0, beta=1.0, eps=0.0)
+    buffer.insert_episode_batch(make_episodes([0, 1, 2, 3]))
+    # new episodes get the largest priority so far
+    assert buffer.priorities.get(np.arange(4)).tolist() == [1.0] * 4
+
+    buffer.update_priorities([0, 1, 2, 3], [3.0, 0.0, 1.0, 0.0], buffer.slot_versions[:4])
+    counts = np.zeros(4)
+    for _ in range(200):
+        batch = buffer.sample(2)
+        ep_ids = batch["sample_id"].view(-1).numpy()
+        # the episodes are gathered from the sampled slots
+        assert th.equal(batch["obs"][:, 0, 0, 0].long(), batch["sample_id"].view(-1))
+        np.add.at(counts, ep_ids, 1)
+    assert counts[1] == counts[3] == 0
+    assert counts[0] > counts[2] > 0
+    # importance weights (n P)^-beta normalised by their max
+    batch = buffer.sample(2)
+    probs = buffer.priorities.get(batch["sample_id"].view(-1).numpy()) / buffer.priorities.total
+    weights = 1 / (4 * probs)
+    assert np.allclose(batch["sample_weight"].view(-1).numpy(), weights / weights.max())
+
+
+def test_priority_updates_skip_overwritten_slots():
+    buffer = ReplayBuffer(SCHEME, GROUPS, 3, MAX_T)
+    buffer.prioritize(alpha=1.0, beta=1.0, eps=0.0)
+    buffer.insert_episode_batch(make_episodes([0, 1, 2]))
+    batch = buffer.sample(3)
+    ep_ids = batch["sample_id"].view(-1).numpy()
+    versions = batch["sample_version"].view(-1).numpy()
+    assert ep_ids.tolist() == [0, 1, 2]
+
+    # slot 0 is written again while the batch is trained on, its new episode keeps
+    # the priority it was inserted with
+    buffer.insert_episode_batch(make_episodes([3]))
+    buffer.update_priorities(ep_ids, [2.0, 2.0, 2.0], versions)
+    assert buffer.priorities.get([0, 1, 2]).tolist() == [1.0, 2.0, 2.0]
+
+
+def make_window_buffer(lengths, window, burn_in):
+    # episodes with stored hidden states, sampled as windows
+    scheme = {
+        **SCHEME,
+        "avail_actions": {"vshape": (3,), "group": "agents", "dtype": th.int},
+        "hidden_states": {"vshape": 4, "group": "agents"},
+    }
+    episodes = make_episodes(range(len(lengths)), lengths, scheme=scheme)
+    n = len(lengths)
+    episodes.update(
+        {
+            "avail_actions": th.ones(n, MAX_T, N_AGENTS, 3, dtype=th.int),
+            "hidden_states": th.randn(n, MAX_T, N_AGENTS, 4),
+        },
+        mark_filled=False,
+    )
+    buffer = ReplayBuffer(scheme, GROUPS, n, MAX_T)
+    buffer.window, buffer.burn_in = window, burn_in
+    buffer.insert_episode_batch(episodes)
+    return buffer, episodes
+
+
+def test_window_batch_burn_in():
+    np.random.seed(0)
+    lengths = [6, 6, 5, 4, 3, 6, 2, 6]
+    buffer, episodes = make_window_buffer(lengths, window=2, burn_in=2)
+    starts = set()
+    for _ in range(20):
+        batch = buffer.sample(len(lengths))
+        # burn_in + window + 1 timesteps
+        assert batch.max_seq_length == 5
+        for b, length in enumerate(lengths):
+            start = int(batch["obs"][b, 0, 0, 1])
+            starts.add(start)
+            assert 0 <= start <= max(length - 5, 0)
+            n_steps = min(length - start, 5)
+            # consecutive timesteps of the episode, the first burn_in ones unfilled
+            # when the window does not start the episode
+            assert th.equal(batch["obs"][b, :n_steps, 0, 1], th.arange(start, start + n_steps).float())
+            assert th.equal(batch["hidden_states"][b, :n_steps], episodes["hidden_states"][b, start : start + n_steps])
+            filled = [start + t < length and (start == 0 or t >= 2) for t in range(5)]
+            assert batch["filled"][b, :, 0].tolist() == [int(f) for f in filled]
+    assert starts == {0, 1}
+
+
+def test_window_unrolled_from_stored_hidden_states():
+    np.random.seed(0)
+    th.manual_seed(0)
+    lengths = [6, 6, 4]
+    buffer, _ = make_window_buffer(lengths, window=2, burn_in=2)
+    args = SN(
+        n_agents=N_AGENTS, n_actions=3, hidden_dim=4, use_rnn=True, agent="rnn",
+        agent_output_type="q", action_selector="epsilon_greedy", epsilon_start=0.0,
+        epsilon_finish=0.0, epsilon_anneal_time=1, obs_last_action=False, obs_agent_id=True,
+    )
+    mac = BasicMAC(buffer.scheme, GROUPS, args)
+    batch = buffer.sample(3)
+
+    mac.init_hidden(3)
+    out = mac.forward_sequence(batch, stored_hidden_states=True)
+    # the rollout of forward() from the hidden states stored at the window starts
+    mac.hidden_states = batch["hidden_states"][:, 0]
+    expected = th.stack([mac.forward(batch, t) for t in range(batch.max_seq_length)], dim=1)
+    for b, length in enumerate(batch.seq_lengths().tolist()):
+        assert th.allclose(out[b, :length], expected[b, :length], atol=1e-5)
+
+
+def test_fields_are_views_of_grouped_storage():
+    scheme = {**SCHEME, "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+              "state": {"vshape": (2,), "episode_const": True}}
+    buffer = ReplayBuffer(scheme, GROUPS, 4, MAX_T)
+    # float (obs, reward) and long (actions, filled) transition fields, float episode fields
+    assert len(buffer.storage_groups) == 3
+    for episode_const, storage, layout in buffer.storage_groups:
+        data = buffer.data.episode_data if episode_const else buffer.data.transition_data
+        for field_key, _, _ in layout:
+            assert data[field_key].untyped_storage().data_ptr() == storage.untyped_storage().data_ptr()
+
+
+def test_gather_matches_indexing():
+    buffer = ReplayBuffer(SCHEME, GROUPS, 5, MAX_T)
+    buffer.insert_episode_batch(make_episodes([0, 1, 2, 3, 4], lengths=[2, 5, 3, 1, 4]))
+    ep_ids = np.array([3, 0, 2])
+    expected = buffer[ep_ids]
+    out = buffer.alloc_gather_out(4)
+
+    for batch in [buffer.gather(ep_ids), buffer.gather(ep_ids, out=out)]:
+        # truncated to the longest gathered episode
+        assert batch.max_seq_length == 3
+        for k in ["obs", "reward", "filled"]:
+            assert th.equal(batch[k], expected[k][:, :3])
+    # gathered into the preallocated buffers
+    ptrs = {v.data_ptr() for v in out.values()}
+    assert batch["obs"].untyped_storage().data_ptr() in ptrs
@@ -0,0 +1,38 @@
+import numpy as np
+
+from components.episode_samplers import length_bucket_sample, prioritized_sample, uniform_sample
+from components.sum_tree import SumTree
+
+
+def test_uniform_sample_distinct_episodes_of_the_pool():
+    np.random.seed(0)
+    pool = np.array([1, 3, 4, 6, 7])
+    ep_ids, weights = uniform_sample(pool, 5)
+    assert sorted(ep_ids.tolist()) == pool.tolist()
+    assert weights is None
+
+
+def test_length_bucket_weights_correct_to_uniform():
+    np.random.seed(0)
+    pool = np.arange(10, 20)
+    lengths = np.random.randint(1, 30, size=10)
+    counts, weighted = np.zeros(10), np.zeros(10)
+    for _ in range(5000):
+        ep_ids, weights = length_bucket_sample(pool, lengths, 4, weighted=True)
+        # consecutive episodes by length
+        assert np.all(np.diff(lengths[ep_ids - 10]) >= 0)
+        np.add.at(counts, ep_ids - 10, 1)
+        np.add.at(weighted, ep_ids - 10, weights)
+    # the extreme lengths are sampled less often, the weighted counts are uniform
+    assert counts[np.argmin(lengths)] < counts.mean()
+    assert np.allclose(weighted / weighted.sum(), 0.1, atol=0.01)
+
+
+def test_prioritized_sample_weights():
+    np.random.seed(0)
+    tree = SumTree(4)
+    tree.update(np.arange(4), [1.0, 0.0, 1.0, 2.0])
+    ep_ids, weights = prioritized_sample(tree, 8, 3, 1.0)
+    assert 1 not in ep_ids
+    # (n P)^-1 normalised by the weight of the least likely episodes
+    assert np.allclose(weights, np.where(ep_ids == 3, 0.5, 1.0))
@@ -0,0 +1,98 @@
+import pytest
+import torch as th
+
+from components.joint_action_reduction import (
+    JointActionOperator,
+    JointActionReduction,
+    cvar_topk,
+)
+
+
+def reduce_in_chunks(q, chunk_size, cvar_k=0):
+    reduction = JointActionReduction(cvar_k=cvar_k)
+    for offset in range(0, q.size(-2), chunk_size):
+        reduction.update(q[..., offset : offset + chunk_size, :], offset)
+    return reduction
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 16, 64])
+def test_chunked_reduction_matches_full(chunk_size):
+    th.manual_seed(0)
+    # [bs, max_t, n_agents, n_joint, n_actions]
+    q = th.randn(2, 3, 2, 16, 4)
+    reduction = reduce_in_chunks(q, chunk_size, cvar_k=2)
+
+    q_max, q_argmax = q.max(dim=-2)
+    assert th.equal(reduction.max, q_max)
+    assert th.equal(reduction.argmax, q_argmax)
+    assert th.allclose(reduction.mean, q.mean(dim=-2), atol=1e-6)
+    assert th.allclose(reduction.cvar, q.topk(2, dim=-1)[0].mean(dim=-1), atol=1e-6)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5])
+def test_chunked_argmax_keeps_first_of_ties(chunk_size):
+    # the max is reached at joint actions 1, 4 and 7 (in different chunks)
+    q = th.zeros(1, 1, 1, 8, 2)
+    q[..., [1, 4, 7], :] = 1.0
+    reduction = reduce_in_chunks(q, chunk_size)
+
+    assert th.equal(reduction.argmax, q.max(dim=-2)[1])
+    assert (reduction.argmax == 1).all()
+
+
+def test_cvar_is_over_the_own_actions():
+    # the own actions (dim -1) of joint action e are [e, e + 1, e + 2, e + 3]: the CVaR
+    # of each joint action only depends on its own row
+    q = th.arange(10.0).unsqueeze(-1) + th.arange(4.0)
+    reduction = reduce_in_chunks(q, 3, cvar_k=2)
+    assert th.equal(reduction.cvar, th.arange(10.0) + 2.5)
+
+
+def test_reduction_without_cvar_has_no_cvar():
+    reduction = reduce_in_chunks(th.zeros(2, 4, 3), 2)
+    with pytest.raises(ValueError):
+        reduction.cvar
+
+
+def test_max_only_reduction_has_no_mean():
+    reduction = JointActionReduction.from_max(th.zeros(2, 3))
+    with pytest.raises(ValueError):
+        reduction.mean
+
+
+@pytest.mark.parametrize("name", JointActionOperator.OPERATORS)
+def test_operators_from_chunked_reduction(name):
+    th.manual_seed(0)
+    q = th.randn(2, 3, 2, 16, 4)
+    operator = JointActionOperator(name, n_actions=4, cvar_alpha=0.5)
+    value = operator(reduce_in_chunks(q, 5, cvar_k=operator.cvar_k), alpha=0.3)
+
+    expected = {
+        "max": q.max(dim=-2)[0],
+        "mean": q.mean(dim=-2),
+        # mean of the top ceil(0.5 * 4) = 2 own-action values of every joint action
+        "cvar": q.sort(dim=-1, descending=True)[0][..., :2].mean(dim=-1),
+        "blend": 0.3 * q.max(dim=-2)[0] + 0.7 * q.mean(dim=-2),
+    }[name]
+    assert th.allclose(value, expected, atol=1e-6)
+
+
+def test_cvar_of_all_values_is_the_mean():
+    th.manual_seed(0)
+    q = th.randn(3, 8, 2)
+    operator = JointActionOperator("cvar", n_actions=2, cvar_alpha=1.0)
+    value = operator(reduce_in_chunks(q, 3, cvar_k=operator.cvar_k))
+    assert th.allclose(value, q.mean(dim=-1), atol=1e-6)
+
+
+def test_cvar_topk():
+    assert cvar_topk(16, 0.2) == 4
+    assert cvar_topk(16, 0.01) == 1
+    assert cvar_topk(16, 1.0) == 16
+    with pytest.raises(ValueError):
+        cvar_topk(16, 0.0)
+
+
+def test_unknown_operator():
+    with pytest.raises(AssertionError):
+        JointActionOperator("min", n_actions=4)
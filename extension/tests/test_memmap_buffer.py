@@ -0,0 +1,60 @@
+import pytest
+import torch as th
+
+from components.memmap_buffer import MemmapReplayBuffer
+from test_episode_buffer import GROUPS, MAX_T, SCHEME, make_episodes, stored_ids
+
+
+def test_memmap_buffer_stores_episodes_in_files(tmp_path):
+    buffer = MemmapReplayBuffer(SCHEME, GROUPS, 4, MAX_T, str(tmp_path))
+    buffer.insert_episode_batch(make_episodes([0, 1, 2], lengths=[2, 6, 4]))
+    assert (tmp_path / "obs.dat").is_file()
+    assert (tmp_path / "meta.json").is_file()
+    assert stored_ids(buffer)[:3] == [0, 1, 2]
+    # sampled batches are in memory, not views of the files
+    batch = buffer.sample(2)
+    assert not any(batch["obs"].data_ptr() == v.data_ptr() for v in buffer.data.transition_data.values())
+
+
+def test_memmap_buffer_is_reopened(tmp_path):
+    buffer = MemmapReplayBuffer(SCHEME, GROUPS, 4, MAX_T, str(tmp_path))
+    buffer.insert_episode_batch(make_episodes([1, 2, 3, 4], lengths=[6, 4, 3, 5]))
+    buffer.insert_episode_batch(make_episodes([5, 6]))
+    buffer.flush()
+    expected = {k: v.clone() for k, v in buffer.data.transition_data.items()}
+    del buffer
+
+    reopened = MemmapReplayBuffer(SCHEME, GROUPS, 4, MAX_T, str(tmp_path))
+    assert (reopened.buffer_index, reopened.episodes_in_buffer) == (2, 4)
+    assert stored_ids(reopened) == [5, 6, 3, 4]
+    for k, v in expected.items():
+        assert th.equal(reopened.data.transition_data[k], v)
+
+
+def test_inserted_episodes_are_flushed_before_the_meta(tmp_path, monkeypatch):
+    buffer = MemmapReplayBuffer(SCHEME, GROUPS, 4, MAX_T, str(tmp_path))
+    events = []
+    for k, m in buffer.memmaps.items():
+        monkeypatch.setattr(m, "flush", lambda k=k: events.append(k))
+    write_meta = buffer._write_meta
+    monkeypatch.setattr(buffer, "_write_meta", lambda: (events.append("meta"), write_meta()))
+    buffer.insert_episode_batch(make_episodes([1, 2, 3], lengths=[6, 4, 3]))
+    assert sorted(events[:-1]) == sorted(buffer.memmaps) and events[-1] == "meta"
+
+    # reopened without an explicit flush
+    expected = {k: v.clone() for k, v in buffer.data.transition_data.items()}
+    del buffer
+    reopened = MemmapReplayBuffer(SCHEME, GROUPS, 4, MAX_T, str(tmp_path))
+    assert (reopened.buffer_index, reopened.episodes_in_buffer) == (3, 3)
+    assert stored_ids(reopened)[:3] == [1, 2, 3]
+    for k, v in expected.items():
+        assert th.equal(reopened.data.transition_data[k], v)
+
+
+def test_memmap_buffer_rejects_other_sizes(tmp_path):
+    MemmapReplayBuffer(SCHEME, GROUPS, 4, MAX_T, str(tmp_path)).flush()
+    with pytest.raises(ValueError):
+        MemmapReplayBuffer(SCHEME, GROUPS, 5, MAX_T, str(tmp_path))
+    scheme = {**SCHEME, "obs": {"vshape": 4, "group": "agents"}}
+    with pytest.raises(ValueError):
+        MemmapReplayBuffer(scheme, GROUPS, 4, MAX_T, str(tmp_path))
@@ -0,0 +1,135 @@
+from itertools import product
+from types import SimpleNamespace as SN
+
+import pytest
+import torch as th
+
+from components.episode_buffer import EpisodeBatch
+from components.transforms import OneHot
+from modules.critics.pac_ac import PACCritic
+from modules.critics.pac_ac_ns import PACCriticNS, generate_other_actions
+
+
+N_AGENTS = 3
+N_ACTIONS = 4
+STATE_SHAPE = 6
+OBS_SHAPE = 5
+BS = 2
+MAX_T = 4
+
+
+def make_args(**kwargs):
+    args = SN(
+        n_agents=N_AGENTS,
+        n_actions=N_ACTIONS,
+        hidden_dim=16,
+        use_cuda=False,
+        obs_individual_obs=True,
+        obs_last_action=True,
+        critic_factorized=False,
+    )
+    args.__dict__.update(kwargs)
+    return args
+
+
+def make_batch():
+    scheme = {
+        "state": {"vshape": STATE_SHAPE},
+        "obs": {"vshape": OBS_SHAPE, "group": "agents"},
+        "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+        "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int},
+    }
+    groups = {"agents": N_AGENTS}
+    preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+    batch = EpisodeBatch(scheme, groups, BS, MAX_T, preprocess=preprocess)
+    batch.update(
+        {
+            "state": th.randn(BS, MAX_T, STATE_SHAPE),
+            "obs": th.randn(BS, MAX_T, N_AGENTS, OBS_SHAPE),
+            "actions": th.randint(N_ACTIONS, (BS, MAX_T, N_AGENTS, 1)),
+            "avail_actions": th.ones(BS, MAX_T, N_AGENTS, N_ACTIONS, dtype=th.int),
+        }
+    )
+    return batch
+
+
+def make_critic(critic_cls, **kwargs):
+    th.manual_seed(0)
+    batch = make_batch()
+    critic = critic_cls(batch.scheme, make_args(**kwargs))
+    return critic, batch
+
+
+@pytest.mark.parametrize("critic_cls", [PACCritic, PACCriticNS])
+@pytest.mark.parametrize("t", [None, 0, 2])
+def test_factorized_compute_all_matches_concatenated(critic_cls, t):
+    critic, batch = make_critic(critic_cls)
+    with th.no_grad():
+        q, other_actions = critic(batch, t=t, compute_all=True)
+        critic.factorized = True
+        q_fact, other_actions_fact = critic(batch, t=t, compute_all=True)
+        q_all, _ = critic(batch, compute_all=True)
+
+    n_joint = N_ACTIONS ** (N_AGENTS - 1)
+    expected_shape = (BS, 1 if t is not None else MAX_T, N_AGENTS, n_joint, N_ACTIONS)
+    assert q_fact.shape == q.shape == expected_shape
+    assert th.allclose(q_fact, q, atol=1e-5)
+    assert th.equal(other_actions_fact, other_actions)
+    if t is not None:
+        # a single timestep gets the same Q-values as in the whole episode
+        assert th.allclose(q, q_all[:, t : t + 1], atol=1e-5)
+
+
+@pytest.mark.parametrize("n_agents,n_actions", [(2, 3), (3, 4), (4, 2)])
+def test_other_actions_enumerated_in_product_order(n_agents, n_actions):
+    other_actions = generate_other_actions(n_actions, n_agents, "cpu")
+    expected = th.stack(
+        [th.cat(x) for x in product(*[th.eye(n_actions) for _ in range(n_agents - 1)])]
+    )
+    assert th.equal(other_actions, expected)
+
+
+def test_other_actions_shared_between_critics():
+    critic, batch = make_critic(PACCritic)
+    critic_ns, _ = make_critic(PACCriticNS)
+    other_actions = generate_other_actions(N_ACTIONS, N_AGENTS, "cpu")
+
+    all_actions = critic._gen_all_other_actions(batch, BS, MAX_T)
+    all_actions_ns = critic_ns._gen_all_other_actions(batch, BS, MAX_T)
+    # expanded views of the same cached tensor, not copies
+    assert all_actions.data_ptr() == all_actions_ns.data_ptr() == other_actions.data_ptr()
+    assert generate_other_actions(N_ACTIONS, N_AGENTS, "cpu") is other_actions
+    assert th.equal(all_actions[1, 2, 0], other_actions)
+
+
+@pytest.mark.parametrize("critic_cls", [PACCritic, PACCriticNS])
+@pytest.mark.parametrize("factorized", [False, True])
+def test_forward_with_all_matches_separate_passes(critic_cls, factorized):
+    critic, batch = make_critic(critic_cls, critic_factorized=factorized)
+    q, chunks = critic.forward_with_all(batch, chunk_size=5)
+    chunks = list(chunks)
+
+    assert th.allclose(q, critic(batch)[0], atol=1e-5)
+    assert q.requires_grad
+    with th.no_grad():
+        q_all = critic(batch, compute_all=True)[0]
+    assert [offset for _, offset in chunks] == list(range(0, q_all.size(3), 5))
+    assert th.allclose(th.cat([chunk for chunk, _ in chunks], dim=3), q_all, atol=1e-5)
+    assert not any(chunk.requires_grad for chunk, _ in chunks)
+
+
+@pytest.mark.parametrize("critic_cls", [PACCritic, PACCriticNS])
+def test_compute_all_chunks_subsamples_other_actions(critic_cls):
+    critic, batch = make_critic(critic_cls, use_subsampling=True, sample_size=5)
+    th.manual_seed(1)
+    chunks = list(critic.compute_all_chunks(batch, chunk_size=2))
+    th.manual_seed(1)
+    other_actions = critic.sample_other_actions(batch, 5)
+
+    # sample_size joint actions per (batch, time, agent) instead of all of them
+    assert [offset for _, offset in chunks] == [0, 2, 4]
+    q = th.cat([chunk for chunk, _ in chunks], dim=3)
+    assert q.shape == (BS, MAX_T, N_AGENTS, 5, N_ACTIONS)
+    with th.no_grad():
+        expected = critic.forward_other_actions(batch, other_actions)
+    assert th.allclose(q, expected, atol=1e-5)
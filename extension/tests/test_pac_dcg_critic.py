@@ -0,0 +1,61 @@
+from types import SimpleNamespace as SN
+
+import torch as th
+
+from components.episode_buffer import EpisodeBatch
+from modules.critics.pac_dcg_ns import DCGCriticNS
+
+
+N_AGENTS = 3
+N_ACTIONS = 3
+STATE_SHAPE = 5
+BS = 2
+MAX_T = 5
+
+
+def make_critic():
+    th.manual_seed(0)
+    scheme = {
+        "state": {"vshape": STATE_SHAPE},
+        "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+        "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int},
+    }
+    batch = EpisodeBatch(scheme, {"agents": N_AGENTS}, BS, MAX_T)
+    batch.update(
+        {
+            "state": th.randn(BS, MAX_T, STATE_SHAPE),
+            "actions": th.randint(N_ACTIONS, (BS, MAX_T, N_AGENTS, 1)),
+            "avail_actions": th.ones(BS, MAX_T, N_AGENTS, N_ACTIONS, dtype=th.int),
+        }
+    )
+    args = SN(
+        n_agents=N_AGENTS,
+        n_actions=N_ACTIONS,
+        hidden_dim=8,
+        agent_output_type="q",
+        cg_edges="full",
+        cg_utilities_hidden_dim=None,
+        cg_payoffs_hidden_dim=None,
+        cg_payoff_rank=None,
+        msg_iterations=4,
+        msg_normalized=True,
+        msg_anytime=True,
+    )
+    return DCGCriticNS(batch.scheme, args), batch
+
+
+def test_hidden_state_sequence_matches_stepped_agents():
+    critic, batch = make_critic()
+    actions = batch["actions"]
+
+    critic.init_hidden(BS)
+    stepped = [critic.forward(batch, t=t, actions=actions[:, t], policy_mode=False) for t in range(MAX_T)]
+
+    critic.init_hidden_sequence(batch, compute_grads=True)
+    # the timesteps can be evaluated in any order and more than once
+    for t in reversed(range(MAX_T)):
+        values = critic.forward(batch, t=t, actions=actions[:, t], policy_mode=False, compute_grads=True)
+        assert th.allclose(values, stepped[t], atol=1e-5)
+    assert values.requires_grad
+    greedy = critic.forward(batch, t=0, policy_mode=False)
+    assert greedy.shape == (BS, N_AGENTS, 1)
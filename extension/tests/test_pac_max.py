@@ -0,0 +1,105 @@
+from itertools import product
+from types import SimpleNamespace as SN
+
+import pytest
+import torch as th
+
+from components.episode_buffer import EpisodeBatch
+from components.transforms import OneHot
+from learners.actor_critic_pac_learner import PACActorCriticLearner
+
+
+N_ACTIONS = 3
+STATE_SHAPE = 4
+OBS_SHAPE = 3
+BS = 2
+MAX_T = 4
+
+
+def make_learner(n_agents, max_mode):
+    th.manual_seed(0)
+    scheme = {
+        "state": {"vshape": STATE_SHAPE},
+        "obs": {"vshape": OBS_SHAPE, "group": "agents"},
+        "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+        "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int},
+    }
+    groups = {"agents": n_agents}
+    preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+    batch = EpisodeBatch(scheme, groups, BS, MAX_T, preprocess=preprocess)
+    # every agent has at least its first action available
+    avail_actions = th.randint(2, (BS, MAX_T, n_agents, N_ACTIONS), dtype=th.int)
+    avail_actions[..., 0] = 1
+    actions = th.randint(N_ACTIONS, (BS, MAX_T, n_agents, 1))
+    actions = actions * avail_actions.gather(-1, actions)
+    batch.update(
+        {
+            "state": th.randn(BS, MAX_T, STATE_SHAPE),
+            "obs": th.randn(BS, MAX_T, n_agents, OBS_SHAPE),
+            "actions": actions,
+            "avail_actions": avail_actions,
+        }
+    )
+
+    args = SN(
+        n_agents=n_agents,
+        n_actions=N_ACTIONS,
+        hidden_dim=8,
+        lr=0.0005,
+        use_cuda=False,
+        critic_type="pac_critic",
+        state_value_type="cv_critic",
+        obs_individual_obs=True,
+        obs_last_action=True,
+        learner_log_interval=1,
+        pac_max_mode=max_mode,
+        pac_max_sweeps=2,
+        pac_max_samples=4,
+    )
+    mac = SN(parameters=lambda: [th.nn.Parameter(th.zeros(1))])
+    learner = PACActorCriticLearner(mac, batch.scheme, None, args)
+    return learner, batch
+
+
+def available_max(critic, batch, n_agents):
+    # Max of compute_all over the joint actions whose actions are all available to the
+    # other agents, enumerated one joint action at a time
+    with th.no_grad():
+        q = critic(batch, compute_all=True)[0][:, :-1]
+    avail_actions = batch["avail_actions"][:, :-1]
+    q_max = th.full(q.shape[:3] + q.shape[4:], -float("inf"))
+    for i in range(n_agents):
+        others = [j for j in range(n_agents) if j != i]
+        for e, joint in enumerate(product(range(N_ACTIONS), repeat=n_agents - 1)):
+            avail = th.ones(BS, MAX_T - 1, dtype=th.bool)
+            for j, a in zip(others, joint):
+                avail &= avail_actions[:, :, j, a] > 0
+            q_e = q[:, :, i, e].masked_fill(~avail.unsqueeze(-1), -float("inf"))
+            q_max[:, :, i] = th.max(q_max[:, :, i], q_e)
+    return q_max
+
+
+def test_coordinate_ascent_is_exact_for_two_agents():
+    # with a single other agent one sweep is its best available response
+    learner, batch = make_learner(2, "coordinate")
+    q_max = learner.reduce_joint_actions(learner.critic, batch).max
+    assert th.allclose(q_max, available_max(learner.critic, batch, 2), atol=1e-6)
+
+
+@pytest.mark.parametrize("max_mode", ["sample", "coordinate"])
+def test_approx_max_is_below_the_available_max(max_mode):
+    learner, batch = make_learner(3, max_mode)
+    q_max = learner.reduce_joint_actions(learner.critic, batch).max
+    assert (q_max <= available_max(learner.critic, batch, 3) + 1e-6).all()
+
+
+def test_max_gap_against_the_available_max():
+    learner, batch = make_learner(3, "coordinate")
+    q_max = available_max(learner.critic, batch, 3)
+    learner._track_max_gap(learner.critic, batch, q_max)
+    assert learner.max_gap_stats["approx_max_gap_mean"] == [0.0]
+    assert learner.max_gap_stats["approx_max_gap_max"] == [0.0]
+
+    learner._track_max_gap(learner.critic, batch, q_max - 1.0)
+    assert learner.max_gap_stats["approx_max_gap_mean"][1] == pytest.approx(1.0)
+    assert learner.max_gap_stats["approx_max_gap_max"][1] == pytest.approx(1.0)
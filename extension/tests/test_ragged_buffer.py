@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import torch as th
+
+from components.batch_prefetcher import BatchPrefetcher
+from components.episode_buffer import ReplayBuffer
+from components.ragged_buffer import RaggedReplayBuffer
+from test_episode_buffer import GROUPS, MAX_T, SCHEME, make_episodes
+
+
+def test_ragged_buffer_stores_only_filled_timesteps():
+    buffer = RaggedReplayBuffer(SCHEME, GROUPS, 4, MAX_T, 12)
+    assert buffer.data.transition_data["obs"].shape[0] == 12
+    buffer.insert_episode_batch(make_episodes([0, 1, 2], lengths=[2, 5, 3]))
+    assert buffer.starts[:3].tolist() == [0, 2, 7]
+    assert buffer.episode_lengths[:3].tolist() == [2, 5, 3]
+    assert buffer.write_pos == 10
+
+
+def test_ragged_sample_matches_the_dense_buffer():
+    lengths = [2, 5, 3, 4]
+    ragged = RaggedReplayBuffer(SCHEME, GROUPS, 4, MAX_T, 16)
+    dense = ReplayBuffer(SCHEME, GROUPS, 4, MAX_T)
+    for buffer in [ragged, dense]:
+        buffer.insert_episode_batch(make_episodes([0, 1, 2, 3], lengths))
+
+    np.random.seed(0)
+    batch = ragged.sample(2)
+    np.random.seed(0)
+    ep_ids = dense.sample_ids(2)
+    expected = dense[ep_ids]
+    expected = expected[:, : expected.max_t_filled()]
+    assert batch.max_seq_length == max(lengths[i] for i in ep_ids)
+    for k in ["obs", "reward", "filled"]:
+        assert th.equal(batch[k], expected[k])
+
+
+def test_overwritten_episodes_are_dropped():
+    buffer = RaggedReplayBuffer(SCHEME, GROUPS, 8, MAX_T, 10)
+    buffer.insert_episode_batch(make_episodes([0, 1, 2], lengths=[3, 3, 2]))
+    # 4 timesteps do not fit after timestep 8, they overwrite episodes 0 and 1
+    buffer.insert_episode_batch(make_episodes([3], lengths=[4]))
+    assert buffer.valid[:4].tolist() == [False, False, True, True]
+    assert not buffer.can_sample(3)
+    assert sorted(buffer.sample(2)["obs"][:, 0, 0, 0].long().tolist()) == [2, 3]
+
+
+def test_indexing_is_bounded_by_the_stored_episodes():
+    buffer = RaggedReplayBuffer(SCHEME, GROUPS, 8, MAX_T, 10)
+    buffer.insert_episode_batch(make_episodes([0, 1, 2], lengths=[3, 3, 2]))
+    assert buffer[:]["obs"][:, 0, 0, 0].long().tolist() == [0, 1, 2]
+    assert buffer[-1]["obs"][0, 0, 0, 0] == 2
+    # slots that were never written
+    with pytest.raises(IndexError):
+        buffer[3]
+    with pytest.raises(IndexError):
+        buffer[[1, 5]]
+    # episodes 0 and 1 are dropped by episode 3
+    buffer.insert_episode_batch(make_episodes([3], lengths=[4]))
+    assert buffer[2:]["obs"][:, 0, 0, 0].long().tolist() == [2, 3]
+    with pytest.raises(IndexError):
+        buffer[:]
+
+
+def test_prefetcher_samples_the_ragged_buffer():
+    buffer = RaggedReplayBuffer(SCHEME, GROUPS, 4, MAX_T, 16)
+    buffer.insert_episode_batch(make_episodes([0, 1, 2, 3], [2, 5, 3, 4]))
+    prefetcher = BatchPrefetcher(buffer, 2, "cpu")
+    try:
+        prefetcher.request()
+        batch = prefetcher.get()
+        assert batch.batch_size == 2
+        assert batch.max_seq_length == int(batch["filled"].sum(1).max())
+    finally:
+        prefetcher.close()
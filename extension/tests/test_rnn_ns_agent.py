@@ -0,0 +1,127 @@
+from types import SimpleNamespace as SN
+
+import pytest
+import torch as th
+
+from components.episode_buffer import EpisodeBatch
+from controllers.non_shared_controller import NonSharedMAC
+from modules.agents.rnn_agent import RNNAgent
+from modules.agents.rnn_ns_agent import RNNNSAgent
+
+
+N_AGENTS = 3
+INPUT_SHAPE = 5
+HIDDEN_DIM = 8
+BS = 2
+
+
+def make_agents(use_rnn):
+    # RNNNSAgent loaded from a checkpoint with one RNNAgent per agent
+    th.manual_seed(0)
+    args = SN(n_agents=N_AGENTS, hidden_dim=HIDDEN_DIM, n_actions=4, use_rnn=use_rnn)
+    agents = [RNNAgent(INPUT_SHAPE, args) for _ in range(N_AGENTS)]
+    state_dict = {
+        "agents.{}.{}".format(i, k): v for i, agent in enumerate(agents) for k, v in agent.state_dict().items()
+    }
+    ns_agent = RNNNSAgent(INPUT_SHAPE, args)
+    ns_agent.load_state_dict(state_dict)
+    return agents, ns_agent
+
+
+def per_agent_forward(agents, inputs, hidden_state):
+    # inputs: [BS, N_AGENTS, INPUT_SHAPE], hidden_state: [BS, N_AGENTS, HIDDEN_DIM]
+    outs = [agent(inputs[:, i], hidden_state[:, i]) for i, agent in enumerate(agents)]
+    return th.stack([q for q, _ in outs], dim=1), th.stack([h for _, h in outs], dim=1)
+
+
+@pytest.mark.parametrize("use_rnn", [True, False])
+def test_forward_matches_per_agent_grucells(use_rnn):
+    agents, ns_agent = make_agents(use_rnn)
+    inputs = th.randn(BS, N_AGENTS, INPUT_SHAPE)
+    h0 = th.randn(BS, N_AGENTS, HIDDEN_DIM)
+
+    q, h = ns_agent(inputs.reshape(-1, INPUT_SHAPE), h0)
+    expected_q, expected_h = per_agent_forward(agents, inputs, h0)
+    assert th.allclose(q.view(BS, N_AGENTS, -1), expected_q, atol=1e-5)
+    assert th.allclose(h, expected_h, atol=1e-5)
+
+
+@pytest.mark.parametrize("use_rnn", [True, False])
+def test_forward_sequence_matches_per_agent_rollout(use_rnn):
+    agents, ns_agent = make_agents(use_rnn)
+    max_t = 4
+    inputs = th.randn(BS, max_t, N_AGENTS, INPUT_SHAPE)
+    h = th.randn(BS, N_AGENTS, HIDDEN_DIM)
+
+    q, h_last = ns_agent.forward_sequence(inputs, h)
+    expected_q = []
+    for t in range(max_t):
+        q_t, h = per_agent_forward(agents, inputs[:, t], h)
+        expected_q.append(q_t)
+    assert th.allclose(q, th.stack(expected_q, dim=1), atol=1e-5)
+    assert th.allclose(h_last, h, atol=1e-5)
+
+
+def test_forward_sequence_masks_padded_timesteps():
+    agents, ns_agent = make_agents(True)
+    max_t = 5
+    inputs = th.randn(BS, max_t, N_AGENTS, INPUT_SHAPE)
+    h0 = th.randn(BS, N_AGENTS, HIDDEN_DIM)
+    lengths = th.tensor([2, 4])
+
+    q, h_last = ns_agent.forward_sequence(inputs, h0, lengths)
+    h = h0
+    for t in range(max_t):
+        q_t, h = per_agent_forward(agents, inputs[:, t], h)
+        for b, length in enumerate(lengths.tolist()):
+            if t < length:
+                assert th.allclose(q[b, t], q_t[b], atol=1e-5)
+            else:
+                # padded timesteps have zero hidden states, as for RNNAgent
+                assert th.allclose(q[b, t], ns_agent.fc2.bias, atol=1e-6)
+            if t == length - 1:
+                assert th.allclose(h_last[b], h[b], atol=1e-5)
+
+
+@pytest.mark.parametrize("use_rnn", [True, False])
+def test_non_shared_mac_rollout_matches_per_agent_grucells(use_rnn):
+    agents, ns_agent = make_agents(use_rnn)
+    bs, max_t = 3, 4
+    scheme = {
+        "obs": {"vshape": INPUT_SHAPE - N_AGENTS, "group": "agents"},
+        "avail_actions": {"vshape": (4,), "group": "agents", "dtype": th.int},
+    }
+    batch = EpisodeBatch(scheme, {"agents": N_AGENTS}, bs, max_t)
+    batch.update(
+        {
+            "obs": th.randn(bs, max_t, N_AGENTS, INPUT_SHAPE - N_AGENTS),
+            "avail_actions": th.ones(bs, max_t, N_AGENTS, 4, dtype=th.int),
+        }
+    )
+    args = SN(
+        n_agents=N_AGENTS, n_actions=4, hidden_dim=HIDDEN_DIM, use_rnn=use_rnn, agent="rnn_ns",
+        agent_output_type="q", action_selector="epsilon_greedy", epsilon_start=0.0,
+        epsilon_finish=0.0, epsilon_anneal_time=1, evaluation_epsilon=0.0,
+        obs_last_action=False, obs_agent_id=True,
+    )
+    mac = NonSharedMAC(batch.scheme, {"agents": N_AGENTS}, args)
+    mac.agent.load_state_dict(ns_agent.state_dict())
+
+    mac.init_hidden(bs)
+    h = mac.hidden_states
+    for t in range(max_t):
+        q = mac.forward(batch, t)
+        inputs = mac._build_inputs(batch, t).view(bs, N_AGENTS, -1)
+        expected_q, h = per_agent_forward(agents, inputs, h)
+        assert th.allclose(q, expected_q, atol=1e-5)
+    actions = mac.select_actions(batch, 0, 0, test_mode=True)
+    assert actions.shape == (bs, N_AGENTS)
+
+
+def test_state_dict_round_trip():
+    _, ns_agent = make_agents(True)
+    args = SN(n_agents=N_AGENTS, hidden_dim=HIDDEN_DIM, n_actions=4, use_rnn=True)
+    other = RNNNSAgent(INPUT_SHAPE, args)
+    other.load_state_dict(ns_agent.state_dict())
+    for k, v in ns_agent.state_dict().items():
+        assert th.equal(other.state_dict()[k], v)
@@ -0,0 +1,105 @@
+import copy
+from types import SimpleNamespace as SN
+
+import torch as th
+
+from modules.agents.rnn_agent import RNNAgent
+from modules.agents.rnn_feature_agent import RNNFeatureAgent
+
+
+BS = 3
+MAX_T = 7
+N_AGENTS = 2
+INPUT_SHAPE = 5
+
+
+def make_agent():
+    th.manual_seed(0)
+    args = SN(hidden_dim=8, n_actions=4, use_rnn=True)
+    return RNNAgent(INPUT_SHAPE, args)
+
+
+def forward_loop(agent, inputs, hidden_state):
+    # the per-timestep rollout of the MACs
+    qs, hs = [], []
+    h = hidden_state
+    for t in range(inputs.size(1)):
+        q, h = agent(inputs[:, t].reshape(-1, INPUT_SHAPE), h)
+        qs.append(q.view(BS, N_AGENTS, -1))
+        hs.append(h.view(BS, N_AGENTS, -1))
+    return th.stack(qs, dim=1), th.stack(hs, dim=1)
+
+
+def test_forward_sequence_matches_forward_loop():
+    agent = make_agent()
+    inputs = th.randn(BS, MAX_T, N_AGENTS, INPUT_SHAPE)
+    h0 = th.randn(BS, N_AGENTS, 8)
+
+    q, h_last = agent.forward_sequence(inputs, h0)
+    expected_q, expected_h = forward_loop(agent, inputs, h0)
+    assert th.allclose(q, expected_q, atol=1e-5)
+    assert th.allclose(h_last, expected_h[:, -1], atol=1e-5)
+
+
+def test_forward_sequence_masks_padded_timesteps():
+    agent = make_agent()
+    inputs = th.randn(BS, MAX_T, N_AGENTS, INPUT_SHAPE)
+    h0 = th.randn(BS, N_AGENTS, 8)
+    lengths = th.tensor([MAX_T, 2, 5])
+
+    q, h_last = agent.forward_sequence(inputs, h0, lengths)
+    expected_q, expected_h = forward_loop(agent, inputs, h0)
+    for b, length in enumerate(lengths.tolist()):
+        # evaluated timesteps as in the rollout, starting from unsorted hidden states
+        assert th.allclose(q[b, :length], expected_q[b, :length], atol=1e-5)
+        assert th.allclose(h_last[b], expected_h[b, length - 1], atol=1e-5)
+        # padded timesteps have zero hidden states
+        assert th.allclose(q[b, length:], agent.fc2.bias.expand_as(q[b, length:]))
+
+
+def test_sequence_gru_shares_the_cell_parameters():
+    agent = make_agent()
+    # checkpoints only hold the cell
+    assert sorted(agent.state_dict()) == sorted(
+        "{}.{}".format(layer, param)
+        for layer in ["fc1", "fc2"]
+        for param in ["weight", "bias"]
+    ) + ["rnn.bias_hh", "rnn.bias_ih", "rnn.weight_hh", "rnn.weight_ih"]
+
+    # loaded parameters and the copies of the target MACs are used by forward_sequence
+    other = make_agent()
+    with th.no_grad():
+        for p in other.parameters():
+            p.add_(th.randn_like(p))
+    agent.load_state_dict(other.state_dict())
+    agent = copy.deepcopy(agent)
+    inputs = th.randn(BS, MAX_T, N_AGENTS, INPUT_SHAPE)
+    h0 = th.randn(BS, N_AGENTS, 8)
+    q, _ = agent.forward_sequence(inputs, h0)
+    expected_q, _ = forward_loop(agent, inputs, h0)
+    assert th.allclose(q, expected_q, atol=1e-5)
+
+    # and the gradients reach the cell
+    q.sum().backward()
+    assert agent.rnn.weight_hh.grad is not None
+    assert agent.rnn.weight_hh.grad.abs().sum() > 0
+
+
+def test_feature_agent_forward_sequence_matches_forward_loop():
+    th.manual_seed(0)
+    agent = RNNFeatureAgent(INPUT_SHAPE, SN(hidden_dim=8))
+    inputs = th.randn(BS, MAX_T, INPUT_SHAPE)
+    h0 = th.randn(BS, 8)
+    lengths = th.tensor([MAX_T, 2, 5])
+
+    h, h_last = agent.forward_sequence(inputs, h0, lengths)
+    h_t = h0
+    for t in range(MAX_T):
+        h_t = agent(inputs[:, t], h_t)[1]
+        for b, length in enumerate(lengths.tolist()):
+            if t < length:
+                assert th.allclose(h[b, t], h_t[b], atol=1e-5)
+            else:
+                assert th.equal(h[b, t], th.zeros(8))
+            if t == length - 1:
+                assert th.allclose(h_last[b], h_t[b], atol=1e-5)
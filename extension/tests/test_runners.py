@@ -0,0 +1,255 @@
+import logging
+from types import SimpleNamespace as SN
+
+import numpy as np
+import pytest
+import torch as th
+
+from components.episode_buffer import ReplayBuffer
+from components.transforms import OneHot
+from controllers.basic_controller import BasicMAC
+from envs import REGISTRY as env_REGISTRY
+from envs.multiagentenv import MultiAgentEnv
+from runners.episode_runner import EpisodeRunner
+from runners.inference_runner import InferenceRunner
+from runners.parallel_runner import ParallelRunner
+from utils.logging import Logger
+
+
+N_AGENTS = 2
+N_ACTIONS = 3
+EPISODE_LIMIT = 5
+BATCH_SIZE = 4
+
+
+class ToyEnv(MultiAgentEnv):
+    # Deterministic env whose episodes last 2 + seed % 4 steps (the last one is cut
+    # at the episode limit), observations hold the seed, the timestep and the last
+    # actions, so that the episodes of an env only depend on its seed and the policy
+    def __init__(self, seed=0, common_reward=True, reward_scalarisation="sum"):
+        self.n_agents = N_AGENTS
+        self.episode_limit = EPISODE_LIMIT
+        self.env_seed = seed
+        self.length = 2 + seed % 4
+        self.t = 0
+        self.last_actions = np.zeros(N_AGENTS, dtype=np.float32)
+
+    def reset(self, seed=None, options=None):
+        self.t = 0
+        self.last_actions[:] = 0
+        return self.get_obs(), {}
+
+    def step(self, actions):
+        actions = np.asarray(actions, dtype=np.int64)
+        self.last_actions = actions.astype(np.float32)
+        self.t += 1
+        reward = float(actions.sum()) + 0.1 * self.env_seed
+        terminated = self.t >= self.length and self.length < self.episode_limit
+        truncated = self.t >= self.episode_limit
+        info = {"episode_limit": True} if truncated and not terminated else {}
+        return self.get_obs(), reward, terminated, truncated, info
+
+    def get_obs(self):
+        return [
+            np.array([self.env_seed, self.t, self.last_actions[i], i], dtype=np.float32)
+            for i in range(N_AGENTS)
+        ]
+
+    def get_obs_size(self):
+        return 4
+
+    def get_state(self):
+        return np.concatenate(self.get_obs())
+
+    def get_state_size(self):
+        return 4 * N_AGENTS
+
+    def get_avail_actions(self):
+        # the last action is only available at even timesteps
+        return [[1, 1, int(self.t % 2 == 0)] for _ in range(N_AGENTS)]
+
+    def get_total_actions(self):
+        return N_ACTIONS
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def toy_env(monkeypatch):
+    monkeypatch.setitem(env_REGISTRY, "toy", ToyEnv)
+
+
+def make_args(**kwargs):
+    args = SN(
+        env="toy",
+        env_args={"seed": 0},
+        batch_size_run=BATCH_SIZE,
+        common_reward=True,
+        reward_scalarisation="sum",
+        device="cpu",
+        n_agents=N_AGENTS,
+        n_actions=N_ACTIONS,
+        test_nepisode=BATCH_SIZE,
+        runner_log_interval=2000,
+        render=False,
+        # greedy agents
+        agent="rnn",
+        hidden_dim=8,
+        use_rnn=True,
+        agent_output_type="q",
+        action_selector="epsilon_greedy",
+        epsilon_start=0.0,
+        epsilon_finish=0.0,
+        epsilon_anneal_time=1,
+        evaluation_epsilon=0.0,
+        obs_last_action=True,
+        obs_agent_id=True,
+    )
+    args.__dict__.update(kwargs)
+    return args
+
+
+def make_setup():
+    # scheme, groups and preprocess as in run.py, a replay buffer and a mac
+    env_info = ToyEnv().get_env_info()
+    scheme = {
+        "state": {"vshape": env_info["state_shape"]},
+        "obs": {"vshape": env_info["obs_shape"], "group": "agents"},
+        "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+        "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int},
+        "terminated": {"vshape": (1,), "dtype": th.uint8},
+        "reward": {"vshape": (1,)},
+    }
+    groups = {"agents": N_AGENTS}
+    preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+    buffer = ReplayBuffer(scheme, groups, 32, EPISODE_LIMIT + 1, preprocess=preprocess)
+    th.manual_seed(0)
+    mac = BasicMAC(buffer.scheme, groups, make_args())
+    return scheme, groups, preprocess, buffer, mac
+
+
+def make_logger():
+    return Logger(logging.getLogger("test_runners"))
+
+
+def reference_episodes(setup, seeds):
+    # {seed: (batch, length)} of the episode of every seed, run alone by an EpisodeRunner
+    scheme, groups, preprocess, _, mac = setup
+    episodes = {}
+    for seed in seeds:
+        runner = EpisodeRunner(make_args(env_args={"seed": seed}, batch_size_run=1), make_logger())
+        runner.setup(scheme, groups, preprocess, mac)
+        with th.no_grad():
+            batch = runner.run(test_mode=False)
+        episodes[seed] = (batch, runner.t)
+        runner.close_env()
+    return episodes
+
+
+def assert_same_episode(batch, b, reference):
+    ref_batch, length = reference
+    assert int(batch["filled"][b].sum()) == length + 1
+    for k in ["state", "obs", "avail_actions"]:
+        assert th.equal(batch[k][b, : length + 1], ref_batch[k][0, : length + 1]), k
+    # no action is selected at the last timestep of the parallel episodes
+    for k in ["actions", "reward", "terminated"]:
+        assert th.equal(batch[k][b, :length], ref_batch[k][0, :length]), k
+
+
+@pytest.mark.parametrize("shared_memory_transport", [False, True])
+@pytest.mark.parametrize("envs_per_worker", [1, 3])
+def test_parallel_runner_matches_episode_runner(shared_memory_transport, envs_per_worker):
+    setup = make_setup()
+    scheme, groups, preprocess, _, mac = setup
+    references = reference_episodes(setup, range(BATCH_SIZE))
+
+    args = make_args(shared_memory_transport=shared_memory_transport, envs_per_worker=envs_per_worker)
+    runner = ParallelRunner(args, make_logger())
+    try:
+        runner.setup(scheme, groups, preprocess, mac)
+        for _ in range(2):
+            with th.no_grad():
+                batch = runner.run(test_mode=False)
+            for b in range(BATCH_SIZE):
+                assert_same_episode(batch, b, references[b])
+        lengths = [length for _, length in references.values()]
+        assert runner.t_env == 2 * sum(lengths)
+    finally:
+        runner.close_env()
+
+
+def test_envs_per_worker_blocks():
+    setup = make_setup()
+    scheme, groups, preprocess, _, mac = setup
+    runner = ParallelRunner(make_args(envs_per_worker=3), make_logger())
+    try:
+        # a worker for envs 0-2 and one for env 3
+        assert runner.env_blocks == [[0, 1, 2], [3]]
+        assert len(runner.ps) == 2
+        runner.setup(scheme, groups, preprocess, mac)
+        with th.no_grad():
+            batch = runner.run(test_mode=False)
+        # every env of both workers ran a whole episode
+        lengths = [2 + seed % 4 for seed in range(BATCH_SIZE)]
+        assert batch["filled"].sum(dim=(1, 2)).tolist() == [min(n, EPISODE_LIMIT) + 1 for n in lengths]
+    finally:
+        runner.close_env()
+
+
+def assert_buffer_matches(buffer, references):
+    # every episode in the buffer is the episode of the seed of its env
+    seeds = set()
+    for slot in range(buffer.episodes_in_buffer):
+        seed = int(buffer["obs"][slot, 0, 0, 0])
+        assert_same_episode(buffer, slot, references[seed])
+        seeds.add(seed)
+    assert seeds == set(references)
+
+
+@pytest.mark.parametrize("shared_memory_transport", [False, True])
+def test_streaming_runner_matches_episode_runner(shared_memory_transport):
+    setup = make_setup()
+    scheme, groups, preprocess, buffer, mac = setup
+    references = reference_episodes(setup, range(BATCH_SIZE))
+
+    args = make_args(runner_streaming=True, shared_memory_transport=shared_memory_transport)
+    runner = ParallelRunner(args, make_logger())
+    try:
+        runner.setup(scheme, groups, preprocess, mac, buffer)
+        n_episodes = 0
+        for i in range(3):
+            with th.no_grad():
+                assert runner.run(test_mode=False) is None
+            assert buffer.episodes_in_buffer >= n_episodes + BATCH_SIZE
+            n_episodes = buffer.episodes_in_buffer
+            if i == 0:
+                # test runs step the envs in lockstep, the stream restarts after them
+                with th.no_grad():
+                    batch = runner.run(test_mode=True)
+                for b in range(BATCH_SIZE):
+                    assert_same_episode(batch, b, references[b])
+        assert_buffer_matches(buffer, references)
+    finally:
+        runner.close_env()
+
+
+@pytest.mark.parametrize("envs_per_worker", [1, 2])
+@pytest.mark.parametrize("inference_batch_size", [0, 1])
+def test_inference_runner_matches_episode_runner(envs_per_worker, inference_batch_size):
+    setup = make_setup()
+    scheme, groups, preprocess, buffer, mac = setup
+    references = reference_episodes(setup, range(BATCH_SIZE))
+
+    args = make_args(envs_per_worker=envs_per_worker, inference_batch_size=inference_batch_size)
+    runner = InferenceRunner(args, make_logger())
+    try:
+        runner.setup(scheme, groups, preprocess, mac, buffer)
+        for _ in range(3):
+            with th.no_grad():
+                assert runner.run(test_mode=False) is None
+        assert runner.batch_sizes and max(runner.batch_sizes) <= BATCH_SIZE
+        assert buffer.episodes_in_buffer >= 3 * BATCH_SIZE
+        assert_buffer_matches(buffer, references)
+    finally:
+        runner.close_env()
@@ -0,0 +1,88 @@
+from types import SimpleNamespace as SN
+
+import pytest
+import torch as th
+
+from components.episode_buffer import EpisodeBatch
+from components.transforms import OneHot
+from controllers.basic_controller import BasicMAC
+from controllers.maddpg_controller import MADDPGMAC
+from controllers.non_shared_controller import NonSharedMAC
+
+
+N_AGENTS = 3
+N_ACTIONS = 4
+OBS_SHAPE = 5
+BS = 2
+MAX_T = 6
+HIDDEN_DIM = 8
+
+
+def make_batch(hidden_states=False):
+    scheme = {
+        "obs": {"vshape": OBS_SHAPE, "group": "agents"},
+        "actions": {"vshape": (1,), "group": "agents", "dtype": th.long},
+        "avail_actions": {"vshape": (N_ACTIONS,), "group": "agents", "dtype": th.int},
+    }
+    if hidden_states:
+        scheme["hidden_states"] = {"vshape": (HIDDEN_DIM,), "group": "agents"}
+    groups = {"agents": N_AGENTS}
+    preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=N_ACTIONS)])}
+    batch = EpisodeBatch(scheme, groups, BS, MAX_T, preprocess=preprocess)
+    avail_actions = th.randint(2, (BS, MAX_T, N_AGENTS, N_ACTIONS), dtype=th.int)
+    avail_actions[..., 0] = 1
+    batch.update(
+        {
+            "obs": th.randn(BS, MAX_T, N_AGENTS, OBS_SHAPE),
+            "actions": th.randint(N_ACTIONS, (BS, MAX_T, N_AGENTS, 1)),
+            "avail_actions": avail_actions,
+        }
+    )
+    if hidden_states:
+        batch.update({"hidden_states": th.randn(BS, MAX_T, N_AGENTS, HIDDEN_DIM)}, mark_filled=False)
+    return batch, groups
+
+
+def make_mac(mac_cls, agent, use_rnn, hidden_states=False):
+    th.manual_seed(0)
+    batch, groups = make_batch(hidden_states)
+    args = SN(
+        n_agents=N_AGENTS, n_actions=N_ACTIONS, hidden_dim=HIDDEN_DIM, use_rnn=use_rnn, agent=agent,
+        agent_output_type="pi_logits", action_selector="soft_policies", mask_before_softmax=True,
+        obs_last_action=True, obs_agent_id=True,
+    )
+    return mac_cls(batch.scheme, groups, args), batch
+
+
+@pytest.mark.parametrize(
+    "mac_cls,agent", [(BasicMAC, "rnn"), (NonSharedMAC, "rnn_ns"), (MADDPGMAC, "rnn")]
+)
+@pytest.mark.parametrize("use_rnn", [False, True])
+@pytest.mark.parametrize("t_start,t_end", [(0, MAX_T - 1), (2, MAX_T)])
+def test_forward_sequence_matches_forward(mac_cls, agent, use_rnn, t_start, t_end):
+    mac, batch = make_mac(mac_cls, agent, use_rnn)
+    with th.no_grad():
+        mac.init_hidden(BS)
+        out = mac.forward_sequence(batch, t_start=t_start, t_end=t_end)
+        h_last = mac.hidden_states
+
+        mac.init_hidden(BS)
+        expected = th.stack([mac.forward(batch, t) for t in range(t_start, t_end)], dim=1)
+
+    assert out.shape == (BS, t_end - t_start, N_AGENTS, N_ACTIONS)
+    assert th.allclose(out, expected, atol=1e-5)
+    # the hidden states are left at the last timestep, as after the forward loop
+    assert th.allclose(h_last.reshape(BS, N_AGENTS, -1), mac.hidden_states.reshape(BS, N_AGENTS, -1), atol=1e-5)
+
+
+@pytest.mark.parametrize("mac_cls,agent", [(BasicMAC, "rnn"), (NonSharedMAC, "rnn_ns")])
+def test_forward_sequence_starts_from_stored_hidden_states(mac_cls, agent):
+    mac, batch = make_mac(mac_cls, agent, True, hidden_states=True)
+    t_start = 2
+    with th.no_grad():
+        mac.init_hidden(BS)
+        out = mac.forward_sequence(batch, t_start=t_start, stored_hidden_states=True)
+
+        mac.hidden_states = batch["hidden_states"][:, t_start]
+        expected = th.stack([mac.forward(batch, t) for t in range(t_start, MAX_T)], dim=1)
+    assert th.allclose(out, expected, atol=1e-5)
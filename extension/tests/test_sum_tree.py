@@ -0,0 +1,35 @@
+import numpy as np
+
+from components.sum_tree import SumTree
+
+
+def test_find_prefix_sums():
+    tree = SumTree(5)
+    tree.update(np.arange(5), [1.0, 0.0, 2.0, 3.0, 0.5])
+    assert tree.total == 6.5
+    # prefix sums 1, 1, 3, 6, 6.5, the zero priority leaf 1 is never found
+    values = [0.0, 0.99, 1.0, 2.5, 3.0, 5.99, 6.0, 6.49]
+    assert tree.find(values).tolist() == [0, 0, 2, 2, 3, 3, 4, 4]
+
+
+def test_update_repeated_leaves_keeps_the_last():
+    tree = SumTree(4)
+    tree.update([0, 1, 2, 3], 1.0)
+    tree.update([2, 0, 2], [5.0, 0.0, 7.0])
+    assert tree.get([0, 1, 2, 3]).tolist() == [0.0, 1.0, 7.0, 1.0]
+    assert tree.total == 9.0
+    # every inner node is the sum of its children
+    inner = np.arange(1, tree.capacity)
+    assert np.allclose(tree.tree[inner], tree.tree[2 * inner] + tree.tree[2 * inner + 1])
+
+
+def test_sample_proportional_to_priorities():
+    np.random.seed(0)
+    tree = SumTree(6)
+    priorities = np.array([1.0, 0.0, 2.0, 4.0, 0.0, 1.0])
+    tree.update(np.arange(6), priorities)
+    counts = np.zeros(6)
+    for _ in range(2000):
+        np.add.at(counts, tree.sample(8), 1)
+    assert counts[1] == counts[4] == 0
+    assert np.allclose(counts / counts.sum(), priorities / priorities.sum(), atol=0.01)
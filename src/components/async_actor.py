@@ -0,0 +1,118 @@
+import copy
+import queue
+import threading
+import time
+
+import numpy as np
+import torch as th
+
+
+class AsyncActor:
+    """Runs the training episodes of a runner in a background thread while the learner
+    trains on the main thread.
+
+    The runner acts with its own copy of the controller, which loads the parameters of
+    the last publish() before every run. Every episode batch is queued with the
+    version (number of publish() calls) of the parameters it was collected with, so
+    the learner can measure its policy lag. The queue holds at most max_queue batches,
+    the actor waits while it is full. Every batch also comes with the runner's t_env
+    right after it was collected, since the actor keeps stepping the envs while the
+    learner trains on it. Other uses of the runner (test runs) have to hold
+    runner_lock.
+    """
+
+    def __init__(self, runner, mac, max_queue=2):
+        assert not getattr(runner, "streaming", False), "Streaming runners insert their episodes themselves"
+        self.runner = runner
+        self.mac = mac
+        self.actor_mac = copy.deepcopy(mac)
+        self.runner.mac = self.actor_mac
+        # queued batches cannot be written into reserved slots of the replay buffer
+        self.runner.buffer = None
+
+        self.version = 0
+        self.params = None
+        self.loaded_version = -1
+        self.param_lock = threading.Lock()
+        self.runner_lock = threading.Lock()
+        self.publish()
+
+        self.lags = []
+        self.n_dropped = 0
+        self.wait_times = []
+
+        self.batches = queue.Queue(maxsize=max_queue)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def publish(self):
+        # Snapshot of the parameters of the learner's controller for the next runs
+        params = {k: v.detach().clone() for k, v in self.mac.agent.state_dict().items()}
+        with self.param_lock:
+            self.params = params
+            self.version += 1
+
+    def get(self):
+        # (episode batch, parameter version it was collected with, t_env after it)
+        start = time.time()
+        batch = self.batches.get()
+        self.wait_times.append(time.time() - start)
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def record_lag(self, version, dropped=False):
+        self.lags.append(self.version - version)
+        if dropped:
+            self.n_dropped += 1
+
+    def load_params(self):
+        # Loads the last published parameters into the actor's controller
+        with self.param_lock:
+            params, version = self.params, self.version
+        if version != self.loaded_version:
+            self.actor_mac.agent.load_state_dict(params)
+            self.loaded_version = version
+        return version
+
+    def stats(self):
+        # Policy lag (in published versions) of the batches received since the last
+        # call, the batches dropped for being too stale and the time get() waited
+        stats = {}
+        if self.lags:
+            stats = {
+                "policy_lag_mean": float(np.mean(self.lags)),
+                "policy_lag_max": float(np.max(self.lags)),
+                "stale_batches_dropped": self.n_dropped,
+            }
+        if self.wait_times:
+            stats["actor_wait_mean"] = float(np.mean(self.wait_times))
+        self.lags = []
+        self.n_dropped = 0
+        self.wait_times = []
+        return stats
+
+    def close(self):
+        # the actor stops after its current run
+        self.stopped.set()
+        self.thread.join()
+
+    def _worker(self):
+        while not self.stopped.is_set():
+            try:
+                with self.runner_lock:
+                    version = self.load_params()
+                    with th.no_grad():
+                        episode_batch = self.runner.run(test_mode=False)
+                    batch = (episode_batch, version, self.runner.t_env)
+            except Exception as e:
+                batch = e
+            while not self.stopped.is_set():
+                try:
+                    self.batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(batch, Exception):
+                return
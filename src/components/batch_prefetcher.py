@@ -0,0 +1,108 @@
+import contextlib
+import queue
+import threading
+import time
+
+import numpy as np
+import torch as th
+
+
+class BatchPrefetcher:
+    """Samples, truncates and collates the next training batch of a ReplayBuffer in a
+    background thread while the learner trains on the current one.
+
+    Batches are gathered into n_slots reusable (pinned when moved to a cuda device)
+    buffers, so a batch returned by get() stays valid until n_slots - 1 further
+    batches have been requested. A batch is sampled when request() is called, i.e.
+    it does not contain the episodes inserted after that call.
+    """
+
+    def __init__(self, buffer, batch_size, device, n_slots=2):
+        assert n_slots >= 2, "Need one slot for the learner and one being filled"
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.device = device
+        self.pin = th.device(buffer.device).type == "cpu" and th.device(device).type == "cuda"
+        self.stream = th.cuda.Stream() if self.pin else None
+
+        self.slots = [self._alloc_slot() for _ in range(n_slots)]
+        self.next_slot = 0
+        self.pending = 0
+        self.wait_times = []
+
+        self.requests = queue.Queue()
+        self.batches = queue.Queue(maxsize=n_slots - 1)
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def request(self):
+        # Starts preparing a batch, at most n_slots - 1 can be pending
+        assert self.pending < len(self.slots) - 1, "Too many pending batches"
+        self.pending += 1
+        slot = self.slots[self.next_slot]
+        self.next_slot = (self.next_slot + 1) % len(self.slots)
+        self.requests.put(slot)
+
+    def get(self):
+        assert self.pending > 0, "No batch was requested"
+        start = time.time()
+        batch = self.batches.get()
+        self.wait_times.append(time.time() - start)
+        self.pending -= 1
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def wait_stats(self):
+        # Time (seconds) get() waited for the prepared batches since the last call
+        stats = {}
+        if self.wait_times:
+            stats = {
+                "prefetch_wait_mean": float(np.mean(self.wait_times)),
+                "prefetch_wait_max": float(np.max(self.wait_times)),
+            }
+        self.wait_times = []
+        return stats
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def _alloc_slot(self):
+        # flat buffers for the largest batch, viewed with the truncated shape
+        return self.buffer.alloc_gather_out(self.batch_size, pin_memory=self.pin)
+
+    def _worker(self):
+        while True:
+            slot = self.requests.get()
+            if slot is None:
+                return
+            try:
+                batch = self._prepare(slot)
+            except Exception as e:
+                batch = e
+            self.batches.put(batch)
+
+    def _prepare(self, slot):
+        with self.buffer.lock:
+            sample_ids, weights = self.buffer.sample_ids(self.batch_size, return_weights=True)
+            batch = self.buffer.gather(sample_ids, out=slot)
+            versions = self.buffer.slot_versions[sample_ids]
+
+        data = batch.data
+        device = self.buffer.device
+        if th.device(device) != th.device(self.device):
+            # copied on a side stream, the pinned slot is free again once it is done
+            with th.cuda.stream(self.stream) if self.pin else contextlib.nullcontext():
+                for d in [data.transition_data, data.episode_data]:
+                    for k, v in d.items():
+                        d[k] = v.to(self.device, non_blocking=self.pin)
+                        if self.pin:
+                            d[k].record_stream(th.cuda.default_stream(d[k].device))
+            if self.pin:
+                self.stream.synchronize()
+            device = self.device
+
+        batch.device = device
+        batch = self.buffer.window_batch(self.buffer.decompress_batch(batch))
+        return self.buffer.annotate_batch(batch, sample_ids, weights, versions)
@@ -1,7 +1,13 @@
+import math
+import threading
+
 import torch as th
 import numpy as np
 from types import SimpleNamespace as SN
 
+from components.episode_samplers import length_bucket_sample, prioritized_sample, uniform_sample
+from components.sum_tree import SumTree
+
 
 class EpisodeBatch:
     def __init__(self,
@@ -12,7 +18,9 @@ class EpisodeBatch:
                  data=None,
                  preprocess=None,
                  device="cpu"):
-        self.scheme = scheme.copy()
+        # batches over existing data (slices, samples) share the scheme, only new
+        # storage extends it
+        self.scheme = scheme.copy() if data is None else scheme
         self.groups = groups
         self.batch_size = batch_size
         self.max_seq_length = max_seq_length
@@ -53,6 +61,7 @@ class EpisodeBatch:
             "filled": {"vshape": (1,), "dtype": th.long},
         })
 
+        fields = []
         for field_key, field_info in scheme.items():
             assert "vshape" in field_info, "Scheme must define vshape for {}".format(field_key)
             vshape = field_info["vshape"]
@@ -70,9 +79,21 @@ class EpisodeBatch:
                 shape = vshape
 
             if episode_const:
-                self.data.episode_data[field_key] = th.zeros((batch_size, *shape), dtype=dtype, device=self.device)
+                fields.append((self.data.episode_data, field_key, (batch_size, *shape), dtype))
             else:
-                self.data.transition_data[field_key] = th.zeros((batch_size, max_seq_length, *shape), dtype=dtype, device=self.device)
+                fields.append((self.data.transition_data, field_key, (batch_size, max_seq_length, *shape), dtype))
+        self._alloc_fields(fields)
+
+    def _alloc_fields(self, fields):
+        # fields: (transition or episode data, key, shape, dtype)
+        for target, field_key, shape, dtype in fields:
+            tensor = self._alloc(field_key, shape, dtype)
+            # fields without storage (see ReplayBuffer) are left out
+            if tensor is not None:
+                target[field_key] = tensor
+
+    def _alloc(self, field_key, shape, dtype):
+        return th.zeros(shape, dtype=dtype, device=self.device)
 
     def extend(self, scheme, groups=None):
         self._setup_data(scheme, self.groups if groups is None else groups, self.batch_size, self.max_seq_length)
@@ -112,6 +133,34 @@ class EpisodeBatch:
                     v = transform.transform(v)
                 target[new_k][_slices] = v.view_as(target[new_k][_slices])
 
+    def update_steps(self, data, bs, ts, mark_filled=True):
+        # update() of a single timestep per episode, ts[i] of episode bs[i], for runners
+        # whose episodes are not in lockstep. Transition data only
+        bs = th.as_tensor(bs, dtype=th.long, device=self.device)
+        ts = th.as_tensor(ts, dtype=th.long, device=self.device)
+        target = self.data.transition_data
+        for k, v in data.items():
+            if k not in target:
+                raise KeyError("{} not found in transition data".format(k))
+            if mark_filled:
+                target["filled"][bs, ts] = 1
+                mark_filled = False
+
+            dtype = self.scheme[k].get("dtype", th.float32)
+            if type(v) == list:
+                v = th.tensor(np.array(v), dtype=dtype, device=self.device)
+            dest = target[k][bs, ts]
+            self._check_safe_view(v, dest)
+            target[k][bs, ts] = v.to(dest.device, dest.dtype).view_as(dest)
+
+            if k in self.preprocess:
+                new_k = self.preprocess[k][0]
+                v = target[k][bs, ts]
+                for transform in self.preprocess[k][1]:
+                    v = transform.transform(v)
+                dest = target[new_k][bs, ts]
+                target[new_k][bs, ts] = v.view_as(dest)
+
     def _check_safe_view(self, v, dest):
         idx = len(v.shape) - 1
         for s in dest.shape[::-1]:
@@ -196,7 +245,24 @@ class EpisodeBatch:
         return parsed
 
     def max_t_filled(self):
-        return th.sum(self.data.transition_data["filled"], 1).max(0)[0]
+        return self.seq_lengths().max(0)[0]
+
+    def seq_lengths(self, t_start=0, t_end=None):
+        # Timesteps up to the last filled one of every episode within [t_start, t_end).
+        # Windows sampled with burn-in (see ReplayBuffer.window_batch) start with
+        # unfilled timesteps, so this is not the number of filled timesteps
+        filled = self.data.transition_data["filled"][:, t_start:t_end].reshape(self.batch_size, -1)
+        t = th.arange(1, filled.size(1) + 1, device=filled.device)
+        return (filled * t).max(1)[0]
+
+    def clear_filled(self, bs=slice(None)):
+        # Zeros the episodes bs for reuse, limited to the timesteps filled so far
+        # (all writes of the runners are marked as filled)
+        max_t = int(th.sum(self.data.transition_data["filled"][bs], 1).max())
+        for v in self.data.transition_data.values():
+            v[bs, :max_t] = 0
+        for v in self.data.episode_data.values():
+            v[bs] = 0
 
     def __repr__(self):
         return "EpisodeBatch. Batch Size:{} Max_seq_len:{} Keys:{} Groups:{}".format(self.batch_size,
@@ -206,44 +272,414 @@ class EpisodeBatch:
 
 
 class ReplayBuffer(EpisodeBatch):
+    # The fields are stored as a struct of arrays: the transition fields of each storage
+    # dtype side by side in one [buffer_size, max_seq_length, width] tensor and the
+    # episode fields in one [buffer_size, width] tensor, every field being a view of
+    # its group. Sampling gathers each group with a single index_select
+    grouped_storage = True
+
+    # Fields can be stored compactly through the scheme: "storage_dtype" stores a field
+    # with a narrower dtype (e.g. th.bool avail_actions, th.uint8 actions, th.float16
+    # obs), and "lazy_preprocess" on a preprocessed field (e.g. actions) computes its
+    # preprocess outputs (actions_onehot) when sampling instead of storing them. filled
+    # is then stored as th.uint8. sample() returns batches with the scheme's dtypes
     def __init__(self, scheme, groups, buffer_size, max_seq_length, preprocess=None, device="cpu"):
         super(ReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length, preprocess=preprocess, device=device)
         self.buffer_size = buffer_size  # same as self.batch_size but more explicit
         self.buffer_index = 0
         self.episodes_in_buffer = 0
+        self.reserved = None
+        self.reserved_slots = slice(0, 0)
+        # filled timesteps of every slot, for length-bucketed sampling (see sample_ids)
+        self.episode_lengths = np.zeros(buffer_size, dtype=np.int64)
+        self.sample_by_length = False
+        self.length_weights = False
+        self.padding_ratios = []
+        # SumTree of the episode priorities for prioritized replay (see prioritize)
+        self.priorities = None
+        # number of times every slot was written, to recognise the sampled episodes
+        # that were overwritten before their priorities were updated
+        self.slot_versions = np.zeros(buffer_size, dtype=np.int64)
+        # timesteps of the sampled windows, whole episodes if 0 (see window_batch)
+        self.window = 0
+        self.burn_in = 0
+        # held while the storage is modified or sampled, for background samplers
+        self.lock = threading.RLock()
+
+    def reserve_episode_batch(self, batch_size):
+        # EpisodeBatch whose tensors are views of the next batch_size slots, for a
+        # runner to fill in place of a newly allocated batch. The slots are cleared up
+        # to their previously filled timesteps, and passing the batch back to
+        # insert_episode_batch commits it without any copy. Slots have to be
+        # contiguous, so if the batch does not fit before the end of the buffer it
+        # starts at slot 0 and the last slots stay unused
+        assert self.reserved is None, "An episode batch is already reserved"
+        assert batch_size <= self.buffer_size, "Episode batch larger than the buffer"
+        assert self.can_reserve, "Compact buffers cannot be written in place"
+        with self.lock:
+            if self.buffer_index + batch_size > self.buffer_size:
+                self.buffer_index = 0
+            slots = slice(self.buffer_index, self.buffer_index + batch_size)
+            # the slots are written without holding the lock, so they are not sampled
+            self.reserved_slots = slots
+            self.clear_filled(slots)
+            self.slot_versions[slots] += 1
+            self._set_priorities(np.arange(slots.start, slots.stop), 0.0)
+
+            data = self._new_data_sn()
+            for k, v in self.data.transition_data.items():
+                data.transition_data[k] = v[slots]
+            for k, v in self.data.episode_data.items():
+                data.episode_data[k] = v[slots]
+            self.reserved = EpisodeBatch(self.scheme, self.groups, batch_size, self.max_seq_length,
+                                         data=data, preprocess=self.preprocess, device=self.device)
+        return self.reserved
+
+    @property
+    def can_reserve(self):
+        # runners and agents need the fields with their scheme dtypes
+        return not self._is_compact()
+
+    def release_episode_batch(self):
+        # Gives up the reserved episode batch of a rollout that did not complete. Its
+        # slots are cleared and stay out of sampling until the next insert or
+        # reservation writes them again, both of which start at the same slot
+        with self.lock:
+            if self.reserved is None:
+                return
+            self.clear_filled(self.reserved_slots)
+            self.episode_lengths[self.reserved_slots] = 0
+            self.reserved = None
 
     def insert_episode_batch(self, ep_batch):
-        if self.buffer_index + ep_batch.batch_size <= self.buffer_size:
-            self.update(ep_batch.data.transition_data,
-                        slice(self.buffer_index, self.buffer_index + ep_batch.batch_size),
-                        slice(0, ep_batch.max_seq_length),
-                        mark_filled=False)
-            self.update(ep_batch.data.episode_data,
-                        slice(self.buffer_index, self.buffer_index + ep_batch.batch_size))
-            self.buffer_index = (self.buffer_index + ep_batch.batch_size)
-            self.episodes_in_buffer = max(self.episodes_in_buffer, self.buffer_index)
-            self.buffer_index = self.buffer_index % self.buffer_size
-            assert self.buffer_index < self.buffer_size
-        else:
-            buffer_left = self.buffer_size - self.buffer_index
-            self.insert_episode_batch(ep_batch[0:buffer_left, :])
-            self.insert_episode_batch(ep_batch[buffer_left:, :])
+        with self.lock:
+            self._insert_episode_batch(ep_batch)
+
+    def _insert_episode_batch(self, ep_batch):
+        if ep_batch is self.reserved:
+            # already written in place
+            filled = self.data.transition_data["filled"][self.reserved_slots]
+            self.episode_lengths[self.reserved_slots] = th.sum(filled, 1).view(-1).cpu().numpy()
+            self.reserved = None
+            self.reserved_slots = slice(0, 0)
+            self._advance(ep_batch.batch_size)
+            return
+
+        # Copies ep_batch straight into the next slots of the ring storage: one copy
+        # per key, two when the batch wraps around the end of the buffer
+        n_episodes = ep_batch.batch_size
+        assert n_episodes <= self.buffer_size, "Episode batch larger than the buffer"
+        n_first = min(n_episodes, self.buffer_size - self.buffer_index)
+        copies = [(slice(self.buffer_index, self.buffer_index + n_first), slice(0, n_first))]
+        if n_first < n_episodes:
+            copies.append((slice(0, n_episodes - n_first), slice(n_first, n_episodes)))
+        self._copy_episodes(ep_batch, copies)
+        if self.reserved is None:
+            # slots of a released reservation that are now written can be sampled again
+            start = min(self.reserved_slots.stop, self.buffer_index + n_episodes)
+            self.reserved_slots = slice(start, self.reserved_slots.stop)
+        self._advance(n_episodes)
+
+    def _advance(self, n_episodes):
+        slots = (self.buffer_index + np.arange(n_episodes)) % self.buffer_size
+        self.slot_versions[slots] += 1
+        if self.priorities is not None:
+            # new episodes are sampled with the largest priority so far
+            self.priorities.update(slots, self.max_priority ** self.priority_alpha)
+        self.buffer_index = self.buffer_index + n_episodes
+        self.episodes_in_buffer = max(self.episodes_in_buffer, min(self.buffer_index, self.buffer_size))
+        self.buffer_index = self.buffer_index % self.buffer_size
+        assert self.buffer_index < self.buffer_size
+
+    def _copy_episodes(self, ep_batch, copies):
+        # copies: (buffer slots, ep_batch episodes) pairs of slices
+        ts = slice(0, ep_batch.max_seq_length)
+        lazy_keys = self._lazy_keys()
+        for src_data, dest_data, time_slice in [(ep_batch.data.transition_data, self.data.transition_data, (ts,)),
+                                                (ep_batch.data.episode_data, self.data.episode_data, ())]:
+            for k, v in src_data.items():
+                if k in lazy_keys:
+                    continue
+                if k not in dest_data:
+                    raise KeyError("{} not found in transition or episode data".format(k))
+                for dest_bs, src_bs in copies:
+                    dest_data[k][(dest_bs, *time_slice)].copy_(v[src_bs])
+        lengths = th.sum(ep_batch.data.transition_data["filled"], 1).view(-1).cpu().numpy()
+        for dest_bs, src_bs in copies:
+            self.episode_lengths[dest_bs] = lengths[src_bs]
+
+        # Preprocessing only runs for outputs that ep_batch does not already hold
+        src_keys = set(ep_batch.data.transition_data) | set(ep_batch.data.episode_data)
+        for k, (new_k, transforms) in self.preprocess.items():
+            if k not in src_keys or new_k in src_keys or new_k in lazy_keys:
+                continue
+            if k in self.data.episode_data:
+                target, time_slice = self.data.episode_data, ()
+            else:
+                target, time_slice = self.data.transition_data, (ts,)
+            for dest_bs, _ in copies:
+                v = target[k][(dest_bs, *time_slice)]
+                for transform in transforms:
+                    v = transform.transform(v)
+                dest = target[new_k][(dest_bs, *time_slice)]
+                dest.copy_(v.view_as(dest))
 
     def can_sample(self, batch_size):
-        return self.episodes_in_buffer >= batch_size
+        return self._n_sampleable() >= batch_size
+
+    def _n_sampleable(self):
+        return self.episodes_in_buffer - self._n_reserved_filled()
 
     def sample(self, batch_size):
+        with self.lock:
+            assert self.can_sample(batch_size)
+            if self.episodes_in_buffer == batch_size:
+                ep_ids, weights = np.arange(batch_size), None
+                self._record_padding(ep_ids)
+            else:
+                ep_ids, weights = self.sample_ids(batch_size, return_weights=True)
+            # copies, learners may modify their batches in place
+            ep_batch = self.gather(ep_ids)
+            versions = self.slot_versions[ep_ids]
+        ep_batch = self.window_batch(self.decompress_batch(ep_batch))
+        return self.annotate_batch(ep_batch, ep_ids, weights, versions)
+
+    def gather(self, ep_ids, out=None):
+        # EpisodeBatch of (copies of) the episodes ep_ids, truncated to the longest one.
+        # With out (see alloc_gather_out) the data is gathered into its tensors
+        ep_ids = np.asarray(ep_ids)
+        bs = len(ep_ids)
+        max_t = max(int(self.episode_lengths[ep_ids].max()), 1)
+        ids = th.as_tensor(ep_ids, dtype=th.long, device=self.device)
+
+        data = self._new_data_sn()
+        if self.storage_groups:
+            for i, (episode_const, storage, layout) in enumerate(self.storage_groups):
+                src = storage if episode_const else storage[:, :max_t]
+                gathered = self._index_select(src, ids, None if out is None else out[i])
+                target = data.episode_data if episode_const else data.transition_data
+                for field_key, offset, shape in layout:
+                    v = gathered[..., offset:offset + math.prod(shape)]
+                    target[field_key] = v.view(*v.shape[:-1], *shape)
+        else:
+            for target, src_data in [(data.transition_data, self.data.transition_data),
+                                     (data.episode_data, self.data.episode_data)]:
+                for k, v in src_data.items():
+                    src = v if target is data.episode_data else v[:, :max_t]
+                    target[k] = self._index_select(src, ids, None if out is None else out[k])
+        return EpisodeBatch(self.scheme, self.groups, bs, max_t, data=data, device=self.device)
+
+    def alloc_gather_out(self, batch_size, pin_memory=False):
+        # Flat tensors large enough to gather batch_size whole episodes into, one per
+        # storage group (per field without grouped storage)
+        if self.storage_groups:
+            sources = enumerate(storage for _, storage, _ in self.storage_groups)
+        else:
+            sources = {**self.data.transition_data, **self.data.episode_data}.items()
+        return {k: th.empty(batch_size * v[0].numel(), dtype=v.dtype, device=self.device, pin_memory=pin_memory)
+                for k, v in sources}
+
+    @staticmethod
+    def _index_select(src, ids, out=None):
+        if out is not None:
+            out = out[: len(ids) * src[0].numel()].view(len(ids), *src.shape[1:])
+        return th.index_select(src, 0, ids, out=out)
+
+    def window_batch(self, ep_batch):
+        # Cuts burn_in + window + 1 consecutive timesteps (the last one only for the
+        # targets) at a uniformly drawn start out of every episode of ep_batch, or the
+        # whole episode if it is shorter. The first burn_in timesteps of windows that
+        # do not start the episode are unfilled: learners unroll them from the
+        # "hidden_states" stored during the rollout to warm up the recurrent state,
+        # without training on them
+        if self.window <= 0:
+            return ep_batch
+        bs = ep_batch.batch_size
+        lengths = th.sum(ep_batch["filled"].view(bs, -1), 1).cpu().numpy()
+        max_t = min(self.burn_in + self.window + 1, int(lengths.max()))
+        starts = (np.random.rand(bs) * (np.maximum(lengths - max_t, 0) + 1)).astype(np.int64)
+        t = np.arange(max_t)
+        steps = np.minimum(starts[:, None] + t, ep_batch.max_seq_length - 1)
+        burn_in = np.where(starts > 0, self.burn_in, 0)
+        filled = (t >= burn_in[:, None]) & (t < (lengths - starts)[:, None])
+
+        bs_ids = th.arange(bs, device=ep_batch.device).unsqueeze(1)
+        steps = th.as_tensor(steps, device=ep_batch.device)
+        data = self._new_data_sn()
+        for k, v in ep_batch.data.transition_data.items():
+            data.transition_data[k] = v[bs_ids, steps]
+        data.transition_data["filled"] = th.as_tensor(
+            filled, dtype=data.transition_data["filled"].dtype, device=ep_batch.device).unsqueeze(-1)
+        data.episode_data = dict(ep_batch.data.episode_data)
+        return EpisodeBatch(self.scheme, self.groups, bs, max_t, data=data, device=ep_batch.device)
+
+    def annotate_batch(self, ep_batch, ep_ids, weights, versions):
+        # Adds the importance weights of the sampled episodes as episode data
+        # "sample_weight" [bs, 1], learners weight their per-episode losses with it.
+        # With prioritized replay the slots of the episodes and their slot_versions
+        # when sampled are added as "sample_id" and "sample_version" for
+        # update_priorities
+        if weights is not None:
+            ep_batch.data.episode_data["sample_weight"] = th.as_tensor(
+                weights, dtype=th.float32, device=ep_batch.device).view(-1, 1)
+        if self.priorities is not None:
+            ep_batch.data.episode_data["sample_id"] = th.as_tensor(
+                ep_ids, dtype=th.long, device=ep_batch.device).view(-1, 1)
+            ep_batch.data.episode_data["sample_version"] = th.as_tensor(
+                versions, dtype=th.long, device=ep_batch.device).view(-1, 1)
+        return ep_batch
+
+    def prioritize(self, alpha, beta, eps=1e-6):
+        # Prioritized replay: episodes are sampled with probability p^alpha / sum p^alpha
+        # of their priorities p (set by update_priorities, the largest one so far for
+        # new episodes) and importance weights (n P)^-beta / max (n P)^-beta
+        with self.lock:
+            self.priorities = SumTree(self.buffer_size)
+            self.priority_alpha, self.priority_beta, self.priority_eps = alpha, beta, eps
+            self.max_priority = 1.0
+            self._set_priorities(self._sample_pool(), 1.0)
+
+    def update_priorities(self, ep_ids, priorities, versions):
+        # Priorities of sampled episodes, e.g. their mean absolute TD error, with the
+        # slot_versions of their slots when they were sampled. Slots that are reserved
+        # or no longer hold an episode keep their zero priority, slots written since
+        # the episodes were sampled (by a runner while the batch was prefetched or
+        # trained on) keep the priority of their new episode
+        ep_ids = np.asarray(ep_ids, dtype=np.int64).reshape(-1)
+        versions = np.asarray(versions, dtype=np.int64).reshape(-1)
+        priorities = np.asarray(priorities, dtype=np.float64).reshape(-1) + self.priority_eps
+        with self.lock:
+            live = (self.priorities.get(ep_ids) > 0) & (self.slot_versions[ep_ids] == versions)
+            self.priorities.update(ep_ids[live], priorities[live] ** self.priority_alpha)
+            self.max_priority = max(self.max_priority, float(priorities.max()))
+
+    def _set_priorities(self, ep_ids, priorities):
+        if self.priorities is not None:
+            self.priorities.update(ep_ids, priorities)
+
+    def sample_stats(self):
+        # Mean fraction of padded timesteps in the batches sampled since the last call
+        with self.lock:
+            stats = {}
+            if self.padding_ratios:
+                stats = {"sample_padding_ratio": float(np.mean(self.padding_ratios))}
+            self.padding_ratios = []
+        return stats
+
+    def decompress_batch(self, ep_batch):
+        # Casts the fields of a batch of this buffer back to their scheme dtypes and
+        # computes the lazy preprocess outputs (in place)
+        if not self._is_compact():
+            return ep_batch
+        for data in [ep_batch.data.transition_data, ep_batch.data.episode_data]:
+            for k, v in data.items():
+                dtype = self.scheme[k].get("dtype", th.float32)
+                if v.dtype != dtype:
+                    data[k] = v.to(dtype)
+        lazy_keys = self._lazy_keys()
+        for k, (new_k, transforms) in self.preprocess.items():
+            if new_k not in lazy_keys:
+                continue
+            if k in ep_batch.data.episode_data:
+                target = ep_batch.data.episode_data
+            else:
+                target = ep_batch.data.transition_data
+            v = target[k]
+            for transform in transforms:
+                v = transform.transform(v)
+            target[new_k] = v
+        return ep_batch
+
+    def _alloc_fields(self, fields):
+        if not hasattr(self, "storage_groups"):
+            self.storage_groups = []
+        if not self.grouped_storage:
+            return super(ReplayBuffer, self)._alloc_fields(fields)
+
+        groups = {}
+        for target, field_key, shape, dtype in fields:
+            dtype = self._storage_dtype(field_key, dtype)
+            if dtype is None:
+                continue
+            episode_const = target is self.data.episode_data
+            groups.setdefault((episode_const, dtype), []).append((field_key, shape))
+        for (episode_const, dtype), group in groups.items():
+            # the fields of a group share its leading (batch[, time]) dims
+            n_lead = 1 if episode_const else 2
+            layout, width = [], 0
+            for field_key, shape in group:
+                layout.append((field_key, width, shape[n_lead:]))
+                width += math.prod(shape[n_lead:])
+            storage = self._alloc_storage(None, (*group[0][1][:n_lead], width), dtype)
+            target = self.data.episode_data if episode_const else self.data.transition_data
+            for field_key, offset, shape in layout:
+                v = storage[..., offset:offset + math.prod(shape)]
+                target[field_key] = v.view(*v.shape[:-1], *shape)
+            self.storage_groups.append((episode_const, storage, layout))
+
+    def _alloc(self, field_key, shape, dtype):
+        dtype = self._storage_dtype(field_key, dtype)
+        if dtype is None:
+            return None
+        return self._alloc_storage(field_key, shape, dtype)
+
+    def _storage_dtype(self, field_key, dtype):
+        # dtype a field is stored with, None for fields without storage
+        if field_key in self._lazy_keys():
+            return None
+        if field_key == "filled" and self._is_compact():
+            dtype = th.uint8
+        return self.scheme[field_key].get("storage_dtype", dtype)
+
+    def _alloc_storage(self, field_key, shape, dtype):
+        return th.zeros(shape, dtype=dtype, device=self.device)
+
+    def _lazy_keys(self):
+        return {new_k for k, (new_k, _) in self.preprocess.items() if self.scheme[k].get("lazy_preprocess", False)}
+
+    def _is_compact(self):
+        return any("storage_dtype" in v or v.get("lazy_preprocess", False) for v in self.scheme.values())
+
+    def sample_ids(self, batch_size, return_weights=False):
+        # Ids of batch_size distinct episodes, leaving out reserved slots. With
+        # sample_by_length the episodes have similar lengths, so less padded timesteps
+        # are computed, and with length_weights the returned weights are the importance
+        # weights correcting their sampling probabilities to uniform ones (else None).
+        # With prioritized replay episodes are drawn by priority (with replacement)
+        # and always weighted
         assert self.can_sample(batch_size)
-        if self.episodes_in_buffer == batch_size:
-            return self[:batch_size]
+        if self.priorities is not None:
+            ep_ids, weights = prioritized_sample(self.priorities, batch_size, self._n_sampleable(), self.priority_beta)
+        elif self.sample_by_length:
+            pool = self._sample_pool()
+            ep_ids, weights = length_bucket_sample(pool, self.episode_lengths[pool], batch_size, self.length_weights)
         else:
-            # Uniform sampling only atm
-            ep_ids = np.random.choice(self.episodes_in_buffer, batch_size, replace=False)
-            return self[ep_ids]
+            ep_ids, weights = uniform_sample(self._sample_pool(), batch_size)
+
+        self._record_padding(ep_ids)
+        return (ep_ids, weights) if return_weights else ep_ids
+
+    def _record_padding(self, ep_ids):
+        # fraction of padded timesteps of a batch of ep_ids truncated to its longest
+        # episode, logged as sample_padding_ratio
+        lengths = self.episode_lengths[ep_ids]
+        self.padding_ratios.append(1.0 - lengths.sum() / (len(ep_ids) * max(lengths.max(), 1)))
+
+    def _sample_pool(self):
+        # episodes that can be sampled
+        ep_ids = np.arange(self.episodes_in_buffer)
+        if self._n_reserved_filled() == 0:
+            return ep_ids
+        reserved = (ep_ids >= self.reserved_slots.start) & (ep_ids < self.reserved_slots.stop)
+        return ep_ids[~reserved]
+
+    def _n_reserved_filled(self):
+        # reserved slots among the episodes that can be sampled
+        stop = min(self.reserved_slots.stop, self.episodes_in_buffer)
+        return max(0, stop - self.reserved_slots.start)
 
     def __repr__(self):
         return "ReplayBuffer. {}/{} episodes. Keys:{} Groups:{}".format(self.episodes_in_buffer,
                                                                         self.buffer_size,
                                                                         self.scheme.keys(),
                                                                         self.groups.keys())
-
@@ -0,0 +1,41 @@
+import numpy as np
+
+
+# Episode selection of ReplayBuffer.sample_ids. Every sampler returns the ids of the
+# sampled episodes and their importance weights (None for uniform sampling)
+
+
+def uniform_sample(pool, batch_size):
+    # batch_size distinct episodes of pool
+    return np.random.choice(pool, batch_size, replace=False), None
+
+
+def length_bucket_sample(pool, lengths, batch_size, weighted=False):
+    # Sorts the episodes of pool by their lengths (ties in random order) and takes the
+    # batch_size consecutive ones centred on a uniformly drawn anchor episode. With
+    # weighted the weights correct their sampling probabilities to uniform ones
+    n = len(pool)
+    order = np.lexsort((np.random.rand(n), lengths))
+    starts = np.clip(np.arange(n) - batch_size // 2, 0, n - batch_size)
+    start = starts[np.random.randint(n)]
+    ranks = np.arange(start, start + batch_size)
+    if not weighted:
+        return pool[order[ranks]], None
+
+    # the episode of rank r is sampled with probability coverage[r] / n (the anchors
+    # whose window holds it) instead of batch_size / n
+    coverage = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(coverage, starts, 1)
+    np.add.at(coverage, starts + batch_size, -1)
+    coverage = np.cumsum(coverage)[:n]
+    return pool[order[ranks]], batch_size / coverage[ranks]
+
+
+def prioritized_sample(priorities, batch_size, n_episodes, beta):
+    # batch_size episodes drawn (with replacement) from the SumTree priorities, with
+    # importance weights (n P)^-beta / max (n P)^-beta for the n_episodes that can be
+    # sampled
+    ep_ids = priorities.sample(batch_size)
+    probs = priorities.get(ep_ids) / priorities.total
+    weights = (n_episodes * probs) ** -beta
+    return ep_ids, weights / weights.max()
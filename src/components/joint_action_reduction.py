@@ -0,0 +1,101 @@
+import numpy as np
+import torch as th
+
+
+class JointActionReduction:
+    """
+    Streaming reduction of PAC compute_all Q-values over the joint actions of the
+    other agents. Chunks of shape [..., n_chunk, n_actions] are folded in along dim -2,
+    so the full [..., n_joint, n_actions] tensor never has to exist at once.
+
+    Keeps a running max/argmax and sum and, if cvar_k > 0, the CVaR of every joint
+    action over the agent's own actions: the mean of its top cvar_k Q-values along
+    dim -1.
+    """
+
+    @classmethod
+    def from_max(cls, q_max):
+        # Reduction that only holds a max found elsewhere, e.g. by a search
+        reduction = cls()
+        reduction.max = q_max
+        return reduction
+
+    def __init__(self, cvar_k=0):
+        self.cvar_k = cvar_k
+        self.max = None
+        self.argmax = None
+        self.sum = None
+        self.count = 0
+        self.cvar_chunks = []
+
+    def update(self, q, offset=0):
+        chunk_max, chunk_argmax = q.max(dim=-2)
+        chunk_argmax = chunk_argmax + offset
+        if self.max is None:
+            self.max = chunk_max
+            self.argmax = chunk_argmax
+            self.sum = q.sum(dim=-2)
+        else:
+            # strict comparison so ties keep the first joint action, as in q.max()
+            better = chunk_max > self.max
+            self.max = th.where(better, chunk_max, self.max)
+            self.argmax = th.where(better, chunk_argmax, self.argmax)
+            self.sum = self.sum + q.sum(dim=-2)
+        self.count += q.size(-2)
+
+        if self.cvar_k > 0:
+            self.cvar_chunks.append(q.topk(self.cvar_k, dim=-1)[0].mean(dim=-1))
+
+    @property
+    def mean(self):
+        if self.sum is None:
+            raise ValueError("This reduction only holds the max over joint actions")
+        return self.sum / self.count
+
+    @property
+    def cvar(self):
+        # [..., n_joint]
+        if not self.cvar_chunks:
+            raise ValueError("This reduction does not hold the CVaR")
+        return th.cat(self.cvar_chunks, dim=-1)
+
+
+def cvar_topk(n_values, alpha):
+    # Number of top values averaged by the CVaR at quantile alpha over n_values values
+    if alpha <= 0 or alpha > 1:
+        raise ValueError("Alpha must be in (0, 1]")
+    return max(1, int(np.ceil(alpha * n_values)))
+
+
+class JointActionOperator:
+    """
+    Value over the joint actions of the other agents that PAC uses in place of
+    max_{a_-i} Q(s, a_i, a_-i), read from a single JointActionReduction pass:
+
+    - "max": the max (PAC)
+    - "mean": the mean
+    - "cvar": the CVaR at quantile cvar_alpha over the agent's own actions (the
+      mean of the top ceil(cvar_alpha * n_actions) values along dim -1) of every
+      joint action of the other agents, [..., n_joint]
+    - "blend": alpha * max + (1 - alpha) * mean, with alpha given per call
+    """
+
+    OPERATORS = ["max", "mean", "cvar", "blend"]
+
+    def __init__(self, name, n_actions, cvar_alpha=0.1):
+        assert name in self.OPERATORS, "Unknown joint action operator {}".format(name)
+        self.name = name
+        self.cvar_k = cvar_topk(n_actions, cvar_alpha) if name == "cvar" else 0
+
+    @property
+    def max_only(self):
+        return self.name == "max"
+
+    def __call__(self, reduction, alpha=1.0):
+        if self.name == "max":
+            return reduction.max
+        elif self.name == "mean":
+            return reduction.mean
+        elif self.name == "cvar":
+            return reduction.cvar
+        return alpha * reduction.max + (1 - alpha) * reduction.mean
@@ -0,0 +1,86 @@
+import json
+import os
+
+import numpy as np
+import torch as th
+
+from components.episode_buffer import ReplayBuffer
+
+
+class MemmapReplayBuffer(ReplayBuffer):
+    # ReplayBuffer whose fields are numpy.memmap files in path (one per scheme key),
+    # used by torch without copies, for buffers larger than RAM. Sampling and indexing
+    # return in-memory batches. Reopening a path written with the same scheme and sizes
+    # restores its episodes and ring position
+    grouped_storage = False
+
+    def __init__(self, scheme, groups, buffer_size, max_seq_length, path, preprocess=None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.meta = self._read_meta()
+        if self.meta is not None and (self.meta["buffer_size"], self.meta["max_seq_length"]) != (buffer_size, max_seq_length):
+            raise ValueError("Replay buffer in {} has a different buffer_size or max_seq_length".format(path))
+        self.memmaps = {}
+        super(MemmapReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length, preprocess=preprocess, device="cpu")
+        if self.meta is not None:
+            self.buffer_index = self.meta["buffer_index"]
+            self.episodes_in_buffer = self.meta["episodes_in_buffer"]
+            filled = self.data.transition_data["filled"]
+            self.episode_lengths[:] = th.sum(filled, 1).view(-1).numpy()
+        self._write_meta()
+
+    def _alloc_storage(self, field_key, shape, dtype):
+        if dtype == th.bfloat16:
+            # numpy has no bfloat16, the file holds its bits as int16
+            return self._alloc_storage(field_key, shape, th.int16).view(th.bfloat16)
+        np_dtype = th.zeros(0, dtype=dtype).numpy().dtype
+        fields = {} if self.meta is None else self.meta["fields"]
+        if field_key in fields:
+            if fields[field_key] != [list(shape), np_dtype.str]:
+                raise ValueError("Replay buffer in {} has a different shape or dtype for {}".format(self.path, field_key))
+            mode = "r+"
+        else:
+            mode = "w+"
+        self.memmaps[field_key] = np.memmap(self._field_path(field_key), dtype=np_dtype, mode=mode, shape=shape)
+        return th.from_numpy(self.memmaps[field_key])
+
+    def _advance(self, n_episodes):
+        super(MemmapReplayBuffer, self)._advance(n_episodes)
+        # the episodes reach the files before meta.json counts them
+        self.flush()
+
+    def flush(self):
+        for m in self.memmaps.values():
+            m.flush()
+        self._write_meta()
+
+    def _field_path(self, field_key):
+        return os.path.join(self.path, "{}.dat".format(field_key))
+
+    def _read_meta(self):
+        meta_path = os.path.join(self.path, "meta.json")
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def _write_meta(self):
+        meta = {
+            "buffer_size": self.buffer_size,
+            "max_seq_length": self.max_seq_length,
+            "buffer_index": self.buffer_index,
+            "episodes_in_buffer": self.episodes_in_buffer,
+            "fields": {k: [list(m.shape), m.dtype.str] for k, m in self.memmaps.items()},
+        }
+        # written next to the old one and swapped, a restart never sees a partial file
+        tmp_path = os.path.join(self.path, "meta.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(self.path, "meta.json"))
+
+    def __repr__(self):
+        return "MemmapReplayBuffer. {}/{} episodes in {}. Keys:{} Groups:{}".format(self.episodes_in_buffer,
+                                                                                    self.buffer_size,
+                                                                                    self.path,
+                                                                                    self.scheme.keys(),
+                                                                                    self.groups.keys())
@@ -0,0 +1,132 @@
+import numpy as np
+import torch as th
+
+from components.episode_buffer import EpisodeBatch, ReplayBuffer
+
+
+class RaggedReplayBuffer(ReplayBuffer):
+    # ReplayBuffer that only stores the filled timesteps of each episode: transition
+    # fields are flat [n_steps, ...] arrays used as a ring, with the start and length
+    # of every episode slot in starts/episode_lengths. Episodes whose timesteps get
+    # overwritten are dropped. Sampling rebuilds padded batches truncated to the
+    # longest sampled episode, as ReplayBuffer.sample. String keys return the flat
+    # storage
+    grouped_storage = False
+
+    def __init__(self, scheme, groups, buffer_size, max_seq_length, n_steps, preprocess=None, device="cpu"):
+        assert n_steps >= max_seq_length, "n_steps must hold at least one full episode"
+        self.n_steps = n_steps
+        super(RaggedReplayBuffer, self).__init__(scheme, groups, buffer_size, max_seq_length, preprocess=preprocess, device=device)
+        self.starts = np.zeros(buffer_size, dtype=np.int64)
+        self.valid = np.zeros(buffer_size, dtype=bool)
+        self.write_pos = 0
+
+    def _alloc_storage(self, field_key, shape, dtype):
+        if not self.scheme[field_key].get("episode_const", False):
+            shape = (self.n_steps, *shape[2:])
+        return super(RaggedReplayBuffer, self)._alloc_storage(field_key, shape, dtype)
+
+    @property
+    def can_reserve(self):
+        return False
+
+    def _copy_episodes(self, ep_batch, copies):
+        lazy_keys = self._lazy_keys()
+        src_keys = set(ep_batch.data.transition_data) | set(ep_batch.data.episode_data)
+        lengths = th.sum(ep_batch.data.transition_data["filled"], 1).view(-1).tolist()
+        for dest_bs, src_bs in copies:
+            for slot, i in zip(range(dest_bs.start, dest_bs.stop), range(src_bs.start, src_bs.stop)):
+                n = int(lengths[i])
+                start = self._alloc_steps(slot, n)
+                steps = slice(start, start + n)
+                for k, v in ep_batch.data.transition_data.items():
+                    if k in lazy_keys:
+                        continue
+                    self.data.transition_data[k][steps].copy_(v[i, :n])
+                for k, v in ep_batch.data.episode_data.items():
+                    if k in lazy_keys:
+                        continue
+                    self.data.episode_data[k][slot].copy_(v[i])
+
+                # Preprocessing only runs for outputs that ep_batch does not already hold
+                for k, (new_k, transforms) in self.preprocess.items():
+                    if k not in src_keys or new_k in src_keys or new_k in lazy_keys:
+                        continue
+                    if k in self.data.episode_data:
+                        target, _slice = self.data.episode_data, slot
+                    else:
+                        target, _slice = self.data.transition_data, steps
+                    v = target[k][_slice]
+                    for transform in transforms:
+                        v = transform.transform(v)
+                    target[new_k][_slice] = v.view_as(target[new_k][_slice])
+
+    def _alloc_steps(self, slot, n):
+        # Next n contiguous timesteps of the flat storage for the episode in slot
+        if self.write_pos + n > self.n_steps:
+            self.write_pos = 0
+        start = self.write_pos
+        self.write_pos += n
+        self.valid[slot] = False
+        overwritten = self.valid & (self.starts < start + n) & (self.starts + self.episode_lengths > start)
+        self.valid[overwritten] = False
+        self._set_priorities(np.flatnonzero(overwritten), 0.0)
+        self.starts[slot], self.episode_lengths[slot], self.valid[slot] = start, n, True
+        return start
+
+    def _n_sampleable(self):
+        return int(self.valid.sum())
+
+    def _sample_pool(self):
+        return np.flatnonzero(self.valid)
+
+    def sample(self, batch_size):
+        with self.lock:
+            ep_ids, weights = self.sample_ids(batch_size, return_weights=True)
+            ep_batch = self.gather(ep_ids)
+            versions = self.slot_versions[ep_ids]
+        ep_batch = self.window_batch(self.decompress_batch(ep_batch))
+        return self.annotate_batch(ep_batch, ep_ids, weights, versions)
+
+    def __getitem__(self, item):
+        if isinstance(item, str) or (isinstance(item, tuple) and all([isinstance(it, str) for it in item])):
+            return super(RaggedReplayBuffer, self).__getitem__(item)
+        if not isinstance(item, tuple):
+            item = (item, slice(None))
+        assert item[1] == slice(None), "Only whole episodes can be indexed"
+        # slots of the episodes inserted so far, in ring order as in the dense buffer,
+        # excluding the dropped ones whose timesteps were overwritten
+        ep_ids = np.atleast_1d(np.arange(self.episodes_in_buffer)[item[0]])
+        if len(ep_ids) == 0 or not self.valid[ep_ids].all():
+            raise IndexError("Only the stored episodes of the buffer can be indexed")
+        return self.gather(ep_ids)
+
+    def alloc_gather_out(self, batch_size, pin_memory=False):
+        return {}
+
+    def gather(self, ep_ids, out=None):
+        # Padded EpisodeBatch of the episodes ep_ids, truncated to the longest one
+        # (out is not supported)
+        ep_ids = np.atleast_1d(ep_ids)
+        lengths = self.episode_lengths[ep_ids]
+        max_t = int(lengths.max())
+        t = np.arange(max_t)
+        step_ids = self.starts[ep_ids, None] + np.minimum(t[None], lengths[:, None] - 1)
+        step_ids = th.as_tensor(step_ids.reshape(-1), device=self.device)
+        padding = th.as_tensor(t[None] >= lengths[:, None], device=self.device)
+
+        data = self._new_data_sn()
+        for k, v in self.data.transition_data.items():
+            x = v.index_select(0, step_ids).view(len(ep_ids), max_t, *v.shape[1:])
+            data.transition_data[k] = x.masked_fill(padding.view(*padding.shape, *[1] * (x.dim() - 2)), 0)
+        ep_ids = th.as_tensor(ep_ids, device=self.device)
+        for k, v in self.data.episode_data.items():
+            data.episode_data[k] = v.index_select(0, ep_ids)
+        return EpisodeBatch(self.scheme, self.groups, len(ep_ids), max_t, data=data, device=self.device)
+
+    def __repr__(self):
+        return "RaggedReplayBuffer. {}/{} episodes, {} timesteps. Keys:{} Groups:{}".format(int(self.valid.sum()),
+                                                                                             self.buffer_size,
+                                                                                             self.n_steps,
+                                                                                             self.scheme.keys(),
+                                                                                             self.groups.keys())
@@ -0,0 +1,50 @@
+import numpy as np
+
+
+class SumTree:
+    # Array-backed binary sum tree over capacity priorities: node i has children 2i and
+    # 2i + 1, the leaves are the nodes capacity..2 * capacity - 1 (capacity rounded up
+    # to a power of two) and node 1 holds the total. Updates and sampling are
+    # vectorised over batches of leaves, O(log capacity) each
+    def __init__(self, capacity):
+        self.depth = max(1, int(capacity - 1).bit_length())
+        self.capacity = 2 ** self.depth
+        self.tree = np.zeros(2 * self.capacity, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idx):
+        return self.tree[np.asarray(idx, dtype=np.int64) + self.capacity]
+
+    def update(self, idx, priorities):
+        idx = np.asarray(idx, dtype=np.int64).reshape(-1)
+        priorities = np.broadcast_to(np.asarray(priorities, dtype=np.float64), idx.shape)
+        if len(idx) == 0:
+            return
+        # a leaf given several times keeps its last priority
+        nodes, last = np.unique(idx[::-1] + self.capacity, return_index=True)
+        self.tree[nodes] = priorities[::-1][last]
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        # Leaves whose prefix sum interval holds values (in [0, total)), leaves with a
+        # zero priority are never returned
+        values = np.array(values, dtype=np.float64).reshape(-1)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = (values >= self.tree[left]) & (self.tree[left + 1] > 0)
+            values = np.where(go_right, values - self.tree[left], values)
+            nodes = left + go_right
+        return nodes - self.capacity
+
+    def sample(self, n):
+        # n leaves with probability proportional to their priority, one from each of n
+        # equal strata of the total
+        values = (np.arange(n) + np.random.rand(n)) * (self.total / n)
+        return self.find(values)
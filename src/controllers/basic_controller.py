@@ -1,10 +1,11 @@
 from modules.agents import REGISTRY as agent_REGISTRY
 from components.action_selectors import REGISTRY as action_REGISTRY
+from controllers.sequence_forward import SequenceForwardMixin
 import torch as th
 
 
 # This multi-agent controller shares parameters between agents
-class BasicMAC:
+class BasicMAC(SequenceForwardMixin):
     def __init__(self, scheme, groups, args):
         self.n_agents = args.n_agents
         self.args = args
@@ -28,16 +29,19 @@ class BasicMAC:
         avail_actions = ep_batch["avail_actions"][:, t]
         agent_outs, self.hidden_states = self.agent(agent_inputs, self.hidden_states)
 
+        agent_outs = self._softmax_outputs(agent_outs, avail_actions)
+        return agent_outs.view(ep_batch.batch_size, self.n_agents, -1)
+
+    def _softmax_outputs(self, agent_outs, avail_actions):
         # Softmax the agent outputs if they're policy logits
         if self.agent_output_type == "pi_logits":
 
             if getattr(self.args, "mask_before_softmax", True):
                 # Make the logits for unavailable actions very negative to minimise their affect on the softmax
-                reshaped_avail_actions = avail_actions.reshape(ep_batch.batch_size * self.n_agents, -1)
+                reshaped_avail_actions = avail_actions.reshape(-1, avail_actions.size(-1))
                 agent_outs[reshaped_avail_actions == 0] = -1e10
             agent_outs = th.nn.functional.softmax(agent_outs, dim=-1)
-
-        return agent_outs.view(ep_batch.batch_size, self.n_agents, -1)
+        return agent_outs
 
     def init_hidden(self, batch_size):
         self.hidden_states = self.agent.init_hidden().unsqueeze(0).expand(batch_size, self.n_agents, -1)  # bav
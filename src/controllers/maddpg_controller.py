@@ -1,5 +1,6 @@
 from modules.agents import REGISTRY as agent_REGISTRY
 from components.action_selectors import REGISTRY as action_REGISTRY
+from controllers.sequence_forward import SequenceForwardMixin
 import torch as th
 from torch.autograd import Variable
 import torch.nn.functional as F
@@ -46,7 +47,7 @@ def gumbel_softmax(logits, temperature=1.0, hard=False):
 
 
 # This multi-agent controller shares parameters between agents
-class MADDPGMAC:
+class MADDPGMAC(SequenceForwardMixin):
     def __init__(self, scheme, groups, args):
         self.n_agents = args.n_agents
         self.args = args
@@ -76,6 +77,12 @@ class MADDPGMAC:
         agent_outs[avail_actions==0] = -1e10
         return agent_outs
 
+    def _sequence_outputs(self, agent_outs, avail_actions):
+        bs, max_t = avail_actions.shape[:2]
+        agent_outs = agent_outs.view(bs, max_t, self.n_agents, -1)
+        agent_outs[avail_actions==0] = -1e10
+        return agent_outs
+
     def init_hidden(self, batch_size):
         self.hidden_states = self.agent.init_hidden().unsqueeze(0).expand(batch_size, self.n_agents, -1)  # bav
 
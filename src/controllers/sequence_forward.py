@@ -0,0 +1,56 @@
+import torch as th
+
+
+class SequenceForwardMixin:
+    # forward_sequence of the MACs, which build their inputs from obs, last actions and
+    # agent ids (see _build_inputs) and have forward(ep_batch, t, **kwargs)
+
+    def forward_sequence(self, ep_batch, t_start=0, t_end=None, stored_hidden_states=False, **kwargs):
+        # forward(ep_batch, t, **kwargs) for t in [t_start, t_end), stacked over time:
+        # [bs, T, n_agents, -1]. Agents with forward_sequence evaluate the inputs of
+        # all timesteps at once (in a single call when non-recurrent, with one GRU
+        # over the filled timesteps when recurrent). With stored_hidden_states the
+        # agents start from the hidden states stored in ep_batch at t_start during the
+        # rollout (sampled windows, see ReplayBuffer.window_batch) instead of
+        # self.hidden_states
+        if t_end is None:
+            t_end = ep_batch.max_seq_length
+        if stored_hidden_states:
+            assert "hidden_states" in ep_batch.data.transition_data, "No hidden states stored in the batch"
+            self.hidden_states = ep_batch["hidden_states"][:, t_start]
+        if not hasattr(self.agent, "forward_sequence"):
+            agent_outs = [self.forward(ep_batch, t, **kwargs) for t in range(t_start, t_end)]
+            return th.stack(agent_outs, dim=1)
+
+        agent_inputs = self._build_sequence_inputs(ep_batch, t_start, t_end)
+        avail_actions = ep_batch["avail_actions"][:, t_start:t_end]
+        lengths = ep_batch.seq_lengths(t_start, t_end)
+        agent_outs, self.hidden_states = self.agent.forward_sequence(
+            agent_inputs, self.hidden_states, lengths
+        )
+        return self._sequence_outputs(agent_outs, avail_actions)
+
+    def _sequence_outputs(self, agent_outs, avail_actions):
+        # agent outputs [bs, T, n_agents, -1] processed as in forward
+        bs, max_t = avail_actions.shape[:2]
+        agent_outs = agent_outs.reshape(-1, agent_outs.size(-1))
+        agent_outs = self._softmax_outputs(agent_outs, avail_actions)
+        return agent_outs.view(bs, max_t, self.n_agents, -1)
+
+    def _build_sequence_inputs(self, batch, t_start, t_end):
+        # _build_inputs for every t in [t_start, t_end), [bs, T, n_agents, -1]
+        bs = batch.batch_size
+        max_t = t_end - t_start
+        inputs = []
+        inputs.append(batch["obs"][:, t_start:t_end])  # btav
+        if self.args.obs_last_action:
+            actions_onehot = batch["actions_onehot"]
+            if t_start == 0:
+                inputs.append(th.cat([th.zeros_like(actions_onehot[:, 0:1]), actions_onehot[:, :t_end-1]], dim=1))
+            else:
+                inputs.append(actions_onehot[:, t_start-1:t_end-1])
+        if self.args.obs_agent_id:
+            inputs.append(th.eye(self.n_agents, device=batch.device).expand(bs, max_t, -1, -1))
+
+        inputs = th.cat([x.reshape(bs, max_t, self.n_agents, -1) for x in inputs], dim=-1)
+        return inputs
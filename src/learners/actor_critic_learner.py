@@ -12,6 +12,8 @@ from modules.critics import REGISTRY as critic_resigtry
 class ActorCriticLearner:
     def __init__(self, mac, scheme, logger, args):
         self.args = args
+        # sampled windows are unrolled from the hidden states stored in the rollout
+        self.stored_hidden_states = getattr(args, "buffer_window", 0) > 0
         self.n_agents = args.n_agents
         self.n_actions = args.n_actions
         self.logger = logger
@@ -69,12 +71,10 @@ class ActorCriticLearner:
 
         critic_mask = mask.clone()
 
-        mac_out = []
         self.mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length - 1):
-            agent_outs = self.mac.forward(batch, t=t)
-            mac_out.append(agent_outs)
-        mac_out = th.stack(mac_out, dim=1)  # Concat over time
+        mac_out = self.mac.forward_sequence(
+            batch, t_end=batch.max_seq_length - 1, stored_hidden_states=self.stored_hidden_states
+        )
 
         pi = mac_out
         advantages, critic_train_stats = self.train_critic_sequential(
@@ -12,6 +12,8 @@ from modules.critics import register_pac_critics
 class PACDCGLearner:
     def __init__(self, mac, scheme, logger, args):
         self.args = args
+        # sampled windows are unrolled from the hidden states stored in the rollout
+        self.stored_hidden_states = getattr(args, "buffer_window", 0) > 0
         self.n_agents = args.n_agents
         self.n_actions = args.n_actions
         self.logger = logger
@@ -35,6 +37,8 @@ class PACDCGLearner:
         self.last_target_update_step = 0
         self.critic_training_steps = 0
         self.log_stats_t = -self.args.learner_log_interval - 1
+        # mean absolute TD error of the episodes of the last batch, for prioritized replay
+        self.episode_priorities = None
 
         device = "cuda" if args.use_cuda else "cpu"
         self.ret_ms = RunningMeanStd(shape=(1,), device=device)
@@ -53,12 +57,10 @@ class PACDCGLearner:
 
         critic_mask = mask.clone()
 
-        mac_out = []
         self.mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length - 1):
-            agent_outs = self.mac.forward(batch, t=t)
-            mac_out.append(agent_outs)
-        mac_out = th.stack(mac_out, dim=1)  # Concat over time
+        mac_out = self.mac.forward_sequence(
+            batch, t_end=batch.max_seq_length - 1, stored_hidden_states=self.stored_hidden_states
+        )
 
         pi = mac_out
         advantages, critic_train_stats = self.train_critic_sequential(
@@ -152,8 +154,8 @@ class PACDCGLearner:
             # target_vals = target_vals.max(dim=3)[0].max(dim=-1)[0]
             target_out = []
 
-            self.target_critic.init_hidden(batch.batch_size)
-            # Run through the episodes in the batch step by step
+            # hidden states of all timesteps at once, shared by the passes below
+            self.target_critic.init_hidden_sequence(batch)
             greedy_actions = []
             for t in range(batch.max_seq_length - 1):
                 # In double Q-learning, the actions are selected greedy w.r.t. mac
@@ -165,7 +167,6 @@ class PACDCGLearner:
             for i in range(self.n_agents):
                 current_actions = copy.deepcopy(greedy_actions)
                 current_actions[:, :, i] = actions[:, :, i]
-                self.target_critic.init_hidden(batch.batch_size)
                 target_q_values = []
                 for t in range(batch.max_seq_length - 1):
                     target_q_values.append(
@@ -177,7 +178,7 @@ class PACDCGLearner:
                 target_out.append(target_q_values.unsqueeze(-1))
             target_out = th.cat(target_out, dim=-1)
 
-        self.critic.init_hidden(batch.batch_size)
+        self.critic.init_hidden_sequence(batch, compute_grads=True)
         q_curr = []
         for t in range(batch.max_seq_length - 1):
             q_curr.append(
@@ -214,7 +215,6 @@ class PACDCGLearner:
             )
 
         greedy_actions = []
-        self.critic.init_hidden(batch.batch_size)
         for t in range(batch.max_seq_length - 1):
             # In double Q-learning, the actions are selected greedy w.r.t. mac
             greedy_actions.append(self.critic.forward(batch, t=t, policy_mode=False))
@@ -223,7 +223,6 @@ class PACDCGLearner:
         for i in range(self.n_agents):
             current_actions = copy.deepcopy(greedy_actions)
             current_actions[:, :, i] = actions[:, :, i]
-            self.critic.init_hidden(batch.batch_size)
             q_values = []
             for t in range(batch.max_seq_length - 1):
                 q_values.append(
@@ -248,11 +247,22 @@ class PACDCGLearner:
 
         td_error = target_returns.detach() - q_curr
         masked_td_error = td_error * mask_q
-        loss = (masked_td_error**2).sum() / mask_q.sum()
+        sq_td_error = masked_td_error**2
 
         td_error_v = target_returns_v.detach() - v
         masked_td_error_v = td_error_v * mask
-        loss_v = (masked_td_error_v**2).sum() / mask.sum()
+        sq_td_error_v = masked_td_error_v**2
+
+        if "sample_weight" in batch.data.episode_data:
+            # importance weights of non-uniformly sampled episodes
+            weights = batch["sample_weight"]
+            sq_td_error = sq_td_error * weights.view(-1, *[1] * (sq_td_error.dim() - 1))
+            sq_td_error_v = sq_td_error_v * weights.view(-1, 1, 1)
+        loss = sq_td_error.sum() / mask_q.sum()
+        loss_v = sq_td_error_v.sum() / mask.sum()
+        self.episode_priorities = (
+            masked_td_error.abs().flatten(1).sum(1) / mask_q.flatten(1).sum(1).clamp(min=1)
+        ).detach()
 
         self.state_value_optimiser.zero_grad()
         loss_v.backward()
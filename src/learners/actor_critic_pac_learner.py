@@ -5,14 +5,25 @@ import torch as th
 from torch.optim import Adam
 
 from components.episode_buffer import EpisodeBatch
+from components.joint_action_reduction import (
+    JointActionOperator,
+    JointActionReduction,
+)
 from components.standarize_stream import RunningMeanStd
 from modules.critics import REGISTRY as critic_resigtry
 from modules.critics import register_pac_critics
+from modules.critics.pac_ac_ns import generate_other_actions
 
 
 class PACActorCriticLearner:
+    # operator over the other agents' joint actions used for the advantage when
+    # pac_operator is not set, see JointActionOperator
+    default_operator = "max"
+
     def __init__(self, mac, scheme, logger, args):
         self.args = args
+        # sampled windows are unrolled from the hidden states stored in the rollout
+        self.stored_hidden_states = getattr(args, "buffer_window", 0) > 0
         self.n_agents = args.n_agents
         self.n_actions = args.n_actions
         self.logger = logger
@@ -34,6 +45,39 @@ class PACActorCriticLearner:
         self.last_target_update_step = 0
         self.critic_training_steps = 0
         self.log_stats_t = -self.args.learner_log_interval - 1
+        # mean absolute TD error of the episodes of the last batch, for prioritized replay
+        self.episode_priorities = None
+
+        self.compute_all_chunk_size = getattr(args, "compute_all_chunk_size", 0)
+
+        # Maximisation over the joint actions of the other agents
+        self.max_mode = getattr(args, "pac_max_mode", "exact")
+        assert self.max_mode in [
+            "exact",
+            "sample",
+            "coordinate",
+        ], "Unknown pac_max_mode {}".format(self.max_mode)
+        self.max_samples = getattr(args, "pac_max_samples", 32)
+        self.max_sweeps = getattr(args, "pac_max_sweeps", 2)
+        assert self.max_sweeps > 0, "pac_max_sweeps must be positive"
+        self.max_gap_log_joint = getattr(args, "pac_max_gap_log_joint", 1024)
+        self.track_max_gap = False
+        self.max_gap_stats = {"approx_max_gap_mean": [], "approx_max_gap_max": []}
+
+        # Operators over the joint actions for the advantage and for the target
+        cvar_alpha = getattr(args, "cvar_alpha", 0.1)
+        self.operator = JointActionOperator(
+            getattr(args, "pac_operator", self.default_operator),
+            self.n_actions,
+            cvar_alpha,
+        )
+        self.target_operator = JointActionOperator(
+            getattr(args, "pac_target_operator", "max"), self.n_actions, cvar_alpha
+        )
+        assert self.max_mode != "coordinate" or (
+            self.operator.max_only and self.target_operator.max_only
+        ), "pac_max_mode 'coordinate' only supports the 'max' operator"
+        self.blend_alpha = getattr(args, "pac_blend_alpha", 1.0)
 
         self.device = "cuda" if args.use_cuda else "cpu"
         self.ret_ms = RunningMeanStd(shape=(self.n_agents,), device=self.device)
@@ -51,14 +95,16 @@ class PACActorCriticLearner:
 
         critic_mask = mask.clone()
 
-        mac_out = []
         self.mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length - 1):
-            agent_outs = self.mac.forward(batch, t=t)
-            mac_out.append(agent_outs)
-        mac_out = th.stack(mac_out, dim=1)  # Concat over time
+        mac_out = self.mac.forward_sequence(
+            batch, t_end=batch.max_seq_length - 1, stored_hidden_states=self.stored_hidden_states
+        )
 
         pi = mac_out
+        self.track_max_gap = (
+            self.max_mode != "exact"
+            and t_env - self.log_stats_t >= self.args.learner_log_interval
+        )
         advantages, critic_train_stats = self.train_critic(
             self.critic, self.target_critic, batch, rewards, critic_mask, terminated, pi
         )
@@ -117,6 +163,11 @@ class PACActorCriticLearner:
                     key, sum(critic_train_stats[key]) / ts_logged, t_env
                 )
 
+            for key, values in self.max_gap_stats.items():
+                if len(values) > 0:
+                    self.logger.log_stat(key, sum(values) / len(values), t_env)
+                    values.clear()
+
             self.logger.log_stat("entropy_coef", entropy_coef, t_env)
             self.logger.log_stat(
                 "advantage_mean",
@@ -135,9 +186,10 @@ class PACActorCriticLearner:
     def train_critic(self, critic, target_critic, batch, rewards, mask, terminated, pi):
         actions = batch["actions"]
         # Optimise critic
-        with th.no_grad():
-            target_vals = target_critic(batch, compute_all=True)[0][:, :-1]
-            target_vals = target_vals.max(dim=3)[0]
+        target_reduction = self.reduce_joint_actions(
+            target_critic, batch, cvar_k=self.target_operator.cvar_k
+        )
+        target_vals = self.target_operator(target_reduction, self.optimism_alpha())
 
         target_vals = th.gather(target_vals, -1, actions[:, :-1]).squeeze(-1)
 
@@ -162,22 +214,36 @@ class PACActorCriticLearner:
         }
 
         actions = batch["actions"][:, :-1]
-        q = critic(batch)[0][:, :-1]
+        q, joint_reduction = self.reduce_joint_actions(
+            critic, batch, cvar_k=self.operator.cvar_k, with_taken=True
+        )
+        if (
+            self.track_max_gap
+            and self.n_actions ** (self.n_agents - 1) <= self.max_gap_log_joint
+        ):
+            self._track_max_gap(critic, batch, joint_reduction.max)
+        q = q[:, :-1]
         v = self.state_value(batch)[:, :-1].squeeze(-1)
 
         q_curr = th.gather(q, -1, actions).squeeze(-1)
         td_error = target_returns.detach() - q_curr
         masked_td_error = td_error * mask
-        loss = (masked_td_error**2).sum() / mask.sum()
 
         td_error_v = target_returns.detach() - v
         masked_td_error_v = td_error_v * mask
-        loss += (masked_td_error_v**2).sum() / mask.sum()
-
-        # compute the maximum Q-value and the joint action of the other agents that results in this Q-value
-        q_all = critic(batch, compute_all=True)[0][:, :-1]
-        q_all = q_all.max(dim=3)[0]
 
+        sq_td_error = masked_td_error**2 + masked_td_error_v**2
+        if "sample_weight" in batch.data.episode_data:
+            # importance weights of non-uniformly sampled episodes
+            sq_td_error = sq_td_error * batch["sample_weight"].view(-1, 1, 1)
+        loss = sq_td_error.sum() / mask.sum()
+        self.episode_priorities = (
+            masked_td_error.abs().sum(dim=(1, 2)) / mask.sum(dim=(1, 2)).clamp(min=1)
+        ).detach()
+
+        # compute the maximum Q-value (or the configured pac_operator) over the joint
+        # actions of the other agents
+        q_all = self.operator(joint_reduction, self.optimism_alpha())
         q_all = th.gather(q_all, -1, actions).squeeze(-1)
 
         advantage = q_all.detach() - v.detach()
@@ -202,6 +268,138 @@ class PACActorCriticLearner:
 
         return advantage, running_log
 
+    def optimism_alpha(self):
+        # weight of the max in the "blend" operator
+        return self.blend_alpha
+
+    def reduce_joint_actions(self, critic, batch, cvar_k=0, with_taken=False):
+        # Reduces the compute_all Q-values [:, :-1] over the joint actions of the other
+        # agents (dim 3) according to pac_max_mode, in chunks of compute_all_chunk_size
+        # joint actions. Only used for targets and advantages, so no graph is kept.
+        # With with_taken=True, critic(batch)[0] (with gradients) is computed from the
+        # same build of the critic inputs and returned along with the reduction.
+        # 'coordinate' mode only provides the max
+        assert self.max_mode != "coordinate" or cvar_k == 0, "No CVaR in coordinate mode"
+        other_actions = None
+        if self.max_mode == "sample":
+            with th.no_grad():
+                other_actions = critic.sample_other_actions(batch, self.max_samples)
+
+        q, chunks = None, None
+        if with_taken:
+            q, chunks = critic.forward_with_all(
+                batch, self.compute_all_chunk_size, other_actions
+            )
+
+        with th.no_grad():
+            if self.max_mode == "coordinate":
+                q_max = self._coordinate_ascent_max(critic, batch)[:, :-1]
+                reduction = JointActionReduction.from_max(q_max)
+            else:
+                if chunks is None:
+                    chunks = critic.compute_all_chunks(
+                        batch,
+                        chunk_size=self.compute_all_chunk_size,
+                        other_actions=other_actions,
+                    )
+                reduction = self._reduce_chunks(chunks, cvar_k)
+
+        if with_taken:
+            return q, reduction
+        return reduction
+
+    def _reduce_chunks(self, chunks, cvar_k=0):
+        reduction = JointActionReduction(cvar_k=cvar_k)
+        for q, offset in chunks:
+            reduction.update(q[:, :-1], offset)
+        return reduction
+
+    def _coordinate_ascent_max(self, critic, batch):
+        # Starting from the actions the other agents took, sets each of them in turn to
+        # its best response for pac_max_sweeps sweeps, separately for every action of
+        # the agent itself. Needs O(n_agents * n_actions^2) critic evaluations per
+        # sweep instead of n_actions^(n_agents - 1)
+        n_others = self.n_agents - 1
+        others = th.tensor(
+            [[j for j in range(self.n_agents) if j != i] for i in range(self.n_agents)],
+            device=batch.device,
+        )
+
+        avail_actions = self._others_avail_actions(batch)
+
+        # joint action of the others for every (agent, own action) pair:
+        # [bs, max_t, n_agents, n_actions, n_others]
+        joint_actions = batch["actions"].squeeze(-1).long()[:, :, others]
+        joint_actions = joint_actions.unsqueeze(3).repeat(1, 1, 1, self.n_actions, 1)
+        candidates = th.arange(self.n_actions, device=batch.device)
+
+        with th.no_grad():
+            for _ in range(self.max_sweeps):
+                for k in range(n_others):
+                    # [bs, max_t, n_agents, n_actions (own), n_actions (candidate), n_others]
+                    joint = joint_actions.unsqueeze(4).repeat(
+                        1, 1, 1, 1, self.n_actions, 1
+                    )
+                    joint[..., k] = candidates
+                    other_actions = th.nn.functional.one_hot(joint, self.n_actions)
+                    other_actions = other_actions.float().flatten(-2).flatten(3, 4)
+
+                    q = critic.forward_other_actions(batch, other_actions)
+                    q = q.view(*joint.shape[:-1], self.n_actions)
+                    # value of each candidate at the own action it was searched for
+                    q = q.diagonal(dim1=3, dim2=5).transpose(3, 4)
+                    q = q.masked_fill(
+                        avail_actions[:, :, :, k].unsqueeze(3) == 0, -float("inf")
+                    )
+                    q_max, best = q.max(dim=-1)
+                    joint_actions[..., k] = best
+        return q_max
+
+    def _others_avail_actions(self, batch):
+        # Available actions of the other agents of every agent,
+        # [bs, max_t, n_agents, n_agents - 1, n_actions]. No action is available once
+        # an episode has terminated, all of them are allowed there (as when sampling)
+        others = th.tensor(
+            [[j for j in range(self.n_agents) if j != i] for i in range(self.n_agents)],
+            device=batch.device,
+        )
+        avail_actions = batch["avail_actions"]
+        avail_actions = th.where(
+            avail_actions.sum(dim=-1, keepdim=True) > 0,
+            avail_actions,
+            th.ones_like(avail_actions),
+        )
+        return avail_actions[:, :, others]
+
+    def _track_max_gap(self, critic, batch, q_max):
+        # How far the approximate max q_max of critic falls below the exact max of the
+        # same critic over the available joint actions, over filled timesteps
+        avail_actions = self._others_avail_actions(batch)[:, :-1].float()
+        other_actions = generate_other_actions(
+            self.n_actions, self.n_agents, batch.device
+        )
+        reduction = JointActionReduction()
+        with th.no_grad():
+            chunks = critic.compute_all_chunks(
+                batch,
+                chunk_size=self.compute_all_chunk_size,
+                other_actions=other_actions,
+            )
+            for q, offset in chunks:
+                # availability of the joint actions of the chunk,
+                # [bs, max_t, n_agents, n_chunk]
+                joint = other_actions[offset : offset + q.size(-2)]
+                joint = joint.view(-1, self.n_agents - 1, self.n_actions)
+                avail = th.einsum("btika,nka->btink", avail_actions, joint).prod(-1)
+                q = q[:, :-1].masked_fill(avail.unsqueeze(-1) == 0, -float("inf"))
+                reduction.update(q, offset)
+            gap = reduction.max - q_max
+        mask = batch["filled"][:, :-1].unsqueeze(-1).expand_as(gap).float()
+        self.max_gap_stats["approx_max_gap_mean"].append(
+            ((gap * mask).sum() / mask.sum()).item()
+        )
+        self.max_gap_stats["approx_max_gap_max"].append((gap * mask).max().item())
+
     def nstep_returns(self, rewards, mask, values, nsteps):
         nstep_values = th.zeros_like(values)
         for t_start in range(rewards.size(1)):
@@ -12,6 +12,8 @@ class COMALearner:
     def __init__(self, mac, scheme, logger, args):
         assert args.common_reward, "COMA only supports common reward setting"
         self.args = args
+        # sampled windows are unrolled from the hidden states stored in the rollout
+        self.stored_hidden_states = getattr(args, "buffer_window", 0) > 0
         self.n_agents = args.n_agents
         self.n_actions = args.n_actions
         self.mac = mac
@@ -62,12 +64,10 @@ class COMALearner:
 
         actions = actions[:, :-1]
 
-        mac_out = []
         self.mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length - 1):
-            agent_outs = self.mac.forward(batch, t=t)
-            mac_out.append(agent_outs)
-        mac_out = th.stack(mac_out, dim=1)  # Concat over time
+        mac_out = self.mac.forward_sequence(
+            batch, t_end=batch.max_seq_length - 1, stored_hidden_states=self.stored_hidden_states
+        )
 
         # Calculated baseline
         q_vals = q_vals.reshape(-1, self.n_actions)
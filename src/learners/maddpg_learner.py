@@ -6,13 +6,15 @@ from torch.optim import Adam
 
 from components.episode_buffer import EpisodeBatch
 from components.standarize_stream import RunningMeanStd
-from controllers.maddpg_controller import gumbel_softmax
+from controllers.maddpg_controller import gumbel_softmax, onehot_from_logits
 from modules.critics import REGISTRY as critic_registry
 
 
 class MADDPGLearner:
     def __init__(self, mac, scheme, logger, args):
         self.args = args
+        # sampled windows are unrolled from the hidden states stored in the rollout
+        self.stored_hidden_states = getattr(args, "buffer_window", 0) > 0
         self.n_agents = args.n_agents
         self.n_actions = args.n_actions
         self.logger = logger
@@ -31,6 +33,8 @@ class MADDPGLearner:
         self.log_stats_t = -self.args.learner_log_interval - 1
 
         self.last_target_update_episode = 0
+        # mean absolute TD error of the episodes of the last batch, for prioritized replay
+        self.episode_priorities = None
 
         device = "cuda" if args.use_cuda else "cpu"
         if self.args.standardise_returns:
@@ -72,11 +76,11 @@ class MADDPGLearner:
 
         # Use the target actor and target critic network to compute the target q
         self.target_mac.init_hidden(batch.batch_size)
-        target_actions = []
-        for t in range(1, batch.max_seq_length):
-            agent_target_outs = self.target_mac.target_actions(batch, t)
-            target_actions.append(agent_target_outs)
-        target_actions = th.stack(target_actions, dim=1)  # Concat over time
+        target_actions = onehot_from_logits(
+            self.target_mac.forward_sequence(
+                batch, t_start=1, stored_hidden_states=self.stored_hidden_states
+            )
+        )
 
         target_actions = target_actions.view(
             batch_size, -1, 1, self.n_agents * self.n_actions
@@ -100,7 +104,15 @@ class MADDPGLearner:
 
         td_error = q_taken.view(-1, 1) - targets.detach()
         masked_td_error = td_error * mask.reshape(-1, 1)
-        loss = (masked_td_error**2).mean()
+        sq_td_error = masked_td_error**2
+        if "sample_weight" in batch.data.episode_data:
+            # importance weights of non-uniformly sampled episodes
+            sq_td_error = sq_td_error.view(batch_size, -1) * batch["sample_weight"]
+        loss = sq_td_error.mean()
+        self.episode_priorities = (
+            masked_td_error.view(batch_size, -1).abs().sum(1)
+            / mask.reshape(batch_size, -1).sum(1).clamp(min=1)
+        ).detach()
 
         self.critic_optimiser.zero_grad()
         loss.backward()
@@ -111,13 +123,10 @@ class MADDPGLearner:
 
         # Train the actor
         self.mac.init_hidden(batch_size)
-        pis = []
-        actions = []
-        for t in range(batch.max_seq_length - 1):
-            pi = self.mac.forward(batch, t=t).view(batch_size, 1, self.n_agents, -1)
-            actions.append(gumbel_softmax(pi, hard=True))
-            pis.append(pi)
-        actions = th.cat(actions, dim=1)
+        pis = self.mac.forward_sequence(
+            batch, t_end=batch.max_seq_length - 1, stored_hidden_states=self.stored_hidden_states
+        )
+        actions = gumbel_softmax(pis, hard=True)
         actions = actions.view(
             batch_size, -1, 1, self.n_agents * self.n_actions
         ).expand(-1, -1, self.n_agents, -1)
@@ -135,8 +144,7 @@ class MADDPGLearner:
             new_actions.append(actions_i.unsqueeze(2))
         new_actions = th.cat(new_actions, dim=2)
 
-        pis = th.cat(pis, dim=1)
-        pis[pis == -1e10] = 0
+        pis = pis.masked_fill(pis == -1e10, 0)
         pis = pis.reshape(-1, 1)
         q = self.critic(inputs[:, :-1], new_actions)
         q = q.reshape(-1, 1)
@@ -12,6 +12,8 @@ from modules.critics import REGISTRY as critic_resigtry
 class PPOLearner:
     def __init__(self, mac, scheme, logger, args):
         self.args = args
+        # sampled windows are unrolled from the hidden states stored in the rollout
+        self.stored_hidden_states = getattr(args, "buffer_window", 0) > 0
         self.n_agents = args.n_agents
         self.n_actions = args.n_actions
         self.logger = logger
@@ -63,12 +65,10 @@ class PPOLearner:
 
         critic_mask = mask.clone()
 
-        old_mac_out = []
         self.old_mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length - 1):
-            agent_outs = self.old_mac.forward(batch, t=t)
-            old_mac_out.append(agent_outs)
-        old_mac_out = th.stack(old_mac_out, dim=1)  # Concat over time
+        old_mac_out = self.old_mac.forward_sequence(
+            batch, t_end=batch.max_seq_length - 1, stored_hidden_states=self.stored_hidden_states
+        )
         old_pi = old_mac_out
         old_pi[mask == 0] = 1.0
 
@@ -76,12 +76,10 @@ class PPOLearner:
         old_log_pi_taken = th.log(old_pi_taken + 1e-10)
 
         for k in range(self.args.epochs):
-            mac_out = []
             self.mac.init_hidden(batch.batch_size)
-            for t in range(batch.max_seq_length - 1):
-                agent_outs = self.mac.forward(batch, t=t)
-                mac_out.append(agent_outs)
-            mac_out = th.stack(mac_out, dim=1)  # Concat over time
+            mac_out = self.mac.forward_sequence(
+                batch, t_end=batch.max_seq_length - 1, stored_hidden_states=self.stored_hidden_states
+            )
 
             pi = mac_out
             advantages, critic_train_stats = self.train_critic_sequential(
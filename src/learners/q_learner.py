@@ -12,6 +12,8 @@ from modules.mixers.qmix import QMixer
 class QLearner:
     def __init__(self, mac, scheme, logger, args):
         self.args = args
+        # sampled windows are unrolled from the hidden states stored in the rollout
+        self.stored_hidden_states = getattr(args, "buffer_window", 0) > 0
         self.n_agents = args.n_agents
         self.mac = mac
         self.logger = logger
@@ -39,6 +41,8 @@ class QLearner:
 
         self.training_steps = 0
         self.last_target_update_step = 0
+        # mean absolute TD error of the episodes of the last batch, for prioritized replay
+        self.episode_priorities = None
         self.log_stats_t = -self.args.learner_log_interval - 1
 
         device = "cuda" if args.use_cuda else "cpu"
@@ -69,26 +73,21 @@ class QLearner:
             rewards = rewards.expand(-1, -1, self.n_agents)
 
         # Calculate estimated Q-Values
-        mac_out = []
         self.mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length):
-            agent_outs = self.mac.forward(batch, t=t)
-            mac_out.append(agent_outs)
-        mac_out = th.stack(mac_out, dim=1)  # Concat over time
+        mac_out = self.mac.forward_sequence(batch, stored_hidden_states=self.stored_hidden_states)
         # Pick the Q-Values for the actions taken by each agent
         chosen_action_qvals = th.gather(mac_out[:, :-1], dim=3, index=actions).squeeze(
             3
         )  # Remove the last dim
 
         # Calculate the Q-Values necessary for the target
-        target_mac_out = []
         self.target_mac.init_hidden(batch.batch_size)
-        for t in range(batch.max_seq_length):
-            target_agent_outs = self.target_mac.forward(batch, t=t)
-            target_mac_out.append(target_agent_outs)
+        target_mac_out = self.target_mac.forward_sequence(
+            batch, stored_hidden_states=self.stored_hidden_states
+        )
 
         # We don't need the first timesteps Q-Value estimate for calculating targets
-        target_mac_out = th.stack(target_mac_out[1:], dim=1)  # Concat across time
+        target_mac_out = target_mac_out[:, 1:]
 
         # Mask out unavailable actions
         target_mac_out[avail_actions[:, 1:] == 0] = -9999999
@@ -135,7 +134,14 @@ class QLearner:
         masked_td_error = td_error * mask
 
         # Normal L2 loss, take mean over actual data
-        loss = (masked_td_error**2).sum() / mask.sum()
+        sq_td_error = masked_td_error**2
+        if "sample_weight" in batch.data.episode_data:
+            # importance weights of non-uniformly sampled episodes
+            sq_td_error = sq_td_error * batch["sample_weight"].view(-1, 1, 1)
+        loss = sq_td_error.sum() / mask.sum()
+        self.episode_priorities = (
+            masked_td_error.abs().sum(dim=(1, 2)) / mask.sum(dim=(1, 2)).clamp(min=1)
+        ).detach()
 
         # Optimise
         self.optimiser.zero_grad()
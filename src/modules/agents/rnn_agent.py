@@ -1,7 +1,46 @@
 # code adapted from https://github.com/wendelinboehmer/dcg
 
+import math
+
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+
+def shared_gru(cell):
+    # Single-layer nn.GRU (batch_first) whose parameters are those of the nn.GRUCell
+    # cell, to run the cell over whole sequences with the GRU kernel. Both modules see
+    # the same updates, loads and device moves of the parameters
+    gru = nn.GRU(cell.input_size, cell.hidden_size, bias=cell.bias, batch_first=True)
+    gru.weight_ih_l0 = cell.weight_ih
+    gru.weight_hh_l0 = cell.weight_hh
+    if cell.bias:
+        gru.bias_ih_l0 = cell.bias_ih
+        gru.bias_hh_l0 = cell.bias_hh
+    return gru
+
+
+def gru_sequence(gru, inputs, hidden_state, lengths=None):
+    # Runs the single-layer nn.GRU gru over inputs [bs, T, *, input_size] from
+    # hidden_state [bs, *, hidden_size] (or reshapeable). Returns the hidden states
+    # [bs, T, *, hidden_size] and the last ones [bs, *, hidden_size].
+    # Without lengths all T timesteps are evaluated, as when stepping the cell. With
+    # lengths [bs] only the first lengths[b] timesteps of each sequence are (packed):
+    # the padded timesteps are masked, their hidden states are zeros and the last
+    # hidden states are the ones at lengths[b] - 1. The learners mask these timesteps
+    bs, max_t = inputs.shape[:2]
+    inner = inputs.shape[2:-1]
+    n = math.prod(inner)
+    x = inputs.reshape(bs, max_t, n, -1).transpose(1, 2).reshape(bs * n, max_t, -1)
+    h0 = hidden_state.reshape(1, bs * n, gru.hidden_size)
+    if lengths is not None:
+        lengths = lengths.repeat_interleave(n).clamp(min=1).cpu()
+        x = pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+    h, h_n = gru(x, h0)
+    if lengths is not None:
+        h, _ = pad_packed_sequence(h, batch_first=True, total_length=max_t)
+    h = h.reshape(bs, n, max_t, -1).transpose(1, 2).reshape(bs, max_t, *inner, -1)
+    return h, h_n.reshape(bs, *inner, -1)
 
 
 class RNNAgent(nn.Module):
@@ -12,6 +51,9 @@ class RNNAgent(nn.Module):
         self.fc1 = nn.Linear(input_shape, args.hidden_dim)
         if self.args.use_rnn:
             self.rnn = nn.GRUCell(args.hidden_dim, args.hidden_dim)
+            # forward_sequence runs self.rnn as an nn.GRU, kept in a tuple so that it is
+            # not a submodule and checkpoints only hold the cell
+            self._gru = (shared_gru(self.rnn),)
         else:
             self.rnn = nn.Linear(args.hidden_dim, args.hidden_dim)
         self.fc2 = nn.Linear(args.hidden_dim, args.n_actions)
@@ -30,3 +72,16 @@ class RNNAgent(nn.Module):
         q = self.fc2(h)
         return q, h
 
+    def forward_sequence(self, inputs, hidden_state, lengths=None):
+        # forward over whole sequences, inputs: [bs, T, n_agents, -1], lengths: [bs]
+        # number of timesteps to evaluate (see gru_sequence for the padded ones). fc1 and
+        # fc2 are applied once to all timesteps and the recurrence runs as one nn.GRU
+        # with the parameters of self.rnn
+        x = F.relu(self.fc1(inputs))
+        if self.args.use_rnn:
+            h, h_last = gru_sequence(self._gru[0], x, hidden_state, lengths)
+        else:
+            h = F.relu(self.rnn(x))
+            h_last = h[:, -1]
+        q = self.fc2(h)
+        return q, h_last
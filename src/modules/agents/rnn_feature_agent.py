@@ -1,5 +1,7 @@
 import torch.nn as nn
 
+from modules.agents.rnn_agent import gru_sequence, shared_gru
+
 
 class RNNFeatureAgent(nn.Module):
     """ Identical to rnn_agent, but does not compute value/probability for each action, only the hidden state. """
@@ -8,6 +10,8 @@ class RNNFeatureAgent(nn.Module):
         self.args = args
         self.fc1 = nn.Linear(input_shape, args.hidden_dim)
         self.rnn = nn.GRUCell(args.hidden_dim, args.hidden_dim)
+        # not a submodule, see RNNAgent
+        self._gru = (shared_gru(self.rnn),)
 
     def init_hidden(self):
         return self.fc1.weight.new(1, self.args.hidden_dim).zero_()
@@ -15,4 +19,9 @@ class RNNFeatureAgent(nn.Module):
     def forward(self, inputs, hidden_state):
         x = nn.functional.relu(self.fc1(inputs))
         h = self.rnn(x, hidden_state.reshape(-1, self.args.hidden_dim))
-        return None, h
\ No newline at end of file
+        return None, h
+
+    def forward_sequence(self, inputs, hidden_state, lengths=None):
+        """ Hidden states for whole sequences inputs [bs, T, *, input_shape] with one nn.GRU, see RNNAgent. """
+        x = nn.functional.relu(self.fc1(inputs))
+        return gru_sequence(self._gru[0], x, hidden_state, lengths)
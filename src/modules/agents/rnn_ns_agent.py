@@ -1,40 +1,132 @@
+import math
+
 import torch.nn as nn
+import torch.nn.functional as F
 import torch as th
 
-from modules.agents.rnn_agent import RNNAgent
+from modules.critics.mlp import EnsembleLinear, ensemble_linear
+
+
+class EnsembleGRUCell(nn.Module):
+    # n_models independent nn.GRUCell with stacked weights [n_models, in, 3 * hidden]
+    # (gates in the order r, z, n of nn.GRUCell), inputs and hidden states
+    # [..., n_models, -1]
+    def __init__(self, n_models, input_size, hidden_size):
+        super(EnsembleGRUCell, self).__init__()
+        self.hidden_size = hidden_size
+        self.weight_ih = nn.Parameter(th.empty(n_models, input_size, 3 * hidden_size))
+        self.weight_hh = nn.Parameter(th.empty(n_models, hidden_size, 3 * hidden_size))
+        self.bias_ih = nn.Parameter(th.empty(n_models, 3 * hidden_size))
+        self.bias_hh = nn.Parameter(th.empty(n_models, 3 * hidden_size))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same initialisation as nn.GRUCell for every model
+        bound = 1.0 / math.sqrt(self.hidden_size)
+        for w in self.parameters():
+            nn.init.uniform_(w, -bound, bound)
+
+    def forward(self, inputs, hidden_state):
+        return self.step(self.input_gates(inputs), hidden_state)
+
+    def input_gates(self, inputs):
+        # input part of the gates, which can be computed for all timesteps at once
+        return ensemble_linear(inputs, self.weight_ih, self.bias_ih)
+
+    def step(self, gi, hidden_state):
+        gh = ensemble_linear(hidden_state, self.weight_hh, self.bias_hh)
+        i_r, i_z, i_n = gi.chunk(3, dim=-1)
+        h_r, h_z, h_n = gh.chunk(3, dim=-1)
+        r = th.sigmoid(i_r + h_r)
+        z = th.sigmoid(i_z + h_z)
+        n = th.tanh(i_n + r * h_n)
+        return n + z * (hidden_state - n)
 
 
 class RNNNSAgent(nn.Module):
+    # One RNNAgent per agent without parameter sharing. The per-agent fc1/rnn/fc2
+    # weights are stacked so that all agents are evaluated in one batched matmul
+    # per layer (and per gate group of the GRU)
     def __init__(self, input_shape, args):
         super(RNNNSAgent, self).__init__()
         self.args = args
         self.n_agents = args.n_agents
         self.input_shape = input_shape
-        self.agents = th.nn.ModuleList(
-            [RNNAgent(input_shape, args) for _ in range(self.n_agents)]
-        )
+
+        self.fc1 = EnsembleLinear(self.n_agents, input_shape, args.hidden_dim)
+        if self.args.use_rnn:
+            self.rnn = EnsembleGRUCell(self.n_agents, args.hidden_dim, args.hidden_dim)
+        else:
+            self.rnn = EnsembleLinear(self.n_agents, args.hidden_dim, args.hidden_dim)
+        self.fc2 = EnsembleLinear(self.n_agents, args.hidden_dim, args.n_actions)
 
     def init_hidden(self):
         # make hidden states on same device as model
-        return th.cat([a.init_hidden() for a in self.agents])
+        return self.fc1.weight.new(self.n_agents, self.args.hidden_dim).zero_()
 
     def forward(self, inputs, hidden_state):
-        hiddens = []
-        qs = []
-        if inputs.size(0) == self.n_agents:
-            for i in range(self.n_agents):
-                q, h = self.agents[i](inputs[i].unsqueeze(0), hidden_state[:, i])
-                hiddens.append(h)
-                qs.append(q)
-            return th.cat(qs), th.cat(hiddens).unsqueeze(0)
+        # inputs: [bs * n_agents, input_shape], hidden_state: [bs, n_agents, hidden_dim]
+        inputs = inputs.view(-1, self.n_agents, self.input_shape)
+        x = F.relu(self.fc1(inputs))
+        h_in = hidden_state.reshape(-1, self.n_agents, self.args.hidden_dim)
+        if self.args.use_rnn:
+            h = self.rnn(x, h_in)
         else:
-            for i in range(self.n_agents):
-                inputs = inputs.view(-1, self.n_agents, self.input_shape)
-                q, h = self.agents[i](inputs[:, i], hidden_state[:, i])
-                hiddens.append(h.unsqueeze(1))
-                qs.append(q.unsqueeze(1))
-            return th.cat(qs, dim=-1).view(-1, q.size(-1)), th.cat(hiddens, dim=1)
+            h = F.relu(self.rnn(x))
+        q = self.fc2(h)
+        return q.reshape(-1, q.size(-1)), h
+
+    def forward_sequence(self, inputs, hidden_state, lengths=None):
+        # forward over whole sequences, inputs: [bs, T, n_agents, input_shape], lengths:
+        # [bs] number of timesteps to evaluate, as in RNNAgent.forward_sequence. fc1, fc2
+        # and the input part of the GRU gates are computed for all timesteps at once.
+        # The stacked per-agent weights have no nn.GRU kernel, so only the hidden state
+        # update steps through time, up to the longest sequence: the padded timesteps
+        # get zero hidden states and keep the last hidden state of their sequence
+        x = F.relu(self.fc1(inputs))
+        if self.args.use_rnn:
+            gi = self.rnn.input_gates(x)
+            h = hidden_state.reshape(-1, self.n_agents, self.args.hidden_dim)
+            max_t = inputs.size(1)
+            if lengths is not None:
+                lengths = lengths.clamp(min=1).view(-1, 1, 1)
+                max_t = int(lengths.max())
+            hs = []
+            for t in range(max_t):
+                h_t = self.rnn.step(gi[:, t], h)
+                if lengths is not None:
+                    filled = t < lengths
+                    h_t = h_t * filled
+                    h = th.where(filled, h_t, h)
+                else:
+                    h = h_t
+                hs.append(h_t)
+            hs = th.stack(hs, dim=1)
+            if max_t < inputs.size(1):
+                hs = F.pad(hs, (0, 0, 0, 0, 0, inputs.size(1) - max_t))
+            q = self.fc2(hs)
+            return q, h
+        h = F.relu(self.rnn(x))
+        q = self.fc2(h)
+        return q, h[:, -1]
+
+    def load_state_dict(self, state_dict, strict=True):
+        if "agents.0.fc1.weight" in state_dict:
+            # checkpoint with one RNNAgent per agent (agents.<i>.<param>)
+            state_dict = self._stack_agents_state_dict(state_dict)
+        return super().load_state_dict(state_dict, strict)
+
+    def _stack_agents_state_dict(self, state_dict):
+        names = [k[len("agents.0.") :] for k in state_dict if k.startswith("agents.0.")]
+        stacked = {}
+        for name in names:
+            params = [
+                state_dict["agents.{}.{}".format(i, name)]
+                for i in range(self.n_agents)
+            ]
+            # nn.Linear/nn.GRUCell weights are [out, in], stacked weights [in, out]
+            stacked[name] = th.stack([p.t() if p.dim() == 2 else p for p in params])
+        return stacked
 
     def cuda(self, device="cuda:0"):
-        for a in self.agents:
-            a.cuda(device=device)
+        return super().cuda(device=device)
@@ -3,10 +3,10 @@
 import torch as th
 import torch.nn as nn
 
-from modules.critics.mlp import MLP
+from modules.critics.mlp import EnsembleMLP, PerAgentCheckpointMixin
 
 
-class CentralVCriticNS(nn.Module):
+class CentralVCriticNS(PerAgentCheckpointMixin, nn.Module):
     def __init__(self, scheme, args):
         super(CentralVCriticNS, self).__init__()
 
@@ -18,18 +18,13 @@ class CentralVCriticNS(nn.Module):
         self.output_type = "v"
 
         # Set up network layers
-        self.critics = [
-            MLP(input_shape, args.hidden_dim, 1) for _ in range(self.n_agents)
-        ]
+        self.critics = EnsembleMLP(self.n_agents, input_shape, args.hidden_dim, 1)
 
     def forward(self, batch, t=None):
         inputs, bs, max_t = self._build_inputs(batch, t=t)
-        qs = []
-        for i in range(self.n_agents):
-            q = self.critics[i](inputs)
-            qs.append(q.view(bs, max_t, 1, -1))
-        q = th.cat(qs, dim=2)
-        return q
+        inputs = inputs.unsqueeze(1).expand(-1, self.n_agents, -1)
+        q = self.critics(inputs)
+        return q.view(bs, max_t, self.n_agents, -1)
 
     def _build_inputs(self, batch, t=None):
         bs = batch.batch_size
@@ -80,20 +75,3 @@ class CentralVCriticNS(nn.Module):
             input_shape += scheme["actions_onehot"]["vshape"][0] * self.n_agents
 
         return input_shape
-
-    def parameters(self):
-        params = list(self.critics[0].parameters())
-        for i in range(1, self.n_agents):
-            params += list(self.critics[i].parameters())
-        return params
-
-    def state_dict(self):
-        return [a.state_dict() for a in self.critics]
-
-    def load_state_dict(self, state_dict):
-        for i, a in enumerate(self.critics):
-            a.load_state_dict(state_dict[i])
-
-    def cuda(self):
-        for c in self.critics:
-            c.cuda()
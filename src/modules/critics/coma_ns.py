@@ -1,10 +1,10 @@
 import torch as th
 import torch.nn as nn
 
-from modules.critics.mlp import MLP
+from modules.critics.mlp import EnsembleMLP, PerAgentCheckpointMixin
 
 
-class COMACriticNS(nn.Module):
+class COMACriticNS(PerAgentCheckpointMixin, nn.Module):
     def __init__(self, scheme, args):
         super(COMACriticNS, self).__init__()
 
@@ -16,18 +16,13 @@ class COMACriticNS(nn.Module):
         self.output_type = "q"
 
         # Set up network layers
-        self.critics = [
-            MLP(input_shape, args.hidden_dim, self.n_actions)
-            for _ in range(self.n_agents)
-        ]
+        self.critics = EnsembleMLP(
+            self.n_agents, input_shape, args.hidden_dim, self.n_actions
+        )
 
     def forward(self, batch, t=None):
         inputs = self._build_inputs(batch, t=t)
-        qs = []
-        for i in range(self.n_agents):
-            q = self.critics[i](inputs[:, :, i]).unsqueeze(2)
-            qs.append(q)
-        return th.cat(qs, dim=2)
+        return self.critics(inputs)
 
     def _build_inputs(self, batch, t=None):
         bs = batch.batch_size
@@ -101,20 +96,3 @@ class COMACriticNS(nn.Module):
         # agent id
         # input_shape += self.n_agents
         return input_shape
-
-    def parameters(self):
-        params = list(self.critics[0].parameters())
-        for i in range(1, self.n_agents):
-            params += list(self.critics[i].parameters())
-        return params
-
-    def state_dict(self):
-        return [a.state_dict() for a in self.critics]
-
-    def load_state_dict(self, state_dict):
-        for i, a in enumerate(self.critics):
-            a.load_state_dict(state_dict[i])
-
-    def cuda(self):
-        for c in self.critics:
-            c.cuda()
@@ -1,3 +1,6 @@
+import math
+
+import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -14,3 +17,110 @@ class MLP(nn.Module):
         x = F.relu(self.fc2(x))
         q = self.fc3(x)
         return q
+
+
+class EnsembleLinear(nn.Module):
+    # n_models independent linear layers with stacked weights [n_models, in, out],
+    # evaluated in a single batched matmul. The model dimension of the inputs is
+    # model_dim (-2 for [..., n_models, in], -3 for [..., n_models, rows, in])
+    def __init__(self, n_models, in_features, out_features):
+        super(EnsembleLinear, self).__init__()
+        self.n_models = n_models
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(th.empty(n_models, in_features, out_features))
+        self.bias = nn.Parameter(th.empty(n_models, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # same initialisation as nn.Linear for every model
+        bound = 1.0 / math.sqrt(self.in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, inputs, model_dim=-2):
+        return ensemble_linear(inputs, self.weight, self.bias, model_dim)
+
+
+def ensemble_linear(inputs, weight, bias=None, model_dim=-2):
+    # inputs @ weight[i] (+ bias[i]) for every model i along model_dim of inputs
+    if model_dim == -2:
+        out = th.einsum("...ni,nio->...no", inputs, weight)
+    else:
+        assert model_dim == -3, "model_dim must be -2 or -3"
+        out = th.einsum("...nri,nio->...nro", inputs, weight)
+    if bias is not None:
+        out = out + (bias if model_dim == -2 else bias.unsqueeze(-2))
+    return out
+
+
+class EnsembleMLP(nn.Module):
+    # n_models MLPs without parameter sharing, equivalent to [MLP(...) for _ in
+    # range(n_models)] applied to inputs[..., i, :], without the loop over models
+    def __init__(self, n_models, input_shape, hidden_dim, output_dim):
+        super(EnsembleMLP, self).__init__()
+        self.n_models = n_models
+        self.fc1 = EnsembleLinear(n_models, input_shape, hidden_dim)
+        self.fc2 = EnsembleLinear(n_models, hidden_dim, hidden_dim)
+        self.fc3 = EnsembleLinear(n_models, hidden_dim, output_dim)
+
+    def forward(self, inputs, model_dim=-2):
+        # inputs: [..., n_models, input_shape], or [..., n_models, rows, input_shape]
+        # with model_dim=-3. Inputs shared by all models can be passed expanded
+        x = F.relu(self.fc1(inputs, model_dim))
+        x = F.relu(self.fc2(x, model_dim))
+        q = self.fc3(x, model_dim)
+        return q
+
+    def factorized_fc1(self, inputs, n_other):
+        # fc1 term (with bias) of inputs for every model, where the last n_other input
+        # features of the network are left out to be added by forward_factorized.
+        # inputs: [..., n_models, -1]
+        n_in = self.fc1.in_features - n_other
+        return ensemble_linear(inputs, self.fc1.weight[:, :n_in], self.fc1.bias)
+
+    def forward_factorized(self, x_in, other_inputs):
+        # Equivalent to forward(cat(inputs, other_inputs)) for every row of other_inputs
+        # without materialising the concatenation: x_in is
+        # factorized_fc1(inputs, other_inputs.size(-1)), [..., n_models, hidden_dim],
+        # computed once and broadcast-added to the fc1 term of each row. other_inputs:
+        # [rows, n_other] shared by all models or [..., n_models, rows, n_other].
+        # Returns [..., n_models, rows, output_dim]
+        n_in = self.fc1.in_features - other_inputs.size(-1)
+        if other_inputs.dim() == 2:
+            other_inputs = other_inputs.expand(self.n_models, -1, -1)
+        x = x_in.unsqueeze(-2) + ensemble_linear(
+            other_inputs, self.fc1.weight[:, n_in:], model_dim=-3
+        )
+        x = F.relu(x)
+        x = F.relu(self.fc2(x, model_dim=-3))
+        q = self.fc3(x, model_dim=-3)
+        return q
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints with one MLP per model (<prefix><i>.fc1.weight, ...) are stacked,
+        # nn.Linear weights being [out, in] and the stacked weights [n_models, in, out]
+        if prefix + "0.fc1.weight" in state_dict:
+            for layer in ["fc1", "fc2", "fc3"]:
+                for param in ["weight", "bias"]:
+                    params = [
+                        state_dict.pop("{}{}.{}.{}".format(prefix, i, layer, param))
+                        for i in range(self.n_models)
+                    ]
+                    if param == "weight":
+                        params = [p.t() for p in params]
+                    state_dict["{}{}.{}".format(prefix, layer, param)] = th.stack(params)
+        super(EnsembleMLP, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class PerAgentCheckpointMixin:
+    # Non-shared critics with an EnsembleMLP self.critics also load the checkpoints
+    # saved before the ensemble: a list with the state dict of one MLP per agent
+    def load_state_dict(self, state_dict, strict=True):
+        if isinstance(state_dict, list):
+            state_dict = {
+                "critics.{}.{}".format(i, k): v
+                for i, agent_state_dict in enumerate(state_dict)
+                for k, v in agent_state_dict.items()
+            }
+        return super().load_state_dict(state_dict, strict)
@@ -1,23 +1,9 @@
-from itertools import product
-
 from einops import rearrange, repeat
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
 
-
-def generate_other_actions(n_actions, n_agents, device):
-    # print(avail_actions.shape)
-    # ^ batch n_steps agents actions
-    other_acts = [
-        th.cat(x)
-        for x in product(
-            *[th.eye(n_actions, device=device) for _ in range(n_agents - 1)]
-        )
-    ]
-    other_acts = th.stack(other_acts)
-
-    return other_acts
+from modules.critics.pac_ac_ns import cat_other_actions, generate_other_actions
 
 
 class PACCritic(nn.Module):
@@ -38,8 +24,11 @@ class PACCritic(nn.Module):
         self.fc3 = nn.Linear(args.hidden_dim, self.n_actions)
 
         self.device = "cuda" if args.use_cuda else "cpu"
+        self.factorized = getattr(args, "critic_factorized", False)
 
     def forward(self, batch, t=None, compute_all=False):
+        if compute_all and self.factorized:
+            return self._forward_all_factorized(batch, t=t)
         if compute_all:
             inputs, bs, max_t, other_actions = self._build_inputs_all(batch, t=t)
         else:
@@ -50,15 +39,99 @@ class PACCritic(nn.Module):
         q = self.fc3(x)
         return q, other_actions
 
+    def compute_all_chunks(self, batch, t=None, chunk_size=0, other_actions=None):
+        # Yields (q, offset) where q is forward(batch, t, compute_all=True)[0] restricted
+        # to the joint actions [offset, offset + chunk_size) of the other agents, so
+        # that reductions over dim 3 never need the full tensor in memory. A subset of
+        # joint actions ([n_joint, -1] or [bs, max_t, n_agents, n_joint, -1]) can be
+        # given as other_actions instead of the default ones
+        inputs, bs, max_t = self._build_inputs_base(batch, t=t)
+        if other_actions is None:
+            other_actions = self._gen_other_actions(batch, bs, max_t, expand=False)
+        return self._iter_all_chunks(
+            self._forward_base(inputs), chunk_size, other_actions
+        )
+
+    def forward_with_all(self, batch, chunk_size=0, other_actions=None):
+        # forward(batch) and compute_all_chunks(batch) from a single build of the
+        # critic inputs (and, when factorized, of their fc1 term). Returns the Q-values
+        # of the taken joint actions, with gradients, and the compute_all generator,
+        # which runs without gradients
+        inputs, bs, max_t = self._build_inputs_base(batch)
+        if other_actions is None:
+            other_actions = self._gen_other_actions(batch, bs, max_t, expand=False)
+        base = self._forward_base(inputs)
+        taken_actions = self._taken_other_actions(batch).unsqueeze(3)
+        q = self._forward_other_actions(base, taken_actions).squeeze(3)
+        return q, self._iter_all_chunks(base, chunk_size, other_actions)
+
+    def forward_other_actions(self, batch, other_actions, t=None):
+        # Q-values for the given joint actions of the other agents along dim -2 of
+        # other_actions, [bs, max_t, n_agents, n_joint, n_actions]
+        inputs, bs, max_t = self._build_inputs_base(batch, t=t)
+        return self._forward_other_actions(self._forward_base(inputs), other_actions)
+
+    def sample_other_actions(self, batch, sample_size):
+        # sample_size joint actions of the other agents per (batch, time, agent), drawn
+        # uniformly over the available actions, [bs, max_t, n_agents, sample_size, -1]
+        return self._gen_subsample_other_actions(
+            batch, batch.batch_size, batch.max_seq_length, sample_size
+        )
+
+    @th.no_grad()
+    def _iter_all_chunks(self, base, chunk_size, other_actions):
+        n_other_actions = other_actions.size(-2)
+        if chunk_size <= 0:
+            chunk_size = n_other_actions
+        for offset in range(0, n_other_actions, chunk_size):
+            chunk = other_actions[..., offset : offset + chunk_size, :]
+            yield self._forward_other_actions(base, chunk), offset
+
+    def _forward_all_factorized(self, batch, t=None):
+        # Same output as _build_inputs_all + forward, but the state/obs/last action
+        # part of fc1 is evaluated once per (batch, time, agent) and broadcast-added
+        # to the other agents' action part instead of being repeated per joint action
+        inputs, bs, max_t = self._build_inputs_base(batch, t=t)
+        other_actions = self._gen_other_actions(batch, bs, max_t, expand=False)
+        q = self._forward_other_actions(self._forward_base(inputs), other_actions)
+        other_actions = other_actions.expand(bs, max_t, self.n_agents, -1, -1)
+        return q, other_actions
+
+    def _forward_base(self, inputs):
+        # Part of the forward pass that does not depend on the other agents' actions:
+        # the fc1 term of the inputs when factorized, the inputs otherwise
+        if not self.factorized:
+            return inputs
+        n_in = self.fc1.in_features - self.n_actions * (self.n_agents - 1)
+        return F.linear(inputs, self.fc1.weight[:, :n_in], self.fc1.bias)
+
+    def _forward_other_actions(self, base, other_actions):
+        # base: _forward_base(inputs), other_actions: [n_joint, -1] or
+        # [bs, max_t, n_agents, n_joint, -1]
+        if self.factorized:
+            n_in = self.fc1.in_features - other_actions.size(-1)
+            x = base.unsqueeze(-2) + F.linear(other_actions, self.fc1.weight[:, n_in:])
+        else:
+            x = self.fc1(cat_other_actions(base, other_actions))
+        x = F.relu(x)
+        x = F.relu(self.fc2(x))
+        q = self.fc3(x)
+        return q
+
+    def _gen_other_actions(self, batch, bs, max_t, expand=True):
+        if getattr(self.args, "use_subsampling", False):
+            return self._gen_subsample_other_actions(
+                batch, bs, max_t, self.args.sample_size
+            )
+        if not expand:
+            return generate_other_actions(self.n_actions, self.n_agents, self.device)
+        return self._gen_all_other_actions(batch, bs, max_t)
+
     def _gen_all_other_actions(self, batch, bs, max_t):
         other_agents_actions = generate_other_actions(
             self.n_actions, self.n_agents, self.device
         )
-        n_other_actions = other_agents_actions.shape[0]
-        other_agents_actions = repeat(
-            other_agents_actions, "e f -> n s a e f", n=bs, s=max_t, a=self.n_agents
-        )
-        return other_agents_actions
+        return other_agents_actions.expand(bs, max_t, self.n_agents, -1, -1)
 
     def _gen_subsample_other_actions(self, batch, bs, max_t, sample_size):
         avail_actions = batch["avail_actions"]
@@ -81,7 +154,8 @@ class PACCritic(nn.Module):
         samples = rearrange(samples, "i j k l m -> k l i j m")
         return samples
 
-    def _build_inputs_all(self, batch, t=None):
+    def _build_inputs_base(self, batch, t=None):
+        # Critic inputs without the other agents' actions, [bs, max_t, n_agents, -1]
         bs = batch.batch_size
         max_t = batch.max_seq_length if t is None else 1
 
@@ -102,15 +176,9 @@ class PACCritic(nn.Module):
         # last actions
         if self.args.obs_last_action:
             if t == 0:
-                inputs.append(
-                    th.zeros_like(batch["actions_onehot"][:, 0:1]).view(
-                        bs, max_t, 1, -1
-                    )
-                )
+                last_actions = th.zeros_like(batch["actions_onehot"][:, 0:1])
             elif isinstance(t, int):
-                inputs.append(
-                    batch["actions_onehot"][:, slice(t - 1, t)].view(bs, max_t, 1, -1)
-                )
+                last_actions = batch["actions_onehot"][:, slice(t - 1, t)]
             else:
                 last_actions = th.cat(
                     [
@@ -119,19 +187,18 @@ class PACCritic(nn.Module):
                     ],
                     dim=1,
                 )
-                last_actions = last_actions.view(bs, max_t, 1, -1).repeat(
-                    1, 1, self.n_agents, 1
-                )
-                inputs.append(last_actions)
+            last_actions = last_actions.reshape(bs, max_t, 1, -1).repeat(
+                1, 1, self.n_agents, 1
+            )
+            inputs.append(last_actions)
 
         inputs = th.cat(inputs, dim=-1)
+        return inputs, bs, max_t
 
-        if self.args.use_subsampling:
-            other_actions = self._gen_subsample_other_actions(
-                batch, bs, max_t, self.args.sample_size
-            )
-        else:
-            other_actions = self._gen_all_other_actions(batch, bs, max_t)
+    def _build_inputs_all(self, batch, t=None):
+        inputs, bs, max_t = self._build_inputs_base(batch, t=t)
+
+        other_actions = self._gen_other_actions(batch, bs, max_t)
 
         n_other_actions = other_actions.size(3)
 
@@ -143,48 +210,14 @@ class PACCritic(nn.Module):
         return inputs, bs, max_t, other_actions
 
     def _build_inputs_cur(self, batch, t=None):
-        bs = batch.batch_size
-        max_t = batch.max_seq_length if t is None else 1
-
-        ts = slice(None) if t is None else slice(t, t + 1)
-        inputs = []
-        # state
-        inputs.append(batch["state"][:, ts].unsqueeze(2).repeat(1, 1, self.n_agents, 1))
-
-        # observations
-        if self.args.obs_individual_obs:
-            inputs.append(
-                batch["obs"][:, ts]
-                .view(bs, max_t, -1)
-                .unsqueeze(2)
-                .repeat(1, 1, self.n_agents, 1)
-            )
+        inputs, bs, max_t = self._build_inputs_base(batch, t=t)
 
-        # last actions
-        if self.args.obs_last_action:
-            if t == 0:
-                inputs.append(
-                    th.zeros_like(batch["actions_onehot"][:, 0:1]).view(
-                        bs, max_t, 1, -1
-                    )
-                )
-            elif isinstance(t, int):
-                inputs.append(
-                    batch["actions_onehot"][:, slice(t - 1, t)].view(bs, max_t, 1, -1)
-                )
-            else:
-                last_actions = th.cat(
-                    [
-                        th.zeros_like(batch["actions_onehot"][:, 0:1]),
-                        batch["actions_onehot"][:, :-1],
-                    ],
-                    dim=1,
-                )
-                last_actions = last_actions.view(bs, max_t, 1, -1).repeat(
-                    1, 1, self.n_agents, 1
-                )
-                inputs.append(last_actions)
+        actions = self._taken_other_actions(batch)
+        inputs = th.cat((inputs, actions), dim=-1)
+        return inputs, bs, max_t, actions
 
+    def _taken_other_actions(self, batch):
+        # one-hot actions taken by the other agents, [bs, max_t, n_agents, -1]
         actions = []
         for i in range(self.n_agents):
             actions.append(
@@ -197,11 +230,7 @@ class PACCritic(nn.Module):
                     dim=-1,
                 )
             )
-        actions = th.cat(actions, dim=2)
-        inputs.append(actions)
-        # inputs.append()
-        inputs = th.cat(inputs, dim=-1)
-        return inputs, bs, max_t, actions
+        return th.cat(actions, dim=2)
 
     def _get_input_shape(self, scheme):
         # state
@@ -20,6 +20,7 @@ class DCGCriticNS:
         self.args = args
         input_shape = self._get_input_shape(scheme)
         self._build_agents(input_shape)
+        self.hidden_state_sequence = None
         self.agent_output_type = args.agent_output_type
         self.n_actions = args.n_actions
         self.payoff_rank = args.cg_payoff_rank
@@ -60,13 +61,16 @@ class DCGCriticNS:
         """Returns all outputs of the utility and payoff functions."""
         with th.no_grad() if not compute_grads else contextlib.suppress():
             # Compute all hidden states
-            agent_inputs = self._build_inputs(ep_batch, t).view(
-                ep_batch.batch_size, self.n_agents, -1
-            )
-            for i, ag in enumerate(self.agents):
-                self.hidden_states[i] = ag(
-                    agent_inputs[:, i, :], self.hidden_states[i]
-                )[1].view(ep_batch.batch_size, -1)
+            if self.hidden_state_sequence is not None:
+                self.hidden_states = [h[:, t] for h in self.hidden_state_sequence]
+            else:
+                agent_inputs = self._build_inputs(ep_batch, t).view(
+                    ep_batch.batch_size, self.n_agents, -1
+                )
+                for i, ag in enumerate(self.agents):
+                    self.hidden_states[i] = ag(
+                        agent_inputs[:, i, :], self.hidden_states[i]
+                    )[1].view(ep_batch.batch_size, -1)
             # Compute all utility functions
             f_i, f_ij = [], []
             for i, f in enumerate(self.utility_fun):
@@ -357,6 +361,21 @@ class DCGCriticNS:
         self.hidden_states = [
             ag.init_hidden().expand(batch_size, -1) for ag in self.agents
         ]  # bv
+        self.hidden_state_sequence = None
+
+    def init_hidden_sequence(self, ep_batch, compute_grads=False):
+        """Initializes the hidden states and computes those of all agents for every time step of ep_batch at once,
+        with one nn.GRU per agent (the agents' inputs do not depend on the actions). Until the next init_hidden,
+        forward(ep_batch, t) reads them instead of stepping the agents, so t can be evaluated in any order."""
+        self.init_hidden(ep_batch.batch_size)
+        with th.no_grad() if not compute_grads else contextlib.suppress():
+            # all agents observe the state, see _build_inputs
+            inputs = ep_batch["state"]
+            lengths = ep_batch.seq_lengths()
+            self.hidden_state_sequence = [
+                ag.forward_sequence(inputs, self.hidden_states[i], lengths)[0]
+                for i, ag in enumerate(self.agents)
+            ]
 
     def forward(
         self,
@@ -10,7 +10,11 @@ from types import SimpleNamespace as SN
 import torch as th
 
 from controllers import REGISTRY as mac_REGISTRY
+from components.async_actor import AsyncActor
+from components.batch_prefetcher import BatchPrefetcher
 from components.episode_buffer import ReplayBuffer
+from components.memmap_buffer import MemmapReplayBuffer
+from components.ragged_buffer import RaggedReplayBuffer
 from components.transforms import OneHot
 from learners import REGISTRY as le_REGISTRY
 from runners import REGISTRY as r_REGISTRY
@@ -122,26 +126,75 @@ def run_sequential(args, logger):
         scheme["reward"] = {"vshape": (1,)}
     else:
         scheme["reward"] = {"vshape": (args.n_agents,)}
+    if getattr(args, "buffer_window", 0) > 0:
+        # written by the runners, sampled windows are unrolled from them
+        scheme["hidden_states"] = {"vshape": (args.hidden_dim,), "group": "agents"}
     groups = {"agents": args.n_agents}
     preprocess = {"actions": ("actions_onehot", [OneHot(out_dim=args.n_actions)])}
+    if getattr(args, "buffer_compact", False):
+        # replay buffer storage only, runners and learners see the dtypes above
+        scheme["avail_actions"]["storage_dtype"] = th.bool
+        scheme["actions"]["storage_dtype"] = (
+            th.uint8 if env_info["n_actions"] <= 256 else th.int16
+        )
+        scheme["actions"]["lazy_preprocess"] = True
+        obs_dtype = getattr(th, getattr(args, "buffer_obs_dtype", "float32"))
+        scheme["state"]["storage_dtype"] = obs_dtype
+        scheme["obs"]["storage_dtype"] = obs_dtype
+        if "hidden_states" in scheme:
+            scheme["hidden_states"]["storage_dtype"] = obs_dtype
+
+    if getattr(args, "buffer_memmap_path", ""):
+        assert args.buffer_cpu_only, "A memory-mapped buffer is kept on the cpu"
+        buffer = MemmapReplayBuffer(
+            scheme,
+            groups,
+            args.buffer_size,
+            env_info["episode_limit"] + 1,
+            args.buffer_memmap_path,
+            preprocess=preprocess,
+        )
+    elif getattr(args, "buffer_ragged_steps", 0) > 0:
+        buffer = RaggedReplayBuffer(
+            scheme,
+            groups,
+            args.buffer_size,
+            env_info["episode_limit"] + 1,
+            args.buffer_ragged_steps,
+            preprocess=preprocess,
+            device="cpu" if args.buffer_cpu_only else args.device,
+        )
+    else:
+        buffer = ReplayBuffer(
+            scheme,
+            groups,
+            args.buffer_size,
+            env_info["episode_limit"] + 1,
+            preprocess=preprocess,
+            device="cpu" if args.buffer_cpu_only else args.device,
+        )
 
-    buffer = ReplayBuffer(
-        scheme,
-        groups,
-        args.buffer_size,
-        env_info["episode_limit"] + 1,
-        preprocess=preprocess,
-        device="cpu" if args.buffer_cpu_only else args.device,
-    )
+    buffer.sample_by_length = getattr(args, "buffer_sample_by_length", False)
+    buffer.length_weights = getattr(args, "buffer_length_weights", False)
+    buffer.window = getattr(args, "buffer_window", 0)
+    buffer.burn_in = getattr(args, "buffer_burn_in", 0)
+    if getattr(args, "buffer_prioritized", False):
+        assert not buffer.sample_by_length, "Prioritized replay cannot also sample by length"
+        buffer.prioritize(args.buffer_priority_alpha, args.buffer_priority_beta)
 
     # Setup multiagent controller here
     mac = mac_REGISTRY[args.mac](buffer.scheme, groups, args)
 
     # Give runner the scheme
-    runner.setup(scheme=scheme, groups=groups, preprocess=preprocess, mac=mac)
+    runner.setup(
+        scheme=scheme, groups=groups, preprocess=preprocess, mac=mac, buffer=buffer
+    )
 
     # Learner
     learner = le_REGISTRY[args.learner](mac, buffer.scheme, logger, args)
+    assert buffer.priorities is None or hasattr(learner, "episode_priorities"), (
+        "Learner {} does not support prioritized replay".format(args.learner)
+    )
 
     if args.use_cuda:
         learner.cuda()
@@ -184,6 +237,28 @@ def run_sequential(args, logger):
             logger.console_logger.info("Finished Evaluation")
             return
 
+    # Prepare the next training batch in the background while the learner trains.
+    # Prefetched batches are sampled one iteration ahead, which on-policy setups
+    # (training on the whole buffer) cannot afford
+    prefetcher = None
+    if getattr(args, "prefetch_batches", False):
+        if args.buffer_size > args.batch_size:
+            prefetcher = BatchPrefetcher(buffer, args.batch_size, args.device)
+        else:
+            logger.console_logger.warning(
+                "prefetch_batches ignored since buffer_size <= batch_size"
+            )
+
+    # Collect the training episodes in a background thread while the learner trains.
+    # On-policy setups (training on the whole buffer) drop the batches collected with
+    # parameters more than async_max_policy_lag updates behind the learner
+    actor = None
+    max_policy_lag = None
+    if getattr(args, "async_actor", False):
+        actor = AsyncActor(runner, mac, getattr(args, "async_queue_size", 2))
+        if args.buffer_size <= args.batch_size:
+            max_policy_lag = getattr(args, "async_max_policy_lag", 1)
+
     # start training
     episode = 0
     last_test_T = -args.test_interval - 1
@@ -195,48 +270,69 @@ def run_sequential(args, logger):
 
     logger.console_logger.info("Beginning training for {} timesteps".format(args.t_max))
 
-    while runner.t_env <= args.t_max:
+    t_env = runner.t_env
+    while t_env <= args.t_max:
         # Run for a whole episode at a time
-        episode_batch = runner.run(test_mode=False)
-        buffer.insert_episode_batch(episode_batch)
-
-        if buffer.can_sample(args.batch_size):
-            episode_sample = buffer.sample(args.batch_size)
-
-            # Truncate batch to only filled timesteps
-            max_ep_t = episode_sample.max_t_filled()
-            episode_sample = episode_sample[:, :max_ep_t]
-
-            if episode_sample.device != args.device:
-                episode_sample.to(args.device)
-
-            learner.train(episode_sample, runner.t_env, episode)
+        episode_batch, t_env, stale = collect_batch(runner, actor, max_policy_lag, logger)
+        # streaming runners insert their episodes as they finish and return None
+        if episode_batch is not None:
+            buffer.insert_episode_batch(episode_batch)
+
+        if not stale and buffer.can_sample(args.batch_size):
+            if prefetcher is not None:
+                if prefetcher.pending == 0:
+                    prefetcher.request()
+                episode_sample = prefetcher.get()
+                prefetcher.request()
+            else:
+                # sampled batches are truncated to their filled timesteps
+                episode_sample = buffer.sample(args.batch_size)
+
+                if episode_sample.device != args.device:
+                    episode_sample.to(args.device)
+
+            learner.train(episode_sample, t_env, episode)
+            if buffer.priorities is not None:
+                buffer.update_priorities(
+                    episode_sample["sample_id"].view(-1).cpu().numpy(),
+                    learner.episode_priorities.cpu().numpy(),
+                    episode_sample["sample_version"].view(-1).cpu().numpy(),
+                )
+            if actor is not None:
+                actor.publish()
 
         # Execute test runs once in a while
         n_test_runs = max(1, args.test_nepisode // runner.batch_size)
-        if (runner.t_env - last_test_T) / args.test_interval >= 1.0:
+        if (t_env - last_test_T) / args.test_interval >= 1.0:
             logger.console_logger.info(
-                "t_env: {} / {}".format(runner.t_env, args.t_max)
+                "t_env: {} / {}".format(t_env, args.t_max)
             )
             logger.console_logger.info(
                 "Estimated time left: {}. Time passed: {}".format(
-                    time_left(last_time, last_test_T, runner.t_env, args.t_max),
+                    time_left(last_time, last_test_T, t_env, args.t_max),
                     time_str(time.time() - start_time),
                 )
             )
             last_time = time.time()
 
-            last_test_T = runner.t_env
-            for _ in range(n_test_runs):
-                runner.run(test_mode=True)
+            last_test_T = t_env
+            if actor is not None:
+                # with the latest parameters, between two runs of the actor
+                with actor.runner_lock:
+                    actor.load_params()
+                    for _ in range(n_test_runs):
+                        runner.run(test_mode=True)
+            else:
+                for _ in range(n_test_runs):
+                    runner.run(test_mode=True)
 
         if args.save_model and (
-            runner.t_env - model_save_time >= args.save_model_interval
+            t_env - model_save_time >= args.save_model_interval
             or model_save_time == 0
         ):
-            model_save_time = runner.t_env
+            model_save_time = t_env
             save_path = os.path.join(
-                args.local_results_path, "models", args.unique_token, str(runner.t_env)
+                args.local_results_path, "models", args.unique_token, str(t_env)
             )
             # "results/models/{}".format(unique_token)
             os.makedirs(save_path, exist_ok=True)
@@ -248,7 +344,7 @@ def run_sequential(args, logger):
 
             if args.use_wandb and args.wandb_save_model:
                 wandb_save_dir = os.path.join(
-                    logger.wandb.dir, "models", args.unique_token, str(runner.t_env)
+                    logger.wandb.dir, "models", args.unique_token, str(t_env)
                 )
                 os.makedirs(wandb_save_dir, exist_ok=True)
                 for f in os.listdir(save_path):
@@ -256,17 +352,54 @@ def run_sequential(args, logger):
                         os.path.join(save_path, f), os.path.join(wandb_save_dir, f)
                     )
 
-        episode += args.batch_size_run
-
-        if (runner.t_env - last_log_T) >= args.log_interval:
-            logger.log_stat("episode", episode, runner.t_env)
+        if not stale:
+            episode += args.batch_size_run
+
+        if (t_env - last_log_T) >= args.log_interval:
+            logger.log_stat("episode", episode, t_env)
+            for k, v in buffer.sample_stats().items():
+                logger.log_stat(k, v, t_env)
+            if prefetcher is not None:
+                for k, v in prefetcher.wait_stats().items():
+                    logger.log_stat(k, v, t_env)
+            if actor is not None:
+                for k, v in actor.stats().items():
+                    logger.log_stat(k, v, t_env)
             logger.print_recent_stats()
-            last_log_T = runner.t_env
-
+            last_log_T = t_env
+
+    if actor is not None:
+        actor.close()
+    if prefetcher is not None:
+        prefetcher.close()
+    if isinstance(buffer, MemmapReplayBuffer):
+        buffer.flush()
     runner.close_env()
     logger.console_logger.info("Finished Training")
 
 
+def collect_batch(runner, actor, max_policy_lag, logger):
+    # Next batch of training episodes, from the runner or from the async actor.
+    # Returns (episode batch, t_env, stale): t_env is the runner's env step count right
+    # after the batch was collected (the actor keeps stepping the envs meanwhile) and
+    # stale batches, collected more than max_policy_lag updates ago, are dropped
+    # (None). The test, save and log schedules still advance with the env steps they
+    # took, the episode counter does not
+    if actor is None:
+        episode_batch = runner.run(test_mode=False)
+        return episode_batch, runner.t_env, False
+
+    episode_batch, version, t_env = actor.get()
+    stale = max_policy_lag is not None and actor.version - version > max_policy_lag
+    actor.record_lag(version, dropped=stale)
+    if stale:
+        logger.console_logger.debug(
+            "Dropped a batch collected {} updates ago".format(actor.version - version)
+        )
+        episode_batch = None
+    return episode_batch, t_env, stale
+
+
 def args_sanity_check(config, _log):
     # set CUDA flags
     # config["use_cuda"] = True # Use cuda whenever possible!
@@ -5,3 +5,6 @@ REGISTRY["episode"] = EpisodeRunner
 
 from .parallel_runner import ParallelRunner
 REGISTRY["parallel"] = ParallelRunner
+
+from .inference_runner import InferenceRunner
+REGISTRY["inference"] = InferenceRunner
@@ -39,7 +39,7 @@ class EpisodeRunner:
         # Log the first run
         self.log_train_stats_t = -1000000
 
-    def setup(self, scheme, groups, preprocess, mac):
+    def setup(self, scheme, groups, preprocess, mac, buffer=None):
         self.new_batch = partial(
             EpisodeBatch,
             scheme,
@@ -50,6 +50,37 @@ class EpisodeRunner:
             device=self.args.device,
         )
         self.mac = mac
+        # With buffer_fill_in_place, training episodes are written straight into
+        # reserved slots of the replay buffer when it lives on the same device, test
+        # episodes reuse test_batch
+        self.buffer = buffer
+        self.test_batch = None
+
+    def _episode_batch(self, test_mode):
+        if test_mode:
+            if self.test_batch is None:
+                self.test_batch = self.new_batch()
+            else:
+                self.test_batch.clear_filled()
+            return self.test_batch
+        if (
+            self.buffer is not None
+            and getattr(self.args, "buffer_fill_in_place", False)
+            and self.buffer.device == self.args.device
+            and self.buffer.can_reserve
+        ):
+            # a rollout that raised before its batch was inserted left it reserved
+            self.buffer.release_episode_batch()
+            return self.buffer.reserve_episode_batch(self.batch_size)
+        return self.new_batch()
+
+    def _store_hidden_states(self, bs=slice(None)):
+        # hidden states the agents select their actions at self.t from, replayed
+        # windows are unrolled from them (see ReplayBuffer.window_batch)
+        if "hidden_states" not in self.batch.scheme:
+            return
+        hidden_states = self.mac.hidden_states.detach().reshape(self.batch_size, self.args.n_agents, -1)
+        self.batch.update({"hidden_states": hidden_states[bs]}, bs=bs, ts=self.t, mark_filled=False)
 
     def get_env_info(self):
         return self.env.get_env_info()
@@ -60,13 +91,13 @@ class EpisodeRunner:
     def close_env(self):
         self.env.close()
 
-    def reset(self):
-        self.batch = self.new_batch()
+    def reset(self, test_mode=False):
+        self.batch = self._episode_batch(test_mode)
         self.env.reset()
         self.t = 0
 
     def run(self, test_mode=False):
-        self.reset()
+        self.reset(test_mode)
 
         terminated = False
         if self.args.common_reward:
@@ -83,6 +114,7 @@ class EpisodeRunner:
             }
 
             self.batch.update(pre_transition_data, ts=self.t)
+            self._store_hidden_states()
 
             # Pass the entire batch of experiences up till now to the agents
             # Receive the actions for each agent at this timestep in a batch of size 1
@@ -117,6 +149,7 @@ class EpisodeRunner:
         if test_mode and self.args.render:
             print(f"Episode return: {episode_return}")
         self.batch.update(last_data, ts=self.t)
+        self._store_hidden_states()
 
         # Select actions in the last stored state
         actions = self.mac.select_actions(
@@ -0,0 +1,120 @@
+from multiprocessing import connection
+import time
+
+import torch as th
+
+from runners.parallel_runner import ParallelRunner
+
+
+class InferenceRunner(ParallelRunner):
+    """
+    ParallelRunner whose training envs are served actions as their steps come back
+    instead of in lockstep: this process acts as the inference server of the env
+    workers, which only step their envs. It waits for the workers whose step replies
+    arrive within inference_max_delay seconds of the first one (or until
+    inference_batch_size envs wait), selects the actions of these envs in one batch and
+    sends them back, while the other workers keep stepping. The hidden states of the
+    agents are kept per env, the episodes are streamed into the replay buffer (see
+    ParallelRunner._run_streaming). Test runs are run in lockstep
+    """
+
+    def __init__(self, args, logger):
+        super(InferenceRunner, self).__init__(args, logger)
+        self.streaming = True
+        self.inference_batch_size = getattr(self.args, "inference_batch_size", 0) or self.batch_size
+        self.inference_max_delay = getattr(self.args, "inference_max_delay", 0.001)
+        self.batch_sizes = []
+
+    def _start_stream(self):
+        super(InferenceRunner, self)._start_stream()
+        # [batch_size, n_agents, hidden_dim], rows of the batches are loaded into the mac
+        self.hidden_states = self.mac.hidden_states.reshape(self.batch_size, self.args.n_agents, -1).clone()
+        # workers whose envs wait for actions, the others have a step pending
+        self.waiting_workers = list(range(len(self.env_blocks)))
+        self.pending_workers = []
+
+    def _reset_hidden_states(self, ids):
+        self.hidden_states[ids] = 0
+
+    def _run_streaming(self):
+        if not self.stream_started:
+            self._start_stream()
+        episode_returns = []
+        episode_lengths = []
+        final_env_infos = []
+        self.env_steps_this_run = 0
+
+        while len(episode_returns) < self.batch_size:
+            self._serve(self.waiting_workers)
+            self.pending_workers.extend(self.waiting_workers)
+            self.waiting_workers = self._recv_requests(episode_returns, episode_lengths, final_env_infos)
+
+        # no step is left pending, test runs reset the envs through the same pipes
+        for worker in self.pending_workers:
+            step_data = self._recv_step(worker)
+            self._store_stream_steps(
+                self.env_blocks[worker], step_data, episode_returns, episode_lengths, final_env_infos
+            )
+        self.waiting_workers.extend(self.pending_workers)
+        self.pending_workers = []
+
+        self.t_env += self.env_steps_this_run
+        self._record_episodes(False, episode_returns, episode_lengths, final_env_infos)
+        return None
+
+    def _recv_requests(self, episode_returns, episode_lengths, final_env_infos):
+        # Stores the steps of the pending workers that reply within inference_max_delay
+        # of the first reply, returns these workers
+        conns = {self.parent_conns[worker]: worker for worker in self.pending_workers}
+        workers = []
+        n_envs = 0
+        deadline = None
+        while conns and n_envs < self.inference_batch_size:
+            timeout = None if deadline is None else max(0.0, deadline - time.time())
+            ready = connection.wait(list(conns), timeout)
+            if not ready:
+                break
+            for conn in ready:
+                worker = conns.pop(conn)
+                step_data = self._recv_step(worker)
+                self._store_stream_steps(
+                    self.env_blocks[worker], step_data, episode_returns, episode_lengths, final_env_infos
+                )
+                workers.append(worker)
+                n_envs += len(self.env_blocks[worker])
+            if deadline is None:
+                deadline = time.time() + self.inference_max_delay
+        self.pending_workers = list(conns.values())
+        return workers
+
+    def _serve(self, workers):
+        # Selects the actions of the envs of workers in one batch and sends them back
+        ids = [idx for worker in workers for idx in self.env_blocks[worker]]
+        if not ids:
+            return
+        self.batch_sizes.append(len(ids))
+        with th.no_grad():
+            if "hidden_states" in self.stream_batch.scheme:
+                self.stream_batch.update_steps(
+                    {"hidden_states": self.hidden_states[ids]}, bs=ids, ts=self.env_t[ids], mark_filled=False
+                )
+            self.mac.hidden_states = self.hidden_states[ids]
+            actions = self.mac.select_actions(self.step_batch[ids], t_ep=1, t_env=self.t_env)
+            self.hidden_states[ids] = self.mac.hidden_states.reshape(len(ids), self.args.n_agents, -1)
+        cpu_actions = actions.to("cpu").numpy()
+        self.stream_batch.update_steps({"actions": actions}, bs=ids, ts=self.env_t[ids], mark_filled=False)
+        # the last actions of the agents at the next step
+        self.step_batch.update({"actions": actions}, bs=ids, ts=0, mark_filled=False)
+
+        env_actions = dict(zip(ids, cpu_actions))
+        for worker in workers:
+            self.parent_conns[worker].send(
+                ("step_reset", {idx: env_actions[idx] for idx in self.env_blocks[worker]})
+            )
+
+    def _log(self, returns, stats, prefix):
+        # mean number of envs per inference batch, along with the training stats
+        if not prefix and self.batch_sizes:
+            self.logger.log_stat("inference_batch_size_mean", sum(self.batch_sizes) / len(self.batch_sizes), self.t_env)
+            self.batch_sizes = []
+        super(InferenceRunner, self)._log(returns, stats, prefix)
@@ -1,7 +1,9 @@
 from functools import partial
-from multiprocessing import Pipe, Process
+import math
+from multiprocessing import Pipe, Process, resource_tracker, shared_memory
 
 import numpy as np
+import torch as th
 
 from components.episode_buffer import EpisodeBatch
 from envs import REGISTRY as env_REGISTRY
@@ -16,9 +18,17 @@ class ParallelRunner:
         self.logger = logger
         self.batch_size = self.args.batch_size_run
 
+        # Each worker process steps a block of envs_per_worker envs sequentially
+        self.envs_per_worker = getattr(self.args, "envs_per_worker", 1)
+        assert self.envs_per_worker > 0, "envs_per_worker must be positive"
+        self.env_blocks = [
+            list(range(i, min(i + self.envs_per_worker, self.batch_size)))
+            for i in range(0, self.batch_size, self.envs_per_worker)
+        ]
+
         # Make subprocesses for the envs
         self.parent_conns, self.worker_conns = zip(
-            *[Pipe() for _ in range(self.batch_size)]
+            *[Pipe() for _ in range(len(self.env_blocks))]
         )
 
         # registering both smac and smacv2 causes a pysc2 error
@@ -37,11 +47,19 @@ class ParallelRunner:
         self.ps = [
             Process(
                 target=env_worker,
-                args=(worker_conn, CloudpickleWrapper(partial(env_fn, **env_arg))),
+                args=(
+                    worker_conn,
+                    [CloudpickleWrapper(partial(env_fn, **env_args[i])) for i in block],
+                    block,
+                ),
             )
-            for env_arg, worker_conn in zip(env_args, self.worker_conns)
+            for block, worker_conn in zip(self.env_blocks, self.worker_conns)
         ]
 
+        if getattr(self.args, "shared_memory_transport", False):
+            # forked workers have to share the resource tracker of this process, one
+            # of their own would unlink the shared slabs when the worker exits
+            resource_tracker.ensure_running()
         for p in self.ps:
             p.daemon = True
             p.start()
@@ -50,6 +68,19 @@ class ParallelRunner:
         self.env_info = self.parent_conns[0].recv()
         self.episode_limit = self.env_info["episode_limit"]
 
+        # With shared_memory_transport the workers write the step data into shared
+        # arrays and only the info of the last step of an episode goes over the pipes
+        self.slabs = None
+        if getattr(self.args, "shared_memory_transport", False):
+            self.slabs = SharedSlabs(self._slab_fields(), self.batch_size)
+            for parent_conn in self.parent_conns:
+                parent_conn.send(("attach_slabs", self.slabs))
+
+        # With runner_streaming the training envs are not stepped in lockstep: every
+        # env is reset as soon as its episode ends (see _run_streaming)
+        self.streaming = getattr(self.args, "runner_streaming", False)
+        self.stream_started = False
+
         self.t = 0
 
         self.t_env = 0
@@ -61,7 +92,7 @@ class ParallelRunner:
 
         self.log_train_stats_t = -100000
 
-    def setup(self, scheme, groups, preprocess, mac):
+    def setup(self, scheme, groups, preprocess, mac, buffer=None):
         self.new_batch = partial(
             EpisodeBatch,
             scheme,
@@ -71,11 +102,84 @@ class ParallelRunner:
             preprocess=preprocess,
             device=self.args.device,
         )
+        # previous and current timestep of every env, the agents select the actions of
+        # the streamed envs at t_ep=1 of it whatever the timesteps of their episodes
+        self.new_step_batch = partial(
+            EpisodeBatch,
+            scheme,
+            groups,
+            self.batch_size,
+            2,
+            preprocess=preprocess,
+            device=self.args.device,
+        )
         self.mac = mac
+        # With buffer_fill_in_place, training episodes are written straight into
+        # reserved slots of the replay buffer when it lives on the same device, test
+        # episodes reuse test_batch
+        self.buffer = buffer
+        self.test_batch = None
         self.scheme = scheme
         self.groups = groups
         self.preprocess = preprocess
 
+    def _episode_batch(self, test_mode):
+        if test_mode:
+            if self.test_batch is None:
+                self.test_batch = self.new_batch()
+            else:
+                self.test_batch.clear_filled()
+            return self.test_batch
+        if (
+            self.buffer is not None
+            and getattr(self.args, "buffer_fill_in_place", False)
+            and self.buffer.device == self.args.device
+            and self.buffer.can_reserve
+        ):
+            # a rollout that raised before its batch was inserted left it reserved
+            self.buffer.release_episode_batch()
+            return self.buffer.reserve_episode_batch(self.batch_size)
+        return self.new_batch()
+
+    def _store_hidden_states(self, bs=slice(None)):
+        # hidden states the agents select their actions at self.t from, replayed
+        # windows are unrolled from them (see ReplayBuffer.window_batch)
+        if "hidden_states" not in self.batch.scheme:
+            return
+        hidden_states = self.mac.hidden_states.detach().reshape(self.batch_size, self.args.n_agents, -1)
+        self.batch.update({"hidden_states": hidden_states[bs]}, bs=bs, ts=self.t, mark_filled=False)
+
+    def _reset_hidden_states(self, ids):
+        # zero initial hidden states (see init_hidden of the agents) of the envs ids
+        hidden_states = self.mac.hidden_states.detach().clone(memory_format=th.contiguous_format)
+        hidden_states.view(self.batch_size, self.args.n_agents, -1)[ids] = 0
+        self.mac.hidden_states = hidden_states
+
+    def _slab_fields(self):
+        n_agents = self.env_info["n_agents"]
+        reward_shape = (1,) if self.args.common_reward else (n_agents,)
+        return {
+            "state": ((self.env_info["state_shape"],), "float32"),
+            "avail_actions": ((n_agents, self.env_info["n_actions"]), "int32"),
+            "obs": ((n_agents, self.env_info["obs_shape"]), "float32"),
+            "reward": (reward_shape, "float32"),
+            "terminated": ((1,), "bool"),
+        }
+
+    def _recv_step(self, worker):
+        # {env idx: data} of the envs stepped by worker, with the reward and terminated
+        # from the slabs
+        step_data = self.parent_conns[worker].recv()
+        if self.slabs is None:
+            return step_data
+        for idx, data in step_data.items():
+            data = {"info": {}} if data is None else data
+            reward = self.slabs.arrays["reward"][idx]
+            data["reward"] = reward[0] if self.args.common_reward else reward.copy()
+            data["terminated"] = bool(self.slabs.arrays["terminated"][idx, 0])
+            step_data[idx] = data
+        return step_data
+
     def get_env_info(self):
         return self.env_info
 
@@ -85,29 +189,43 @@ class ParallelRunner:
     def close_env(self):
         for parent_conn in self.parent_conns:
             parent_conn.send(("close", None))
+        if self.slabs is not None:
+            for p in self.ps:
+                p.join()
+            self.slabs.close(unlink=True)
 
-    def reset(self):
-        self.batch = self.new_batch()
-
+    def _reset_envs(self):
         # Reset the envs
         for parent_conn in self.parent_conns:
             parent_conn.send(("reset", None))
 
         pre_transition_data = {"state": [], "avail_actions": [], "obs": []}
-        # Get the obs, state and avail_actions back
+        # Get the obs, state and avail_actions back, in the order of the envs
         for parent_conn in self.parent_conns:
-            data = parent_conn.recv()
-            pre_transition_data["state"].append(data["state"])
-            pre_transition_data["avail_actions"].append(data["avail_actions"])
-            pre_transition_data["obs"].append(data["obs"])
+            for data in parent_conn.recv():
+                if self.slabs is None:
+                    pre_transition_data["state"].append(data["state"])
+                    pre_transition_data["avail_actions"].append(data["avail_actions"])
+                    pre_transition_data["obs"].append(data["obs"])
+        if self.slabs is not None:
+            pre_transition_data = self.slabs.read(pre_transition_data.keys())
+        return pre_transition_data
 
-        self.batch.update(pre_transition_data, ts=0)
+    def reset(self, test_mode=False):
+        self.batch = self._episode_batch(test_mode)
+        # the episodes in progress of the stream are dropped with the env resets
+        self.stream_started = False
+
+        self.batch.update(self._reset_envs(), ts=0)
 
         self.t = 0
         self.env_steps_this_run = 0
 
     def run(self, test_mode=False):
-        self.reset()
+        if self.streaming and not test_mode:
+            return self._run_streaming()
+
+        self.reset(test_mode)
 
         all_terminated = False
         if self.args.common_reward:
@@ -127,6 +245,7 @@ class ParallelRunner:
         while True:
             # Pass the entire batch of experiences up till now to the agents
             # Receive the actions for each agent at this timestep in a batch for each un-terminated env
+            self._store_hidden_states(envs_not_terminated)
             actions = self.mac.select_actions(
                 self.batch,
                 t_ep=self.t,
@@ -142,17 +261,21 @@ class ParallelRunner:
                 actions_chosen, bs=envs_not_terminated, ts=self.t, mark_filled=False
             )
 
-            # Send actions to each env
-            action_idx = 0
-            for idx, parent_conn in enumerate(self.parent_conns):
-                if idx in envs_not_terminated:  # We produced actions for this env
-                    if not terminated[
-                        idx
-                    ]:  # Only send the actions to the env if it hasn't terminated
-                        parent_conn.send(("step", cpu_actions[action_idx]))
-                    action_idx += 1  # actions is not a list over every env
-                    if idx == 0 and test_mode and self.args.render:
-                        parent_conn.send(("render", None))
+            # Send the actions of its unterminated envs to each worker in one message
+            # (actions is not a list over every env)
+            env_actions = {
+                idx: env_action
+                for idx, env_action in zip(envs_not_terminated, cpu_actions)
+                if not terminated[idx]  # Only send the actions to the env if it hasn't terminated
+            }
+            stepped_workers = []
+            for worker, (block, parent_conn) in enumerate(zip(self.env_blocks, self.parent_conns)):
+                block_actions = {idx: env_actions[idx] for idx in block if idx in env_actions}
+                if block_actions:
+                    parent_conn.send(("step", block_actions))
+                    stepped_workers.append(worker)
+            if 0 in env_actions and test_mode and self.args.render:
+                self.parent_conns[0].send(("render", None))
 
             # Update envs_not_terminated
             envs_not_terminated = [
@@ -167,10 +290,13 @@ class ParallelRunner:
             # Data for the next step we will insert in order to select an action
             pre_transition_data = {"state": [], "avail_actions": [], "obs": []}
 
-            # Receive data back for each unterminated env
-            for idx, parent_conn in enumerate(self.parent_conns):
+            # Receive data back for each unterminated env, one reply per stepped worker
+            step_data = {}
+            for worker in stepped_workers:
+                step_data.update(self._recv_step(worker))
+            for idx in range(self.batch_size):
                 if not terminated[idx]:
-                    data = parent_conn.recv()
+                    data = step_data[idx]
                     # Remaining data for this current timestep
                     post_transition_data["reward"].append((data["reward"],))
 
@@ -190,9 +316,12 @@ class ParallelRunner:
                     post_transition_data["terminated"].append((env_terminated,))
 
                     # Data for the next timestep needed to select an action
-                    pre_transition_data["state"].append(data["state"])
-                    pre_transition_data["avail_actions"].append(data["avail_actions"])
-                    pre_transition_data["obs"].append(data["obs"])
+                    if self.slabs is None:
+                        pre_transition_data["state"].append(data["state"])
+                        pre_transition_data["avail_actions"].append(data["avail_actions"])
+                        pre_transition_data["obs"].append(data["obs"])
+            if self.slabs is not None:
+                pre_transition_data = self.slabs.read(pre_transition_data.keys(), envs_not_terminated)
 
             # Add post_transiton data into the batch
             self.batch.update(
@@ -219,9 +348,13 @@ class ParallelRunner:
 
         env_stats = []
         for parent_conn in self.parent_conns:
-            env_stat = parent_conn.recv()
-            env_stats.append(env_stat)
+            env_stats.extend(parent_conn.recv())
 
+        self._record_episodes(test_mode, episode_returns, episode_lengths, final_env_infos)
+        return self.batch
+
+    def _record_episodes(self, test_mode, episode_returns, episode_lengths, final_env_infos):
+        # Adds the returns and stats of finished episodes, logged once enough were run
         cur_stats = self.test_stats if test_mode else self.train_stats
         cur_returns = self.test_returns if test_mode else self.train_returns
         log_prefix = "test_" if test_mode else ""
@@ -232,7 +365,7 @@ class ParallelRunner:
                 for k in set.union(*[set(d) for d in infos])
             }
         )
-        cur_stats["n_episodes"] = self.batch_size + cur_stats.get("n_episodes", 0)
+        cur_stats["n_episodes"] = len(episode_returns) + cur_stats.get("n_episodes", 0)
         cur_stats["ep_length"] = sum(episode_lengths) + cur_stats.get("ep_length", 0)
 
         cur_returns.extend(episode_returns)
@@ -250,7 +383,124 @@ class ParallelRunner:
                 )
             self.log_train_stats_t = self.t_env
 
-        return self.batch
+    def _start_stream(self):
+        assert self.buffer is not None, "Streamed episodes are inserted into the replay buffer"
+        self.stream_batch = self.new_batch()
+        self.step_batch = self.new_step_batch()
+        pre_transition_data = self._reset_envs()
+        self.stream_batch.update(pre_transition_data, ts=0)
+        self.step_batch.update(pre_transition_data, ts=1)
+
+        # timestep, return and length of the episode in progress of every env
+        self.env_t = np.zeros(self.batch_size, dtype=np.int64)
+        if self.args.common_reward:
+            self.stream_returns = [0 for _ in range(self.batch_size)]
+        else:
+            self.stream_returns = [
+                np.zeros(self.args.n_agents) for _ in range(self.batch_size)
+            ]
+        self.stream_lengths = [0 for _ in range(self.batch_size)]
+        self.mac.init_hidden(batch_size=self.batch_size)
+        self.stream_started = True
+
+    def _run_streaming(self):
+        # Steps all envs together, but each at the timestep of its own episode: the
+        # workers reset an env as soon as its episode ends and every finished episode is
+        # inserted into the replay buffer right away, so no env waits for the longest
+        # episode of a batch. Returns None once batch_size episodes were finished. The
+        # episodes in progress carry over to the next call, unless a test run resets
+        # the envs in between
+        if not self.stream_started:
+            self._start_stream()
+        envs = list(range(self.batch_size))
+        episode_returns = []
+        episode_lengths = []
+        final_env_infos = []
+        self.env_steps_this_run = 0
+
+        while len(episode_returns) < self.batch_size:
+            # actions are selected from step_batch, the episodes are kept in stream_batch
+            with th.no_grad():
+                if "hidden_states" in self.stream_batch.scheme:
+                    hidden_states = self.mac.hidden_states.reshape(self.batch_size, self.args.n_agents, -1)
+                    self.stream_batch.update_steps(
+                        {"hidden_states": hidden_states}, bs=envs, ts=self.env_t, mark_filled=False
+                    )
+                actions = self.mac.select_actions(self.step_batch, t_ep=1, t_env=self.t_env)
+            cpu_actions = actions.to("cpu").numpy()
+            self.stream_batch.update_steps({"actions": actions}, bs=envs, ts=self.env_t, mark_filled=False)
+            # the last actions of the agents at the next step
+            self.step_batch.update({"actions": actions}, ts=0, mark_filled=False)
+
+            for block, parent_conn in zip(self.env_blocks, self.parent_conns):
+                parent_conn.send(("step_reset", {idx: cpu_actions[idx] for idx in block}))
+
+            step_data = {}
+            for worker in range(len(self.env_blocks)):
+                step_data.update(self._recv_step(worker))
+            self._store_stream_steps(envs, step_data, episode_returns, episode_lengths, final_env_infos)
+
+        self.t_env += self.env_steps_this_run
+        self._record_episodes(False, episode_returns, episode_lengths, final_env_infos)
+        return None
+
+    def _store_stream_steps(self, ids, step_data, episode_returns, episode_lengths, final_env_infos):
+        # Writes the step data of the envs ids into their episodes, the finished episodes
+        # are inserted into the replay buffer and their envs start the next ones
+        post_transition_data = {"reward": [], "terminated": []}
+        pre_transition_data = {"state": [], "avail_actions": [], "obs": []}
+        finished = []
+        for idx in ids:
+            data = step_data[idx]
+            post_transition_data["reward"].append(data["reward"])
+            self.stream_returns[idx] += data["reward"]
+            self.stream_lengths[idx] += 1
+            self.env_steps_this_run += 1
+
+            if data["terminated"]:
+                final_env_infos.append(data["info"])
+                finished.append(idx)
+            post_transition_data["terminated"].append(
+                data["terminated"] and not data["info"].get("episode_limit", False)
+            )
+
+            # last timestep of the finished episodes, the reset data comes separately
+            if self.slabs is None:
+                pre_transition_data["state"].append(data["state"])
+                pre_transition_data["avail_actions"].append(data["avail_actions"])
+                pre_transition_data["obs"].append(data["obs"])
+        if self.slabs is not None:
+            pre_transition_data = self.slabs.read(pre_transition_data.keys(), ids)
+
+        self.stream_batch.update_steps(post_transition_data, bs=ids, ts=self.env_t[ids], mark_filled=False)
+        self.env_t[ids] += 1
+        self.stream_batch.update_steps(pre_transition_data, bs=ids, ts=self.env_t[ids], mark_filled=True)
+        self.step_batch.update(pre_transition_data, bs=ids, ts=1)
+
+        if finished:
+            self.buffer.insert_episode_batch(self.stream_batch[finished])
+            episode_returns.extend(self.stream_returns[idx] for idx in finished)
+            episode_lengths.extend(self.stream_lengths[idx] for idx in finished)
+            self._restart_episodes(finished, step_data)
+
+    def _restart_episodes(self, ids, step_data):
+        # Starts the next episodes of the envs ids from the data of their resets
+        reset_data = {
+            k: [step_data[idx]["reset"][k] for idx in ids]
+            for k in ["state", "avail_actions", "obs"]
+        }
+        self.stream_batch.clear_filled(ids)
+        self.stream_batch.update(reset_data, bs=ids, ts=0)
+        self.step_batch.update(reset_data, bs=ids, ts=1)
+        # no last actions and zero hidden states at the first timestep
+        for k in ["actions", "actions_onehot"]:
+            self.step_batch.data.transition_data[k][ids, 0] = 0
+        self._reset_hidden_states(ids)
+
+        self.env_t[ids] = 0
+        for idx in ids:
+            self.stream_returns[idx] = 0 if self.args.common_reward else np.zeros(self.args.n_agents)
+            self.stream_lengths[idx] = 0
 
     def _log(self, returns, stats, prefix):
         if self.args.common_reward:
@@ -285,57 +535,147 @@ class ParallelRunner:
         stats.clear()
 
 
-def env_worker(remote, env_fn):
-    # Make environment
-    env = env_fn.x()
+def env_worker(remote, env_fns, env_ids):
+    # Make the environments of the block of envs env_ids, stepped sequentially
+    envs = {idx: env_fn.x() for idx, env_fn in zip(env_ids, env_fns)}
+    first_env = envs[env_ids[0]]
+    # shared arrays of the step data with shared_memory_transport
+    slabs = None
     while True:
         cmd, data = remote.recv()
         if cmd == "step":
-            actions = data
-            # Take a step in the environment
-            _, reward, terminated, truncated, env_info = env.step(actions)
-            terminated = terminated or truncated
-            # Return the observations, avail_actions and state to make the next action
-            state = env.get_state()
-            avail_actions = env.get_avail_actions()
-            obs = env.get_obs()
+            # {env idx: actions} of the unterminated envs, answered in one message
             remote.send(
-                {
-                    # Data for the next timestep needed to pick an action
-                    "state": state,
-                    "avail_actions": avail_actions,
-                    "obs": obs,
-                    # Rest of the data for the current timestep
-                    "reward": reward,
-                    "terminated": terminated,
-                    "info": env_info,
-                }
+                {idx: _step_env(envs[idx], actions, slabs, idx) for idx, actions in data.items()}
             )
-        elif cmd == "reset":
-            env.reset()
+        elif cmd == "step_reset":
+            # step, resetting the envs whose episode ends (streaming runner)
             remote.send(
                 {
-                    "state": env.get_state(),
-                    "avail_actions": env.get_avail_actions(),
-                    "obs": env.get_obs(),
+                    idx: _step_env(envs[idx], actions, slabs, idx, auto_reset=True)
+                    for idx, actions in data.items()
                 }
             )
+        elif cmd == "reset":
+            remote.send([_reset_env(envs[idx], slabs, idx) for idx in env_ids])
         elif cmd == "close":
-            env.close()
+            for env in envs.values():
+                env.close()
+            if slabs is not None:
+                slabs.close()
             remote.close()
             break
+        elif cmd == "attach_slabs":
+            slabs = data
         elif cmd == "get_env_info":
-            remote.send(env.get_env_info())
+            remote.send(first_env.get_env_info())
         elif cmd == "get_stats":
-            remote.send(env.get_stats())
+            remote.send([envs[idx].get_stats() for idx in env_ids])
         elif cmd == "render":
-            env.render()
+            first_env.render()
         elif cmd == "save_replay":
-            env.save_replay()
+            first_env.save_replay()
         else:
             raise NotImplementedError
 
 
+def _step_env(env, actions, slabs, idx, auto_reset=False):
+    # Take a step in the environment
+    _, reward, terminated, truncated, env_info = env.step(actions)
+    terminated = terminated or truncated
+    # Return the observations, avail_actions and state to make the next action
+    state = env.get_state()
+    avail_actions = env.get_avail_actions()
+    obs = env.get_obs()
+    if slabs is not None:
+        slabs.write(
+            idx,
+            state=state,
+            avail_actions=avail_actions,
+            obs=obs,
+            reward=reward,
+            terminated=terminated,
+        )
+        if not terminated:
+            return None
+        data = {"info": env_info}
+    else:
+        data = {
+            # Data for the next timestep needed to pick an action
+            "state": state,
+            "avail_actions": avail_actions,
+            "obs": obs,
+            # Rest of the data for the current timestep
+            "reward": reward,
+            "terminated": terminated,
+            "info": env_info,
+        }
+    if terminated and auto_reset:
+        # first timestep of the next episode, the slabs keep the last one
+        data["reset"] = _reset_env(env, None, idx)
+    return data
+
+
+def _reset_env(env, slabs, idx):
+    env.reset()
+    if slabs is not None:
+        slabs.write(
+            idx,
+            state=env.get_state(),
+            avail_actions=env.get_avail_actions(),
+            obs=env.get_obs(),
+        )
+        return None
+    return {
+        "state": env.get_state(),
+        "avail_actions": env.get_avail_actions(),
+        "obs": env.get_obs(),
+    }
+
+
+class SharedSlabs:
+    """
+    Numpy arrays [n_envs, *shape] of the step data of the envs in one block of shared
+    memory, each worker writes the row of its env. fields: {key: (shape, dtype)}.
+    Unpickled copies (e.g. sent to the workers) attach to the same block
+    """
+
+    def __init__(self, fields, n_envs, name=None):
+        self.fields = fields
+        self.n_envs = n_envs
+        offsets, size = {}, 0
+        for k, (shape, dtype) in fields.items():
+            offsets[k] = size
+            nbytes = n_envs * math.prod(shape) * np.dtype(dtype).itemsize
+            size += -(-nbytes // 8) * 8
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.arrays = {
+            k: np.ndarray((n_envs, *shape), dtype=dtype, buffer=self.shm.buf, offset=offsets[k])
+            for k, (shape, dtype) in fields.items()
+        }
+
+    def __reduce__(self):
+        return SharedSlabs, (self.fields, self.n_envs, self.shm.name)
+
+    def write(self, idx, **data):
+        for k, v in data.items():
+            self.arrays[k][idx] = v
+
+    def read(self, keys, ids=None):
+        # Tensors of the rows ids (all envs if None) of keys, for EpisodeBatch.update.
+        # All rows are shared without copy, they stay valid until the next step
+        if ids is None or len(ids) == self.n_envs:
+            return {k: th.from_numpy(self.arrays[k]) for k in keys}
+        return {k: th.from_numpy(self.arrays[k][ids]) for k in keys}
+
+    def close(self, unlink=False):
+        # the arrays hold pointers into the block, which cannot be closed before them
+        self.arrays = {}
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
 class CloudpickleWrapper:
     """
     Uses cloudpickle to serialize contents (otherwise multiprocessing tries to use pickle)
@@ -2,6 +2,7 @@ from collections import defaultdict
 from hashlib import sha256
 import json
 import logging
+import threading
 
 import numpy as np
 
@@ -16,6 +17,8 @@ class Logger:
         self.use_hdf = False
 
         self.stats = defaultdict(lambda: [])
+        # stats can be logged from the actor thread (see AsyncActor)
+        self.lock = threading.RLock()
 
     def setup_tb(self, directory_name):
         # Import here so it doesn't have to be installed if you don't use it
@@ -84,6 +87,10 @@ class Logger:
         self.use_sacred = True
 
     def log_stat(self, key, value, t, to_sacred=True):
+        with self.lock:
+            self._log_stat(key, value, t, to_sacred)
+
+    def _log_stat(self, key, value, t, to_sacred):
         self.stats[key].append((t, value))
 
         if self.use_tb:
@@ -110,6 +117,10 @@ class Logger:
             self._run_obj.log_scalar(key, value, t)
 
     def print_recent_stats(self):
+        with self.lock:
+            self._print_recent_stats()
+
+    def _print_recent_stats(self):
         log_str = "Recent Stats | t_env: {:>10} | Episode: {:>8}\n".format(
             *self.stats["episode"][-1]
         )